@@ -0,0 +1,119 @@
+"""
+Benchmarks preparing and serializing emails with large attachments stored on
+the local filesystem, with many messages being sent concurrently.
+
+Compares reading attachments into memory (what ``prepare_email_message`` used
+to do), encoding them from a memory map, which saves the raw copy but still
+builds the encoded payload in memory, and encoding them into spooled
+temporary files. Run from the repository root::
+
+    python benchmarks/attachments.py --size 25 --emails 20 --threads 5
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from multiprocessing.dummy import Pool as ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+    INSTALLED_APPS=['post_office'],
+    MEDIA_ROOT=MEDIA_ROOT,
+    POST_OFFICE={},
+)
+django.setup()
+
+from django.core.mail import EmailMessage  # noqa
+
+from post_office.attachments import attach, write_message  # noqa
+from post_office.models import Attachment  # noqa
+
+
+class NullWriter(object):
+    """Stands in for the SMTP socket."""
+
+    def write(self, data):
+        pass
+
+
+def create_attachment(size):
+    name = 'benchmark.pdf'
+    with open(os.path.join(MEDIA_ROOT, name), 'wb') as f:
+        for i in range(size):
+            f.write(os.urandom(1024 * 1024))
+    return Attachment(file=name, name=name)
+
+
+def send_in_memory(attachment):
+    message = EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+    message.attach(attachment.name, attachment.file.read(),
+                   mimetype=attachment.mimetype or None)
+    attachment.file.close()
+    message.message().as_bytes(linesep='\r\n')
+
+
+def send_memory_mapped(attachment):
+    message = EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+    attach(message, attachment)
+    message.message().as_bytes(linesep='\r\n')
+
+
+def send_streamed(attachment):
+    message = EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+    attach(message, attachment)
+    write_message(message.message(), NullWriter())
+
+
+MODES = [
+    ('in memory', send_in_memory, {}),
+    ('memory mapped', send_memory_mapped, {}),
+    ('streamed', send_streamed, {'ATTACHMENT_STREAMING_THRESHOLD': 0,
+                                 'ATTACHMENT_SPOOL_SIZE': 1024 * 1024}),
+]
+
+
+def run(attachment, size, emails, threads):
+    print('%d emails with a %dMB attachment, %d threads' % (emails, size, threads))
+    print('%-15s %10s %18s' % ('mode', 'seconds', 'peak memory (MB)'))
+    for name, send, config in MODES:
+        settings.POST_OFFICE = config
+        # Every email gets its own Attachment instance, just like emails
+        # fetched by get_queued() do
+        attachments = [Attachment(file=attachment.file.name, name=attachment.name)
+                       for i in range(emails)]
+        pool = ThreadPool(threads)
+        tracemalloc.start()
+        start = time.time()
+        pool.map(send, attachments)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        pool.close()
+        pool.join()
+        print('%-15s %10.2f %18.1f' % (name, elapsed, peak / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=25,
+                        help='Attachment size in MB, defaults to 25')
+    parser.add_argument('--emails', type=int, default=20,
+                        help='Number of emails to send, defaults to 20')
+    parser.add_argument('--threads', type=int, default=5,
+                        help='Number of sending threads, defaults to 5')
+    args = parser.parse_args()
+    try:
+        attachment = create_attachment(args.size)
+        run(attachment, args.size, args.emails, args.threads)
+    finally:
+        shutil.rmtree(MEDIA_ROOT)
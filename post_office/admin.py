@@ -1,29 +1,55 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import json
 import logging
 import warnings
 
 
 from django import forms
 from django.contrib import admin
+from django.contrib.admin.utils import prepare_lookup_value
+from django.contrib.admin.views.main import ChangeList, ERROR_FLAG, IGNORED_PARAMS, PAGE_VAR, SEARCH_VAR
 from django.conf import settings
-from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.conf.urls import url
+from django.core.exceptions import ValidationError, ImproperlyConfigured, PermissionDenied
+from django.core.paginator import Paginator
+from django.core.validators import validate_email
+from django.db import connections
 from django.forms import BaseInlineFormSet, widgets
 from django.forms.widgets import TextInput
+from django.http import JsonResponse
+from django.template.response import TemplateResponse
 from django.template.defaultfilters import safe
 from django.utils import six
-from django.utils.html import strip_spaces_between_tags, escape
+from django.utils.html import format_html, strip_spaces_between_tags, escape
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 from django.utils.text import Truncator
 from django.utils.translation import ugettext, ugettext_lazy as _, ungettext
 
-from . import settings as postoffice_settings
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+from . import cache, settings as postoffice_settings
 from .fields import CommaSeparatedEmailField
-from .models import Attachment, Log, Email, EmailTemplate, STATUS, AttachmentTemplate
+from .models import (Attachment, BulkAction, Log, Email, EmailTemplate, ExceptionFingerprint,
+                     STATUS, AttachmentTemplate)
+from .stats import get_queue_stats
 from .utils import render_to_template_email
 
 logger = logging.getLogger(__name__)
 
+
+def is_recipient_term(term):
+    """Returns whether ``term`` is an email address or an ``@domain``."""
+    try:
+        validate_email('user' + term if term.startswith('@') else term)
+    except ValidationError:
+        return False
+    return True
+
 class LogInline(admin.StackedInline):
     model = Log
     extra = 0
@@ -72,7 +98,164 @@ class CommaSeparatedEmailWidget(TextInput):
 
 
 
-class EmailAdmin(admin.ModelAdmin):
+def estimate_count(queryset):
+    """
+    Returns the number of rows matched by ``queryset`` as estimated by the
+    query planner on PostgreSQL, or from table statistics for unfiltered
+    querysets on MySQL. Counts rows on other databases.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, six.string_types):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    if connection.vendor == 'mysql' and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                           'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] is not None:
+            return int(row[0])
+    return queryset.count()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator relying on estimated counts, exact counts are only run when
+    the estimate is below ``exact_count_threshold``.
+    """
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        count = estimate_count(self.object_list)
+        if count < self.exact_count_threshold:
+            count = self.object_list.count()
+        return count
+
+
+# Id of the last email of the previous page
+CURSOR_VAR = 'before'
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Pages through emails ordered by descending id by filtering on the last
+    id of the previous page instead of using OFFSET, which scans every
+    skipped row. Other orderings fall back to numbered pages.
+    """
+    keyset = False
+    next_cursor = None
+
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.cursor = int(request.GET.get(CURSOR_VAR, 0)) or None
+        except ValueError:
+            self.cursor = None
+        super(KeysetChangeList, self).__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        # The cursor isn't a lookup, nor kept in filter and ordering links
+        self.params.pop(CURSOR_VAR, None)
+        return super(KeysetChangeList, self).get_filters_params(params)
+
+    def get_results(self, request):
+        if self.show_all or list(self.queryset.query.order_by) not in (['-pk'], ['-id']):
+            return super(KeysetChangeList, self).get_results(request)
+
+        queryset = self.queryset
+        if self.cursor:
+            queryset = queryset.filter(pk__lt=self.cursor)
+        result_list = list(queryset[:self.list_per_page + 1])
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            self.next_cursor = result_list[-1].pk
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+
+        self.keyset = True
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = self.next_cursor is not None or self.cursor is not None
+        self.paginator = paginator
+
+    def get_cursor_url(self, cursor):
+        return self.get_query_string({CURSOR_VAR: cursor} if cursor else {})
+
+    @property
+    def next_page_url(self):
+        return self.get_cursor_url(self.next_cursor)
+
+    @property
+    def first_page_url(self):
+        return self.get_cursor_url(None)
+
+
+class TemplateNameFilter(admin.ListFilter):
+    """
+    Filters emails by template name typed in a text input, suggesting
+    matching names instead of listing every template.
+    """
+    title = _('template')
+    parameter_name = 'template_name'
+    lookup = 'template__name'
+    template = 'admin/post_office/template_name_filter.html'
+    max_suggestions = 50
+
+    def __init__(self, request, params, model, model_admin):
+        super(TemplateNameFilter, self).__init__(request, params, model, model_admin)
+        self.value = params.pop(self.parameter_name, '').strip()
+
+    def has_output(self):
+        return True
+
+    def expected_parameters(self):
+        return [self.parameter_name]
+
+    def queryset(self, request, queryset):
+        if self.value:
+            return queryset.filter(**{self.lookup: self.value})
+        return queryset
+
+    def suggestions(self):
+        names = EmailTemplate.objects.filter(default_template__isnull=True)
+        if self.value:
+            names = names.filter(name__istartswith=self.value)
+        return names.order_by('name').values_list('name', flat=True)[:self.max_suggestions]
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value,
+            'suggestions': self.suggestions(),
+            'params': [(key, value) for key, value in changelist.params.items()
+                       if key != self.parameter_name],
+        }
+
+
+class ReadDatabaseMixin(object):
+    """
+    Reads changelists from ``POST_OFFICE['READ_DATABASE']``, other views
+    and changelist actions keep using the primary database.
+    """
+
+    def get_queryset(self, request):
+        queryset = super(ReadDatabaseMixin, self).get_queryset(request)
+        match = getattr(request, 'resolver_match', None)
+        if request.method == 'GET' and match and match.url_name and \
+                match.url_name.endswith('_changelist'):
+            queryset = queryset.using(postoffice_settings.get_read_database())
+        return queryset
+
+
+class EmailAdmin(ReadDatabaseMixin, admin.ModelAdmin):
     list_display = ('id', 'to_display', 'subject', 'template',
                     'status', 'last_updated')
     list_filter = ['status', 'template']
@@ -81,6 +264,7 @@ class EmailAdmin(admin.ModelAdmin):
 
     actions = ['requeue', 'set_as_sent']
     inlines = [LogInline, AttachmentInline]
+    change_list_template = 'admin/post_office/email/change_list.html'
 
     formfield_overrides = {
         CommaSeparatedEmailField: {'widget': CommaSeparatedEmailWidget}
@@ -99,6 +283,103 @@ class EmailAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         return super(EmailAdmin, self).get_queryset(request).select_related('template')
 
+    def get_object(self, request, object_id, from_field=None):
+        obj = super(EmailAdmin, self).get_object(request, object_id, from_field)
+        if obj is not None and obj.body_id is not None:
+            # Deduplicated emails are edited through their body's content
+            obj.message, obj.html_message = obj.get_bodies()
+        return obj
+
+    def save_model(self, request, obj, form, change):
+        if obj.body_id is not None:
+            if 'html_message' in form.changed_data:
+                # An edited email no longer shares its body with others
+                obj.body = None
+            else:
+                obj.message = obj.html_message = ''
+        super(EmailAdmin, self).save_model(request, obj, form, change)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^dashboard/$', self.admin_site.admin_view(self.dashboard_view),
+                name='%s_%s_dashboard' % info),
+            url(r'^dashboard\.json$', self.admin_site.admin_view(self.dashboard_json_view),
+                name='%s_%s_dashboard_json' % info),
+        ] + super(EmailAdmin, self).get_urls()
+
+    def has_dashboard_permission(self, request):
+        has_permission = getattr(self, 'has_view_or_change_permission',  # Django >= 2.1
+                                 self.has_change_permission)
+        return has_permission(request)
+
+    def dashboard_view(self, request):
+        """Shows queue depth and throughput, read from the read database."""
+        if not self.has_dashboard_permission(request):
+            raise PermissionDenied
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title=_('Mail queue'),
+            stats=get_queue_stats(),
+            status_counters=postoffice_settings.get_status_counters(),
+        )
+        return TemplateResponse(request, 'admin/post_office/email/dashboard.html', context)
+
+    def dashboard_json_view(self, request):
+        if not self.has_dashboard_permission(request):
+            raise PermissionDenied
+        return JsonResponse(get_queue_stats())
+
+    @property
+    def show_full_result_count(self):
+        return not postoffice_settings.get_fast_admin_changelist()
+
+    def get_changelist(self, request, **kwargs):
+        if postoffice_settings.get_fast_admin_changelist():
+            return KeysetChangeList
+        return super(EmailAdmin, self).get_changelist(request, **kwargs)
+
+    def get_paginator(self, request, queryset, per_page, *args, **kwargs):
+        if postoffice_settings.get_fast_admin_changelist():
+            return EstimatedCountPaginator(queryset, per_page, *args, **kwargs)
+        return super(EmailAdmin, self).get_paginator(request, queryset, per_page, *args, **kwargs)
+
+    def get_list_filter(self, request):
+        if postoffice_settings.get_fast_admin_changelist():
+            return ['status', TemplateNameFilter]
+        return super(EmailAdmin, self).get_list_filter(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        # A single address or "@domain" term is looked up in the recipient index
+        term = search_term.strip()
+        if postoffice_settings.get_recipient_index() and is_recipient_term(term):
+            return queryset.with_recipient(term), False
+        return super(EmailAdmin, self).get_search_results(request, queryset, search_term)
+
+    def get_bulk_action_filters(self, request, queryset):
+        """
+        Describes the selection as JSON for a ``BulkAction``: the selected
+        ids, or the changelist filters and search when all matching emails
+        are selected, bounded by the current highest id.
+        """
+        if not forms.BooleanField().to_python(request.POST.get('select_across')):
+            return {'ids': list(queryset.values_list('pk', flat=True))}
+
+        renamed = dict((spec.parameter_name, spec.lookup) for spec
+                       in self.get_list_filter(request) if getattr(spec, 'lookup', None))
+        ignored = set(IGNORED_PARAMS) | set([PAGE_VAR, ERROR_FLAG, CURSOR_VAR])
+        lookups = {}
+        for key, value in request.GET.items():
+            if key not in ignored and value:
+                key = renamed.get(key, key)
+                lookups[key] = prepare_lookup_value(key, value)
+        return {
+            'lookups': lookups,
+            'search': request.GET.get(SEARCH_VAR, ''),
+            'max_id': queryset.order_by('-pk').values_list('pk', flat=True).first() or 0,
+        }
+
     def to_display(self, instance):
         return ', '.join(instance.to)
     to_display.short_description = 'to'
@@ -106,30 +387,66 @@ class EmailAdmin(admin.ModelAdmin):
 
 
     def display_mail_preview(self, obj):
-        content = safe(obj.html_message)
+        content = safe(obj.get_bodies()[1])
         return strip_spaces_between_tags(mark_safe("<div style='width:860px; '><iframe width='100%' height='350px' srcdoc='{mail_message}'>PREVIEW</iframe></div>\
                             ".format(**{'mail_message': escape(strip_spaces_between_tags(content))})))
     display_mail_preview.allow_tags = True
     display_mail_preview.short_description = ugettext("Preview")
 
+    def run_action(self, request, queryset, action, **update):
+        """
+        Updates up to ``BULK_ACTION_THRESHOLD`` emails right away, larger
+        selections are handed to a background ``BulkAction``. Returns the
+        number of updated emails, or ``None`` when deferred.
+        """
+        threshold = postoffice_settings.get_bulk_action_threshold()
+        ids = list(queryset.values_list('pk', flat=True)[:threshold + 1])
+        if len(ids) <= threshold:
+            return Email.objects.filter(pk__in=ids).update(**update)
+
+        job = BulkAction.objects.create(action=action,
+                                        filters=self.get_bulk_action_filters(request, queryset))
+        url = reverse('admin:post_office_bulkaction_change', args=[job.pk])
+        self.message_user(request, format_html(
+            ugettext('More than {0} mails are selected, they will be updated in the '
+                     'background by <a href="{1}">{2}</a>'), threshold, url, job))
+
     def requeue(self, request, queryset):
         """An admin action to requeue emails."""
-        rows_updated = queryset.update(status=STATUS.queued)
-        self.message_user(request, ungettext('%(count)d mail was requeued',
-                                             '%(count)d mails were requeued',
-                                             rows_updated) % {'count': rows_updated})
+        rows_updated = self.run_action(request, queryset, 'requeue', status=STATUS.queued)
+        if rows_updated is not None:
+            self.message_user(request, ungettext('%(count)d mail was requeued',
+                                                 '%(count)d mails were requeued',
+                                                 rows_updated) % {'count': rows_updated})
     requeue.short_description = _('Requeue selected emails')
 
     def set_as_sent(self, request, queryset):
         """An admin action to requeue emails."""
-        rows_updated = queryset.update(status=STATUS.sent)
-        self.message_user(request, ungettext('%(count)d mail was set as sent',
-                                             '%(count)d mails were set as sent',
-                                             rows_updated) % {'count': rows_updated})
+        rows_updated = self.run_action(request, queryset, 'set_as_sent', status=STATUS.sent)
+        if rows_updated is not None:
+            self.message_user(request, ungettext('%(count)d mail was set as sent',
+                                                 '%(count)d mails were set as sent',
+                                                 rows_updated) % {'count': rows_updated})
     set_as_sent.short_description = _('Set as sent selected emails')
 
 
-class LogAdmin(admin.ModelAdmin):
+class BulkActionAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'progress', 'created', 'last_updated')
+    list_filter = ('action', 'status')
+    readonly_fields = ('action', 'status', 'progress', 'message', 'created', 'last_updated')
+    fields = readonly_fields
+
+    def has_add_permission(self, request, *args):
+        return False
+
+    def progress(self, instance):
+        if instance.total is None:
+            return '-'
+        return '%d / %d' % (instance.processed, instance.total)
+    progress.short_description = _('Progress')
+
+
+class LogAdmin(ReadDatabaseMixin, admin.ModelAdmin):
     list_display = ('date', 'email', 'status', 'get_message_preview')
 
     def get_message_preview(self, instance):
@@ -138,6 +455,13 @@ class LogAdmin(admin.ModelAdmin):
     get_message_preview.short_description = 'Message'
 
 
+class ExceptionFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('exception_type', 'message', 'count', 'last_seen')
+    list_filter = ('exception_type',)
+    ordering = ('-count',)
+    readonly_fields = ('hash', 'exception_type', 'message', 'count', 'last_seen')
+
+
 class SubjectField(TextInput):
     def __init__(self, *args, **kwargs):
         super(SubjectField, self).__init__(*args, **kwargs)
@@ -234,29 +558,49 @@ class EmailTemplateAdminMixin(object):
                               ImportWarning)
         return super(EmailTemplateAdminMixin,self).formfield_for_dbfield(db_field, request, **kwargs)
 
+    def get_mail_preview(self, obj, is_plain_text=False):
+        """
+        Renders ``obj``'s preview, cached by primary key and last update
+        time, so unchanged templates aren't compiled and converted to plain
+        text on every page load. Caching follows ``POST_OFFICE_CACHE`` and
+        ``POST_OFFICE_TEMPLATE_CACHE`` like templates do.
+        """
+        use_cache = cache.cache_backend is not None and \
+            getattr(settings, 'POST_OFFICE_CACHE', True) and \
+            getattr(settings, 'POST_OFFICE_TEMPLATE_CACHE', True)
+        key = None
+        if use_cache and obj.pk and obj.last_updated:
+            key = 'preview-%s-%s-%s' % ('plain' if is_plain_text else 'html', obj.pk,
+                                        obj.last_updated.strftime('%Y%m%d%H%M%S%f'))
+            preview = cache.get(key)
+            if preview is not None:
+                return preview
+        preview = escape(strip_spaces_between_tags(render_to_template_email(
+            obj.html_content.replace('{{', '{').replace('}}', '}'), {},
+            is_plain_text=is_plain_text)))
+        if key:
+            cache.set(key, preview)
+        return preview
+
     def display_html_mail_preview(self,obj=None):
-        content_preview = render_to_template_email(obj.html_content.replace('{{', '{').replace('}}', '}'), {},
-                                                   is_plain_text=False)
         return mark_safe(strip_spaces_between_tags(mark_safe("""
             <div>
                 <iframe width='97%' height='480px' srcdoc='{mail_message}'>PREVIEW</iframe>
                 <div class='help' style='margin-left:0;padding-left:0'>{help_text}</div>
             </div>
             """.format(**{'help_text': _('*The field in brackets are variables!'),
-                         'mail_message': escape(strip_spaces_between_tags(content_preview))})
+                         'mail_message': self.get_mail_preview(obj)})
         )))
     display_html_mail_preview.short_description=_("Preview HTML")
 
     def display_plain_mail_preview(self,obj=None):
-        content_preview = render_to_template_email(obj.html_content.replace('{{', '{').replace('}}', '}'), {},
-                                                   is_plain_text=True)
         return mark_safe(strip_spaces_between_tags(mark_safe("""
                 <div style='width: 100%;'>
                     <iframe width='97%' height='480px' srcdoc='{mail_message}'>PREVIEW</iframe>
                     <div class='help' style='margin-left:0;padding-left:0'>{help_text}</div>
                 </div>
                 """.format(**{'help_text': _('*The field in brackets are variables!'),
-                              'mail_message': escape(strip_spaces_between_tags(content_preview))})
+                              'mail_message': self.get_mail_preview(obj, is_plain_text=True)})
                                                              )))
     display_plain_mail_preview.short_description=_("Preview Plain")
 
@@ -281,7 +625,7 @@ class EmailTemplateInline(EmailTemplateAdminMixin,
     def get_extra(self, request, obj=None, **kwargs):
         """Hook for customizing the number of extra inline forms."""
         if obj:
-            return len(settings.LANGUAGES) - 1 - obj.translated_templates.count()
+            return len(settings.LANGUAGES) - 1 - len(obj.translated_templates.all())
         else:
             return len(settings.LANGUAGES) - 1
 
@@ -330,7 +674,8 @@ class EmailTemplateAdmin(EmailTemplateAdminMixin,
         return super(EmailTemplateAdmin,self).formfield_for_dbfield(db_field, request, **kwargs)
 
     def get_queryset(self, request):
-        return self.model.objects.filter(default_template__isnull=True)
+        return self.model.objects.filter(default_template__isnull=True) \
+            .prefetch_related('translated_templates')
 
     def description_shortened(self, instance):
         return Truncator(instance.description.split('\n')[0]).chars(200)
@@ -338,7 +683,7 @@ class EmailTemplateAdmin(EmailTemplateAdminMixin,
     description_shortened.admin_order_field = 'description'
 
     def languages_compact(self, instance):
-        languages = [tt.language for tt in instance.translated_templates.order_by('language')]
+        languages = sorted(tt.language for tt in instance.translated_templates.all())
         return ', '.join(languages)
     languages_compact.short_description = _("Languages")
 
@@ -360,6 +705,8 @@ class AttachmentTemplateAdmin(admin.ModelAdmin):
 
 admin.site.register(Email, EmailAdmin)
 admin.site.register(Log, LogAdmin)
+admin.site.register(ExceptionFingerprint, ExceptionFingerprintAdmin)
+admin.site.register(BulkAction, BulkActionAdmin)
 admin.site.register(EmailTemplate, EmailTemplateAdmin)
 admin.site.register(Attachment, AttachmentAdmin)
 admin.site.register(AttachmentTemplate, AttachmentTemplateAdmin)
\ No newline at end of file
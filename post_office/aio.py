@@ -0,0 +1,139 @@
+"""
+Awaitable counterparts of ``mail.send()``, ``mail.send_many()`` and
+``get_email_template()`` for ASGI views, requires Python 3.5+.
+
+Blocking work runs in a bounded thread pool. Emails queued by coroutines
+running concurrently on the same event loop are validated together and
+inserted with a single query.
+
+SQLite can't handle writes from several threads at once, so on SQLite the
+pool has a single thread unless ``ASYNC_THREADS`` says otherwise.
+"""
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+
+from django.db import close_old_connections
+
+from . import mail
+from .models import Email, PRIORITY
+from .settings import get_async_batch_size, get_async_threads
+from .utils import get_email_template as _get_email_template, parse_priority
+
+_executor = None
+_executor_lock = Lock()
+_batchers = weakref.WeakKeyDictionary()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_async_threads())
+        return _executor
+
+
+def _call(func, *args, **kwargs):
+    # Worker threads outlive requests, so their database connections are
+    # recycled the same way request threads do
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(get_executor(), partial(_call, func, *args, **kwargs))
+
+
+def _create_emails(kwargs_list):
+    """
+    Validates and inserts emails, returning a list of ``(email, exception)``
+    pairs so that invalid emails only fail their own caller.
+    """
+    results = []
+    for kwargs in kwargs_list:
+        try:
+            results.append((mail.send(commit=False, **kwargs), None))
+        except Exception as e:
+            results.append((None, e))
+    emails = [email for email, exception in results if email is not None]
+    if emails:
+        Email.objects.bulk_create(emails)
+    return results
+
+
+class Batcher(object):
+    """
+    Collects ``send()`` calls made during one iteration of the event loop and
+    queues them with one ``bulk_create()``.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = []
+
+    def add(self, kwargs):
+        future = self.loop.create_future()
+        if not self.pending:
+            self.loop.call_soon(self.flush)
+        self.pending.append((kwargs, future))
+        if len(self.pending) >= get_async_batch_size():
+            self.flush()
+        return future
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if pending:
+            job = run_in_executor(_create_emails, [kwargs for kwargs, future in pending])
+            job.add_done_callback(partial(self.resolve, pending))
+
+    def resolve(self, pending, job):
+        if job.exception() is not None:
+            results = [(None, job.exception())] * len(pending)
+        else:
+            results = job.result()
+        for (kwargs, future), (email, exception) in zip(pending, results):
+            if future.cancelled():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(email)
+
+
+def get_batcher():
+    loop = asyncio.get_event_loop()
+    if loop not in _batchers:
+        _batchers[loop] = Batcher(loop)
+    return _batchers[loop]
+
+
+async def get_email_template(name, language=''):
+    return await run_in_executor(_get_email_template, name, language)
+
+
+async def send(**kwargs):
+    """
+    Queues an email, taking the same arguments as ``mail.send()``. Emails with
+    attachments or ``priority='now'`` are sent on their own, others are
+    inserted together with emails queued concurrently and returned unsaved,
+    so they may not have a primary key.
+    """
+    try:
+        priority = parse_priority(kwargs.get('priority'))
+    except ValueError:
+        priority = None  # Raised by mail.send()
+    # Batched emails are created with commit=False and inserted together
+    commit = kwargs.pop('commit', True)
+    if priority == PRIORITY.now or kwargs.get('attachments') or not commit:
+        return await run_in_executor(mail.send, commit=commit, **kwargs)
+    return await get_batcher().add(kwargs)
+
+
+async def send_many(kwargs_list):
+    await run_in_executor(mail.send_many, kwargs_list)
@@ -0,0 +1,456 @@
+import mimetypes
+import mmap
+import os
+import time
+from base64 import b64decode
+from collections import OrderedDict
+from email import encoders, message_from_string
+from email.generator import _make_boundary
+from email.mime.base import MIMEBase
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.mail.message import (DEFAULT_ATTACHMENT_MIME_TYPE,
+                                      SafeMIMEMessage, SafeMIMEText)
+from django.utils.encoding import force_str
+
+from .compat import PY3
+from .settings import (get_attachment_cache_size, get_attachment_spool_size,
+                       get_attachment_streaming_threshold,
+                       get_template_attachment_cache_size)
+
+
+try:
+    from base64 import encodebytes  # Python >= 3.1
+except ImportError:
+    from base64 import encodestring as encodebytes
+
+
+# base64 encodes 57 bytes into one 76 characters line, encoding in multiples
+# of 57 bytes keeps lines intact across chunks
+ENCODING_CHUNK_SIZE = 57 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentCache(object):
+    """
+    A cache of MIME encoded attachment parts, bounded by the total size of the
+    attachments it holds. Least recently used parts are evicted first.
+
+    ``_send_bulk`` creates one cache per batch so attachments shared by
+    several emails are only fetched from storage and encoded once.
+    """
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = get_attachment_cache_size()
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.build_time = 0.0
+        self._parts = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._parts)
+
+    def __contains__(self, key):
+        return key in self._parts
+
+    def get(self, key):
+        with self._lock:
+            try:
+                part, size = self._parts.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert the part to mark it as most recently used
+            self._parts[key] = (part, size)
+            self.hits += 1
+            return part
+
+    def set(self, key, part, size):
+        with self._lock:
+            if key in self._parts:
+                self.size -= self._parts.pop(key)[1]
+            # Parts larger than the whole cache are never stored
+            if size > self.max_size:
+                return
+            while self._parts and self.size + size > self.max_size:
+                self.size -= self._parts.popitem(last=False)[1][1]
+            self._parts[key] = (part, size)
+            self.size += size
+
+    def get_or_create(self, key, factory):
+        """
+        Returns the part stored under ``key``, calling ``factory`` to build
+        it if it's not cached yet. ``factory`` must return a (part, size) tuple.
+        """
+        part = self.get(key)
+        if part is None:
+            start = time.time()
+            part, size = factory()
+            self.build_time += time.time() - start
+            self.set(key, part, size)
+        return part
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'count': len(self._parts),
+            'size': self.size,
+        }
+
+
+class SpooledAttachment(MIMEBase, object):
+    """
+    A base64 encoded MIME part whose payload is kept in a spooled temporary
+    file, so at most ``spool_size`` bytes of it are held in memory.
+
+    ``write_message()`` copies the payload chunk by chunk, other generators
+    read the whole payload through ``get_payload()``.
+    """
+
+    def __init__(self, mimetype, spool_size=None, **params):
+        if spool_size is None:
+            spool_size = get_attachment_spool_size()
+        self.spool_size = spool_size
+        self.encoded_size = 0
+        self._spool = SpooledTemporaryFile(max_size=spool_size)
+        self._spool_lock = Lock()
+        maintype, subtype = mimetype.split('/', 1)
+        MIMEBase.__init__(self, maintype, subtype, **params)
+        self['Content-Transfer-Encoding'] = 'base64'
+
+    def _get_payload(self):
+        return b''.join(self.iter_payload()).decode('ascii')
+
+    def _set_payload(self, payload):
+        # Message.__init__() resets the payload to None
+        if payload is not None:
+            raise TypeError('Payload of spooled attachments is set with encode()')
+
+    _payload = property(_get_payload, _set_payload)
+
+    def is_multipart(self):
+        return False
+
+    @property
+    def memory_size(self):
+        """Number of bytes of the payload held in memory."""
+        return min(self.encoded_size, self.spool_size)
+
+    def encode(self, chunks):
+        """Base64 encodes the raw bytes yielded by ``chunks`` into the spool."""
+        remainder = b''
+        with self._spool_lock:
+            for chunk in chunks:
+                data = remainder + bytes(chunk) if remainder else chunk
+                cut = len(data) - len(data) % ENCODING_CHUNK_SIZE
+                if cut:
+                    self._write(encodebytes(data[:cut]))
+                # Don't keep a view on ``chunk``, it may be a memory map
+                remainder = bytes(data[cut:])
+            if remainder:
+                self._write(encodebytes(remainder))
+
+    def _write(self, data):
+        self._spool.write(data)
+        self.encoded_size += len(data)
+
+    def iter_payload(self, chunk_size=READ_CHUNK_SIZE):
+        """
+        Yields the encoded payload in chunks. Each chunk is read under a lock,
+        so messages sharing this part can be written from several threads.
+        """
+        position = 0
+        while position < self.encoded_size:
+            with self._spool_lock:
+                self._spool.seek(position)
+                chunk = self._spool.read(chunk_size)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    def decoded_payload(self):
+        return b64decode(b''.join(self.iter_payload()))
+
+
+def get_mimetype(attachment):
+    return (attachment.mimetype or mimetypes.guess_type(attachment.name)[0] or
+            DEFAULT_ATTACHMENT_MIME_TYPE)
+
+
+def is_streamed(attachment):
+    """
+    Returns whether ``attachment`` should be encoded into a spooled part.
+    Text attachments are never streamed because Django re-encodes them.
+    """
+    threshold = get_attachment_streaming_threshold()
+    if threshold is None or is_text(get_mimetype(attachment)):
+        return False
+    return attachment.file.size > threshold
+
+
+def is_text(mimetype):
+    return mimetype.startswith('text/') or mimetype == 'message/rfc822'
+
+
+def map_file(attachment):
+    """
+    Returns a read only memory map of ``attachment``'s file if it's stored
+    on the local filesystem, otherwise (or if the file is empty) None.
+    """
+    if not isinstance(attachment.file.storage, FileSystemStorage):
+        return None
+    with open(attachment.file.path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_mapped_chunks(mapping, chunk_size=ENCODING_CHUNK_SIZE):
+    """Yields zero copy views on ``mapping``."""
+    view = memoryview(mapping)
+    try:
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+    finally:
+        view.release()
+
+
+def _add_filename(part, filename):
+    # Same as EmailMessage._create_attachment()
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        filename = ('utf-8', '', filename)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+
+
+def create_mime_part(content, mimetype):
+    """
+    Returns the MIME part ``EmailMessage.attach()`` would create for
+    ``content``. Binary content of a text mimetype that isn't UTF-8 is
+    attached as ``application/octet-stream``, like Django does.
+    """
+    basetype, subtype = mimetype.split('/', 1)
+    if basetype == 'text' and isinstance(content, bytes):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            basetype, subtype = DEFAULT_ATTACHMENT_MIME_TYPE.split('/', 1)
+
+    if basetype == 'text':
+        return SafeMIMEText(content, subtype, settings.DEFAULT_CHARSET)
+    if mimetype == 'message/rfc822':
+        return SafeMIMEMessage(message_from_string(force_str(content)), subtype)
+    part = MIMEBase(basetype, subtype)
+    part.set_payload(content)
+    encoders.encode_base64(part)
+    return part
+
+
+def create_spooled_part(attachment):
+    """Returns a ``SpooledAttachment`` holding the encoded ``attachment``."""
+    part = SpooledAttachment(get_mimetype(attachment))
+    mapping = map_file(attachment)
+    if mapping is not None:
+        try:
+            part.encode(iter_mapped_chunks(mapping))
+        finally:
+            mapping.close()
+    else:
+        attachment.file.open('rb')
+        try:
+            part.encode(attachment.file.chunks(READ_CHUNK_SIZE))
+        finally:
+            attachment.file.close()
+
+    _add_filename(part, attachment.name)
+    return part
+
+
+def create_mapped_part(attachment):
+    """
+    Returns a base64 encoded MIME part of a binary ``attachment`` stored on
+    the local filesystem, encoded from a memory map of the file so its raw
+    content is never read into a bytes object. The encoded payload is still
+    held in memory. Returns None if the file can't be mapped.
+    """
+    mapping = map_file(attachment)
+    if mapping is None:
+        return None
+    try:
+        payload = encodebytes(mapping).decode('ascii')
+    finally:
+        mapping.close()
+
+    part = MIMEBase(*get_mimetype(attachment).split('/', 1))
+    part.set_payload(payload)
+    part['Content-Transfer-Encoding'] = 'base64'
+    _add_filename(part, attachment.name)
+    return part
+
+
+def create_attachment_part(attachment):
+    """
+    Reads ``attachment`` from storage and returns a (part, size) tuple where
+    part is the MIME part Django would have built for it and size the number
+    of bytes it keeps in memory.
+    """
+    if is_streamed(attachment):
+        part = create_spooled_part(attachment)
+        return part, part.memory_size
+
+    if not is_text(get_mimetype(attachment)):
+        part = create_mapped_part(attachment)
+        if part is not None:
+            return part, attachment.file.size
+
+    content = attachment.file.read()
+    attachment.file.close()
+
+    part = create_mime_part(content, get_mimetype(attachment))
+    _add_filename(part, attachment.name)
+    return part, len(content)
+
+
+def attach(message, attachment, cache=None):
+    """
+    Attaches ``attachment`` to ``message``. If ``cache`` is given, the encoded
+    MIME part is shared with other messages using the same attachment.
+    """
+    if cache is not None:
+        part = cache.get_or_create(('attachment', attachment.pk),
+                                   lambda: create_attachment_part(attachment))
+        message.attach(part)
+    elif is_streamed(attachment):
+        message.attach(create_spooled_part(attachment))
+    else:
+        part = None
+        if not is_text(get_mimetype(attachment)):
+            part = create_mapped_part(attachment)
+        if part is not None:
+            message.attach(part)
+        else:
+            message.attach(attachment.name, attachment.file.read(),
+                           mimetype=attachment.mimetype or None)
+            attachment.file.close()
+
+
+_template_attachment_cache = None
+
+
+def get_template_attachment_cache():
+    """
+    Returns the per process cache of encoded ``AttachmentTemplate`` parts,
+    keyed by file name and last modified time.
+    """
+    global _template_attachment_cache
+    if _template_attachment_cache is None:
+        _template_attachment_cache = AttachmentCache(
+            max_size=get_template_attachment_cache_size())
+    return _template_attachment_cache
+
+
+def get_modified_time(field_file):
+    storage = field_file.storage
+    try:
+        if hasattr(storage, 'get_modified_time'):  # Django >= 1.10
+            return storage.get_modified_time(field_file.name)
+        return storage.modified_time(field_file.name)
+    except NotImplementedError:
+        # Uploaded files get unique names, so the name alone is a usable key
+        return None
+
+
+def get_template_attachments(template):
+    """
+    Returns the ``AttachmentTemplate``s of ``template``, translated templates
+    also use the attachments of their default template.
+    """
+    attachments = list(template.attachments.all())
+    if template.default_template_id:
+        attachments.extend(template.default_template.attachments.all())
+    return attachments
+
+
+def attach_template_attachment(message, attachment, cache=None):
+    """
+    Attaches an ``AttachmentTemplate`` to ``message``, the encoded part is
+    shared by every message of the process until the file is modified.
+    If ``cache`` is given, the file's modified time is only looked up once.
+    """
+    def create_part():
+        key = (attachment.file.name, get_modified_time(attachment.file))
+        part = get_template_attachment_cache().get_or_create(
+            key, lambda: create_attachment_part(attachment))
+        # Memory is accounted for by the per process cache
+        return part, 0
+
+    if cache is None:
+        part = create_part()[0]
+    else:
+        part = cache.get_or_create(('template_attachment', attachment.pk), create_part)
+    message.attach(part)
+
+
+def has_spooled_parts(message):
+    return any(isinstance(part, SpooledAttachment) for part in message.walk())
+
+
+def _as_bytes(message):
+    if PY3:
+        return message.as_bytes()
+    return message.as_string()
+
+
+def _write_headers(message, fp):
+    # Same as the generators do, without generating the payload
+    if PY3:
+        for name, value in message.raw_items():
+            fp.write(message.policy.fold_binary(name, value))
+    else:
+        for name, value in message.items():
+            fp.write('%s: %s\n' % (name, value))
+    fp.write(b'\n')
+
+
+def write_message(message, fp):
+    """
+    Writes the MIME ``message`` to the binary file-like ``fp`` with "\\n" line
+    endings. Payloads of spooled attachments are copied chunk by chunk, so the
+    serialized message is never held in memory as a whole.
+    """
+    if isinstance(message, SpooledAttachment):
+        _write_headers(message, fp)
+        for chunk in message.iter_payload():
+            fp.write(chunk)
+    elif message.is_multipart() and has_spooled_parts(message):
+        boundary = message.get_boundary()
+        if boundary is None:
+            boundary = _make_boundary()
+            message.set_boundary(boundary)
+        _write_headers(message, fp)
+        if message.preamble is not None:
+            fp.write(message.preamble.encode('utf-8') + b'\n')
+        for part in message.get_payload():
+            fp.write(('--%s\n' % boundary).encode('ascii'))
+            write_message(part, fp)
+            fp.write(b'\n')
+        fp.write(('--%s--\n' % boundary).encode('ascii'))
+        if message.epilogue is not None:
+            fp.write(message.epilogue.encode('utf-8'))
+    else:
+        fp.write(_as_bytes(message))
@@ -1,6 +1,12 @@
+import smtplib
+
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.mail.message import sanitize_address
 
+from .attachments import has_spooled_parts, write_message
 from .settings import get_default_priority
 
 
@@ -54,3 +60,116 @@ class EmailBackend(BaseEmailBackend):
 
             if get_default_priority() == 'now':
                 email.dispatch()
+
+
+class SMTPDataWriter(object):
+    """
+    A binary file-like object that writes the ``DATA`` of an SMTP transaction.
+    Line endings are converted to CRLF and lines starting with a period are
+    escaped, written data is sent to the server in ``buffer_size`` chunks.
+    """
+
+    def __init__(self, connection, buffer_size=64 * 1024):
+        self.connection = connection
+        self.buffer_size = buffer_size
+        self._pending = b''
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._write_line(line)
+
+    def _write_line(self, line):
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        if line.startswith(b'.'):
+            line = b'.' + line
+        self._buffer.append(line + b'\r\n')
+        self._buffered += len(line) + 2
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.connection.send(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        """Terminates the DATA command with a line containing a single period."""
+        if self._pending:
+            self._write_line(self._pending)
+            self._pending = b''
+        self._buffer.append(b'.\r\n')
+        self.flush()
+
+
+class StreamingSMTPEmailBackend(SMTPEmailBackend):
+    """
+    An SMTP backend that writes messages with spooled attachments to the
+    socket as they are serialized, instead of building the whole message
+    in memory first. Other messages are sent like Django's SMTP backend does.
+    """
+
+    def _send(self, email_message):
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding)
+                      for addr in email_message.recipients()]
+        message = email_message.message()
+        try:
+            if has_spooled_parts(message):
+                self._stream(from_email, recipients, message)
+            else:
+                self.connection.sendmail(from_email, recipients,
+                                         message.as_bytes(linesep='\r\n'))
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
+
+    def _reset(self):
+        try:
+            self.connection.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def _stream(self, from_email, recipients, message):
+        # Mirrors smtplib.SMTP.sendmail(), except for the DATA command
+        connection = self.connection
+        connection.ehlo_or_helo_if_needed()
+
+        code, response = connection.mail(from_email)
+        if code != 250:
+            self._reset()
+            raise smtplib.SMTPSenderRefused(code, response, from_email)
+
+        refused = {}
+        for recipient in recipients:
+            code, response = connection.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            self._reset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, response = connection.docmd('data')
+        if code != 354:
+            self._reset()
+            raise smtplib.SMTPDataError(code, response)
+
+        writer = SMTPDataWriter(connection)
+        write_message(message, writer)
+        writer.close()
+
+        code, response = connection.getreply()
+        if code != 250:
+            self._reset()
+            raise smtplib.SMTPDataError(code, response)
+        return refused
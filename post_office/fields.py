@@ -1,9 +1,19 @@
+import base64
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models import TextField
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 
+from .settings import get_compress_bodies
 from .validators import validate_comma_separated_emails
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class CommaSeparatedEmailField(TextField):
     default_validators = [validate_comma_separated_emails]
@@ -56,3 +66,94 @@ class CommaSeparatedEmailField(TextField):
         field_class = 'django.db.models.fields.TextField'
         args, kwargs = introspector(self)
         return (field_class, args, kwargs)
+
+
+# Compressed values are stored base64 encoded behind a prefix naming the
+# algorithm, so uncompressed values can still be read and vice versa
+COMPRESSION_PREFIX = '\x02'
+COMPRESSION_THRESHOLD = 1024
+
+
+def get_zstandard():
+    if zstandard is None:
+        raise ImproperlyConfigured('zstd compression requires the zstandard package')
+    return zstandard
+
+
+def compress(value, algorithm):
+    data = value.encode('utf-8')
+    if algorithm == 'zlib':
+        data = zlib.compress(data)
+    elif algorithm == 'zstd':
+        data = get_zstandard().ZstdCompressor().compress(data)
+    else:
+        raise ImproperlyConfigured('Unknown compression algorithm %s' % algorithm)
+    return '%s%s:%s' % (COMPRESSION_PREFIX, algorithm, base64.b64encode(data).decode('ascii'))
+
+
+def is_compressed(value):
+    return isinstance(value, six.string_types) and value.startswith(COMPRESSION_PREFIX)
+
+
+def decompress(value):
+    algorithm, data = value[len(COMPRESSION_PREFIX):].split(':', 1)
+    data = base64.b64decode(data)
+    if algorithm == 'zlib':
+        data = zlib.decompress(data)
+    else:
+        data = get_zstandard().ZstdDecompressor().decompress(data)
+    return data.decode('utf-8')
+
+
+class CompressedTextDescriptor(object):
+    """
+    Decompresses values the first time they're accessed, and loads deferred
+    values like Django's ``DeferredAttribute``.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        if self.field.attname not in data:
+            instance.refresh_from_db(fields=[self.field.attname])
+        value = data[self.field.attname]
+        if is_compressed(value):
+            value = data[self.field.attname] = decompress(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(TextField):
+    """
+    A ``TextField`` compressed with the algorithm set by ``COMPRESS_BODIES``
+    (``'zlib'`` or ``'zstd'``) when saved, and decompressed when accessed.
+
+    Lookups compare against the stored value, so compressed values no longer
+    match exact (or ``contains``) lookups on their original text.
+    """
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name, *args, **kwargs)
+        setattr(cls, self.attname, CompressedTextDescriptor(self))
+
+    def get_db_prep_save(self, value, connection):
+        value = super(CompressedTextField, self).get_db_prep_save(value, connection)
+        algorithm = get_compress_bodies()
+        if algorithm and value and not is_compressed(value) and \
+                len(value) >= COMPRESSION_THRESHOLD:
+            value = compress(value, algorithm)
+        return value
+
+    def to_python(self, value):
+        if is_compressed(value):
+            return decompress(value)
+        return super(CompressedTextField, self).to_python(value)
+
+    def value_to_string(self, obj):
+        return self.to_python(self.value_from_object(obj))
@@ -1,17 +1,25 @@
+from itertools import islice
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
+from threading import local
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import connection as db_connection
+from django.db import DEFAULT_DB_ALIAS, connections as db_connections, transaction
 from django.db.models import Q
 from django.template import Context, Template
 from django.utils.timezone import now
 
+from .attachments import AttachmentCache
 from .connections import connections
-from .models import Email, EmailTemplate, Log, PRIORITY, STATUS
-from .settings import (get_available_backends, get_batch_size,
-                       get_log_level, get_sending_order, get_threads_per_process)
+from . import profiling
+from .metrics import get_metrics
+from .models import (Email, EmailBody, EmailTemplate, QueuedEmail, SharedContext,
+                     log_deliveries, PRIORITY, STATUS)
+from .settings import (get_available_backends, get_batch_size, get_database,
+                       get_deduplicate_bodies,
+                       get_log_level, get_queue_table, get_sending_order,
+                       get_threads_per_process)
 from .utils import (get_email_template, parse_emails, parse_priority,
                     split_emails, create_attachments, transform_html_to_plain)
 from .logutils import setup_loghandlers
@@ -19,14 +27,95 @@ from .logutils import setup_loghandlers
 
 logger = setup_loghandlers("INFO")
 
+_buffers = local()
+
+
+def _on_commit(func):
+    """
+    Runs ``func`` once the transactions open on the default and
+    ``POST_OFFICE['DATABASE']`` databases are committed, or right away
+    outside of transactions. ``func`` doesn't run if any is rolled back.
+    """
+    if hasattr(transaction, 'on_commit'):  # Django >= 1.9
+        for using in sorted(set([DEFAULT_DB_ALIAS, get_database()])):
+            if transaction.get_connection(using).in_atomic_block:
+                transaction.on_commit(lambda: _on_commit(func), using=using)
+                return
+    func()
+
+
+class EnqueueBuffer(object):
+    """
+    Collects emails queued by ``mail.send()`` and inserts them at once.
+    """
+
+    def __init__(self):
+        self.emails = []
+        self.templates = {}
+
+    def add(self, email):
+        # Emails queued inside a transaction are only buffered once it's
+        # committed, so nothing is sent for rolled back transactions
+        _on_commit(lambda: self.emails.append(email))
+
+    def get_email_template(self, name, language=''):
+        key = (name, language)
+        if key not in self.templates:
+            self.templates[key] = get_email_template(name, language)
+        return self.templates[key]
+
+    def flush(self):
+        emails, self.emails = self.emails, []
+        if emails:
+            Email.objects.bulk_create(emails)
+            logger.debug('Flushed %s buffered emails' % len(emails))
+
+    def discard(self):
+        self.emails = []
+
+
+def get_buffer():
+    """Returns the ``EnqueueBuffer`` active in this thread, if any."""
+    return getattr(_buffers, 'buffer', None)
+
+
+class buffered(object):
+    """
+    A context manager buffering emails queued with ``mail.send()``, which are
+    then inserted with one query when leaving the block, or when the current
+    transaction is committed. Emails queued in a transaction that's rolled
+    back, or in a block that raises an exception, are discarded.
+
+    Buffered emails are returned unsaved by ``mail.send()``. Emails with
+    attachments or ``priority='now'`` aren't buffered. Nested blocks share
+    the outermost buffer.
+    """
+
+    def __enter__(self):
+        self.buffer = None
+        if get_buffer() is None:
+            self.buffer = _buffers.buffer = EnqueueBuffer()
+        return get_buffer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.buffer is None:
+            return
+        _buffers.buffer = None
+        if exc_type is not None:
+            self.buffer.discard()
+        else:
+            _on_commit(self.buffer.flush)
+
 
 def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
            html_message='', context=None, scheduled_time=None, headers=None,
            template=None, priority=None, render_on_delivery=False, commit=True,
-           backend=''):
+           backend='', shared_context=None):
     """
     Creates an email from supplied keyword arguments. If template is
     specified, email subject and content will be rendered during delivery.
+    If the email is rendered during delivery, ``context`` is merged into
+    ``shared_context``'s context, otherwise it's rendered right away.
     """
     priority = parse_priority(priority)
     status = None if priority == PRIORITY.now else STATUS.queued
@@ -50,7 +139,8 @@ def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
             bcc=bcc,
             scheduled_time=scheduled_time,
             headers=headers, priority=priority, status=status,
-            context=context, template=template, backend_alias=backend
+            context=context, template=template, backend_alias=backend,
+            shared_context=shared_context
         )
 
     else:
@@ -60,6 +150,11 @@ def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
             message = template.content or (template.default_template and template.default_template.content) or ""
             html_message = template.html_content or (template.default_template and template.default_template.html_content) or ""
 
+        if shared_context is not None:
+            _context = dict(shared_context.context or {})
+            _context.update(context or {})
+            context = _context
+
         _context = Context(context or {})
         subject = Template(subject).render(_context)
         message = Template(message).render(_context)
@@ -67,6 +162,11 @@ def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
         if template and message == html_message:
             message = transform_html_to_plain(html_message)
 
+        body = None
+        if template and get_deduplicate_bodies():
+            body = EmailBody.objects.get_for(message, html_message)
+            message = html_message = ''
+
         email = Email(
             from_email=sender,
             to=recipients,
@@ -78,7 +178,7 @@ def create(sender, recipients=None, cc=None, bcc=None, subject='', message='',
             scheduled_time=scheduled_time,
             headers=headers,
             priority=priority, status=status,
-            backend_alias=backend
+            rendered_template=template, backend_alias=backend, body=body
         )
 
     if commit:
@@ -91,7 +191,7 @@ def send(recipients=None, sender=None, template=None, context=None, subject='',
          message='', html_message='', scheduled_time=None, headers=None,
          priority=None, attachments=None, render_on_delivery=False,
          log_level=None, commit=True, cc=None, bcc=None, language='',
-         backend=''):
+         backend='', shared_context=None):
 
     try:
         recipients = parse_emails(recipients)
@@ -122,6 +222,10 @@ def send(recipients=None, sender=None, template=None, context=None, subject='',
         if attachments:
             raise ValueError("Can't add attachments with send_many()")
 
+    buffer = get_buffer()
+    if buffer is not None and (priority == PRIORITY.now or attachments):
+        buffer = None
+
     if template:
         if subject:
             raise ValueError('You can\'t specify both "template" and "subject" arguments')
@@ -137,15 +241,26 @@ def send(recipients=None, sender=None, template=None, context=None, subject='',
             if language:
                 if template.language != language:
                     template = template.translated_templates.get(language=language)
+        elif buffer is not None:
+            template = buffer.get_email_template(template, language)
         else:
             template = get_email_template(template, language)
 
     if backend and backend not in get_available_backends().keys():
         raise ValueError('%s is not a valid backend alias' % backend)
 
+    if commit and buffer is not None:
+        email = create(sender, recipients, cc, bcc, subject, message, html_message,
+                       context, scheduled_time, headers, template, priority,
+                       render_on_delivery, commit=False, backend=backend,
+                       shared_context=shared_context)
+        buffer.add(email)
+        return email
+
     email = create(sender, recipients, cc, bcc, subject, message, html_message,
                    context, scheduled_time, headers, template, priority,
-                   render_on_delivery, commit=commit, backend=backend)
+                   render_on_delivery, commit=commit, backend=backend,
+                   shared_context=shared_context)
 
     if attachments:
         attachments = create_attachments(attachments)
@@ -169,23 +284,153 @@ def send_many(kwargs_list):
     Email.objects.bulk_create(emails)
 
 
-def get_queued():
+def send_campaign(template, recipients, context=None, chunk_size=1000,
+                  progress=None, language='', **kwargs):
+    """
+    Queues one email per item of ``recipients`` using ``template``.
+
+    ``recipients`` can be any iterable, including generators, of either
+    email addresses or dicts of keyword arguments for ``mail.send()``, their
+    ``context`` overrides the shared ``context``. Other keyword arguments are
+    passed to ``mail.send()`` for every email.
+
+    Recipients are consumed lazily, ``chunk_size`` at a time, and each chunk
+    is inserted with one ``bulk_create``, so memory usage doesn't grow with
+    the number of recipients. If given, ``progress`` is called with the
+    number of emails queued so far after every chunk.
+
+    When rendering on delivery, the shared context is stored once in a
+    ``SharedContext`` and emails only store their own context.
+    Returns the number of queued emails.
+    """
+    if not isinstance(template, EmailTemplate):
+        template = get_email_template(template, language)
+    elif language and template.language != language:
+        template = template.translated_templates.get(language=language)
+
+    if context is None:
+        context = {}
+
+    shared_context = None
+    if kwargs.get('render_on_delivery') and context:
+        shared_context = SharedContext.objects.create(context=context)
+
+    recipients = iter(recipients)
+    total = 0
+    while True:
+        emails = []
+        for overrides in islice(recipients, chunk_size):
+            if not isinstance(overrides, dict):
+                overrides = {'recipients': overrides}
+            email_kwargs = dict(kwargs, **overrides)
+            if shared_context is not None:
+                email_kwargs['shared_context'] = shared_context
+                email_kwargs['context'] = overrides.get('context', {})
+            else:
+                email_kwargs['context'] = dict(context, **overrides.get('context', {}))
+            emails.append(send(template=template, commit=False, **email_kwargs))
+
+        if not emails:
+            break
+        Email.objects.bulk_create(emails)
+        total += len(emails)
+        if progress is not None:
+            progress(total)
+
+    logger.info('Queued %s emails with template %s' % (total, template))
+    return total
+
+
+def get_queue_order():
+    """
+    Translates ``SENDING_ORDER`` into an ordering of ``QueuedEmail``, whose
+    primary key follows the order emails were created in.
+    """
+    order = []
+    for field in get_sending_order():
+        prefix, name = ('-', field[1:]) if field.startswith('-') else ('', field)
+        if name in ('id', 'pk', 'created'):
+            name = 'email_id'
+        elif name not in ('priority', 'scheduled_time'):
+            name = 'email__' + name
+        order.append(prefix + name)
+    return order
+
+
+def _get_ready(queryset):
+    return queryset.filter(Q(scheduled_time__lte=now()) | Q(scheduled_time=None))
+
+
+def has_queued():
+    """
+    Returns whether there are queued emails ready to be sent.
+    """
+    if get_queue_table():
+        return _get_ready(QueuedEmail.objects.all()).exists()
+    return _get_ready(Email.objects.filter(status=STATUS.queued)).exists()
+
+
+def get_queued(defer_bodies=False):
     """
     Returns a list of emails that should be sent:
      - Status is queued
      - Has scheduled_time lower than the current time or None
+
+    With ``defer_bodies``, message and html_message aren't loaded, the
+    sending process loads them with ``_load_bodies()``.
+    """
+    queued = Email.objects.filter(status=STATUS.queued)
+    if get_queue_table():
+        ids = list(_get_ready(QueuedEmail.objects.all()).order_by(*get_queue_order())
+                   .values_list('email_id', flat=True)[:get_batch_size()])
+        # Entries of emails updated without the ORM would be polled forever
+        QueuedEmail.objects.filter(email_id__in=ids).exclude(email__status=STATUS.queued) \
+            .delete()
+        queued = queued.filter(pk__in=ids)
+    else:
+        queued = _get_ready(queued)
+
+    queued = queued.select_related('template', 'rendered_template')
+    if defer_bodies:
+        # Bodies are loaded by the process sending them, see _load_bodies()
+        queued = queued.defer('message', 'html_message')
+    return queued \
+        .order_by(*get_sending_order()) \
+        .prefetch_related('attachments', 'template__attachments',
+                          'template__default_template__attachments',
+                          'rendered_template__attachments',
+                          'rendered_template__default_template__attachments')[:get_batch_size()]
+
+
+def _load_bodies(emails):
+    """
+    Loads the deferred bodies of ``emails`` and their deduplicated bodies
+    with one query each, they're decompressed when messages are built.
     """
-    return Email.objects.filter(status=STATUS.queued) \
-        .select_related('template') \
-        .filter(Q(scheduled_time__lte=now()) | Q(scheduled_time=None)) \
-        .order_by(*get_sending_order()).prefetch_related('attachments')[:get_batch_size()]
+    deferred = [email for email in emails
+                if 'message' in email.get_deferred_fields()]
+    if deferred:
+        bodies = dict((pk, (message, html_message)) for pk, message, html_message in
+                      Email.objects.filter(pk__in=[email.pk for email in deferred])
+                      .values_list('pk', 'message', 'html_message'))
+        for email in deferred:
+            email.message, email.html_message = bodies.get(email.pk, ('', ''))
+
+    body_ids = set(email.body_id for email in emails if email.body_id is not None)
+    if body_ids:
+        bodies = EmailBody.objects.in_bulk(list(body_ids))
+        for email in emails:
+            if email.body_id is not None:
+                email.body = bodies[email.body_id]
 
 
 def send_queued(processes=1, log_level=None):
     """
     Sends out all queued mails that has scheduled_time less than now or None
     """
-    queued_emails = get_queued()
+    metrics = get_metrics()
+    with metrics.timer('stage', stage='fetch'):
+        queued_emails = get_queued(defer_bodies=True)
     total_sent, total_failed = 0, 0
     total_email = len(queued_emails)
 
@@ -209,8 +454,10 @@ def send_queued(processes=1, log_level=None):
             email_lists = split_emails(queued_emails, processes)
 
             pool = Pool(processes)
-            results = pool.map(_send_bulk, email_lists)
+            results = pool.map(_send_bulk_in_process, email_lists)
             pool.terminate()
+            for result in results:
+                metrics.merge(result[2])
 
             total_sent = sum([result[0] for result in results])
             total_failed = sum([result[1] for result in results])
@@ -220,15 +467,30 @@ def send_queued(processes=1, log_level=None):
         total_failed
     )
     logger.info(message)
+    metrics.flush()
     return (total_sent, total_failed)
 
 
+def _send_bulk_in_process(emails):
+    """
+    Runs ``_send_bulk()`` in a pool process, also returning metrics it
+    recorded for the parent process to export.
+    """
+    metrics = get_metrics()
+    # Drop metrics inherited from the parent process when forking
+    metrics.collect()
+    with profiling.profile_process('worker'):
+        sent, failed = _send_bulk(emails)
+    return sent, failed, metrics.collect()
+
+
 def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
     # Multiprocessing does not play well with database connection
     # Fix: Close connections on forking process
     # https://groups.google.com/forum/#!topic/django-users/eCAIY9DAfG0
     if uses_multiprocessing:
-        db_connection.close()
+        # Connections to every database would be shared with forked processes
+        db_connections.close_all()
 
     if log_level is None:
         log_level = get_log_level()
@@ -249,55 +511,53 @@ def _send_bulk(emails, uses_multiprocessing=True, log_level=None):
             logger.debug('Failed to send email #%d' % email.id)
             failed_emails.append((email, e))
 
+    metrics = get_metrics()
     # Prepare emails before we send these to threads for sending
     # So we don't need to access the DB from within threads
-    for email in emails:
-        # Sometimes this can fail, for example when trying to render
-        # email from a faulty Django template
-        try:
-            email.prepare_email_message()
-        except Exception as e:
-            failed_emails.append((email, e))
+    with metrics.timer('stage', stage='load_bodies'):
+        _load_bodies(emails)
+    attachment_cache = AttachmentCache()
+    with metrics.timer('stage', stage='prepare'):
+        for email in emails:
+            # Sometimes this can fail, for example when trying to render
+            # email from a faulty Django template
+            try:
+                email.prepare_email_message(attachment_cache=attachment_cache)
+            except Exception as e:
+                failed_emails.append((email, e))
+
+    stats = attachment_cache.stats()
+    logger.debug('Attachment cache: %(hits)s hits, %(misses)s misses, '
+                 '%(count)s parts (%(size)s bytes)' % stats)
+    if metrics.enabled:
+        # Parts are built while preparing emails, their time is part of it
+        metrics.timing('stage', attachment_cache.build_time, stage='attachments')
+        metrics.incr('attachment_cache', stats['hits'], result='hit')
+        metrics.incr('attachment_cache', stats['misses'], result='miss')
 
     number_of_threads = min(get_threads_per_process(), email_count)
     pool = ThreadPool(number_of_threads)
 
-    pool.map(send, emails)
-    pool.close()
-    pool.join()
+    with metrics.timer('stage', stage='send'):
+        pool.map(profiling.wrap_thread(send), emails)
+        pool.close()
+        pool.join()
 
-    connections.close()
+        connections.close()
 
     # Update statuses of sent and failed emails
-    email_ids = [email.id for email in sent_emails]
-    Email.objects.filter(id__in=email_ids).update(status=STATUS.sent)
-
-    email_ids = [email.id for (email, e) in failed_emails]
-    Email.objects.filter(id__in=email_ids).update(status=STATUS.failed)
-
-    # If log level is 0, log nothing, 1 logs only sending failures
-    # and 2 means log both successes and failures
-    if log_level >= 1:
-
-        logs = []
-        for (email, exception) in failed_emails:
-            logs.append(
-                Log(email=email, status=STATUS.failed,
-                    message=str(exception),
-                    exception_type=type(exception).__name__)
-            )
-
-        if logs:
-            Log.objects.bulk_create(logs)
+    with metrics.timer('stage', stage='update_status'):
+        email_ids = [email.id for email in sent_emails]
+        Email.objects.filter(id__in=email_ids).update(status=STATUS.sent)
 
-    if log_level == 2:
+        email_ids = [email.id for (email, e) in failed_emails]
+        Email.objects.filter(id__in=email_ids).update(status=STATUS.failed)
 
-        logs = []
-        for email in sent_emails:
-            logs.append(Log(email=email, status=STATUS.sent))
+    with metrics.timer('stage', stage='log'):
+        log_deliveries(sent_emails, failed_emails, log_level)
 
-        if logs:
-            Log.objects.bulk_create(logs)
+    metrics.incr('emails', len(sent_emails), status='sent')
+    metrics.incr('emails', len(failed_emails), status='failed')
 
     logger.info(
         'Process finished, %s attempted, %s sent, %s failed' % (
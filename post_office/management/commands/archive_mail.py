@@ -0,0 +1,220 @@
+import datetime
+import gzip
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.utils.timezone import now
+
+from ...compat import string_types
+from ...models import Attachment, Email, EmailBody, Log
+from .cleanup_mail import delete_emails
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def serialize(obj):
+    return dict((field.attname, getattr(obj, field.attname))
+                for field in obj._meta.concrete_fields)
+
+
+class JSONLWriter(object):
+    extension = '.jsonl.gz'
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wb')
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row, cls=DjangoJSONEncoder).encode('utf-8') + b'\n')
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def count(path):
+        with gzip.open(path, 'rb') as f:
+            return sum(1 for line in f)
+
+
+class ParquetWriter(object):
+    """
+    Writes one column per ``Email`` field, integers are stored as such and
+    other values, including logs and attachments, as JSON encoded strings.
+    """
+    extension = '.parquet'
+
+    def __init__(self, path):
+        self.integer_fields = set(field.attname for field in Email._meta.concrete_fields
+                                  if field.get_internal_type().endswith(
+                                      ('AutoField', 'IntegerField', 'ForeignKey')))
+        columns = [field.attname for field in Email._meta.concrete_fields]
+        self.schema = pyarrow.schema(
+            [(name, pyarrow.int64() if name in self.integer_fields else pyarrow.string())
+             for name in columns + ['logs', 'attachments']])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def encode(self, name, value):
+        if value is None or name in self.integer_fields or isinstance(value, string_types):
+            return value
+        return json.dumps(value, cls=DjangoJSONEncoder)
+
+    def write(self, rows):
+        columns = dict((name, [self.encode(name, row[name]) for row in rows])
+                       for name in self.schema.names)
+        self.writer.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+    @staticmethod
+    def count(path):
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+
+
+class Command(BaseCommand):
+    help = ('Archive emails older than a number of days, along with their logs, '
+            'to compressed files, then delete them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Directory archive files are written to')
+        parser.add_argument(
+            '-d', '--days',
+            type=int,
+            default=90,
+            help='Archive mails older than this many days, defaults to 90',
+        )
+        parser.add_argument(
+            '-f', '--format',
+            choices=['jsonl', 'parquet'],
+            default='jsonl',
+            help='Archive format, "parquet" requires pyarrow, defaults to "jsonl"',
+        )
+        parser.add_argument(
+            '-b', '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of mails read and deleted at once, defaults to 1000',
+        )
+        parser.add_argument(
+            '-r', '--rows-per-file',
+            type=int,
+            default=100000,
+            help='Number of mails per archive file, defaults to 100000',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            default=False,
+            help='Keep archived mails instead of deleting them',
+        )
+
+    def handle(self, path, days, batch_size, rows_per_file, keep, **options):
+        if options['format'] == 'parquet' and pyarrow is None:
+            raise CommandError('The parquet format requires pyarrow')
+        self.writer_class = ParquetWriter if options['format'] == 'parquet' else JSONLWriter
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        cutoff_date = now() - datetime.timedelta(days)
+        emails = Email.objects.filter(created__lt=cutoff_date)
+        # Emails queued while archiving aren't archived nor deleted
+        max_id = emails.aggregate(max_id=Max('id'))['max_id']
+        if max_id is None:
+            self.stdout.write('No mails created before %s' % cutoff_date)
+            return
+        emails = emails.filter(id__lte=max_id).order_by('id')
+        expected = emails.count()
+
+        start = time.time()
+        prefix = os.path.join(path, 'emails-%s-' % now().strftime('%Y%m%dT%H%M%S'))
+        files = self.archive(emails.iterator(), prefix, batch_size, rows_per_file)
+        archived = 0
+        for file_path, count in files:
+            written = self.writer_class.count(file_path)
+            if written != count:
+                raise CommandError('%s holds %d mails instead of %d, nothing was deleted'
+                                   % (file_path, written, count))
+            archived += count
+        if archived != expected:
+            raise CommandError('Archived %d mails instead of %d, nothing was deleted'
+                               % (archived, expected))
+        self.stdout.write('Archived %d mails to %d files in %.1fs'
+                          % (archived, len(files), time.time() - start))
+
+        if keep:
+            return
+        last_id = 0
+        while True:
+            ids = list(emails.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            attachment_ids = set(Attachment.emails.through.objects.filter(email__in=ids)
+                                 .values_list('attachment_id', flat=True))
+            delete_emails(ids, attachment_ids)
+        self.stdout.write('Deleted %d archived mails' % archived)
+
+    def archive(self, emails, prefix, batch_size, rows_per_file):
+        """
+        Streams ``emails`` to files of at most ``rows_per_file`` mails,
+        returns a list of ``(path, number of mails)``.
+        """
+        files = []
+        writer = None
+        while True:
+            chunk = list(islice(emails, batch_size))
+            if not chunk:
+                break
+            rows = self.serialize(chunk)
+            while rows:
+                if writer is None:
+                    file_path = '%s%04d%s' % (prefix, len(files) + 1, self.writer_class.extension)
+                    writer = self.writer_class(file_path)
+                    files.append((file_path, 0))
+                file_path, count = files[-1]
+                written = rows[:rows_per_file - count]
+                rows = rows[len(written):]
+                writer.write(written)
+                files[-1] = (file_path, count + len(written))
+                if count + len(written) >= rows_per_file:
+                    writer.close()
+                    writer = None
+        if writer is not None:
+            writer.close()
+        return files
+
+    def serialize(self, emails):
+        """
+        Returns ``emails`` as dicts, with their logs and attachment names.
+        """
+        ids = [email.id for email in emails]
+        logs = dict((email_id, []) for email_id in ids)
+        for log in Log.objects.filter(email__in=ids).order_by('id'):
+            logs[log.email_id].append(serialize(log))
+        attachments = dict((email_id, []) for email_id in ids)
+        for email_id, name in Attachment.emails.through.objects.filter(email__in=ids) \
+                .values_list('email_id', 'attachment__name'):
+            attachments[email_id].append(name)
+
+        bodies = EmailBody.objects.in_bulk(
+            list(set(email.body_id for email in emails if email.body_id is not None)))
+
+        rows = []
+        for email in emails:
+            row = serialize(email)
+            if email.body_id is not None:
+                row['message'] = bodies[email.body_id].message
+                row['html_message'] = bodies[email.body_id].html_message
+            row['logs'] = logs[email.id]
+            row['attachments'] = attachments[email.id]
+            rows.append(row)
+        return rows
@@ -1,13 +1,57 @@
 import datetime
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import ProtectedError
 from django.utils.timezone import now
 
-from ...models import Email
+from ...logutils import setup_loghandlers
+from ...models import Attachment, Email, EmailBody, SharedContext
+from ...partitioning import drop_partitions, is_partitioned
+from ...settings import get_database
+
+logger = setup_loghandlers()
+
+
+def delete_emails(ids, attachment_ids):
+    """
+    Deletes emails with ``ids``, then attachments among ``attachment_ids``
+    no other email references, along with their files, and deduplicated
+    bodies and shared contexts no other email uses. Returns the number of
+    deleted attachments.
+    """
+    with transaction.atomic(using=get_database()):
+        body_ids = set(Email.objects.filter(id__in=ids, body__isnull=False)
+                       .values_list('body_id', flat=True))
+        shared_context_ids = set(Email.objects.filter(id__in=ids, shared_context__isnull=False)
+                                 .values_list('shared_context_id', flat=True))
+        Email.objects.filter(id__in=ids).delete()
+        if body_ids:
+            try:
+                with transaction.atomic():
+                    EmailBody.objects.filter(id__in=body_ids, email__isnull=True).delete()
+            except ProtectedError:
+                # Emails created meanwhile reuse some of the bodies, they're
+                # deleted with a later batch
+                pass
+        if shared_context_ids:
+            SharedContext.objects.filter(id__in=shared_context_ids, email__isnull=True).delete()
+        attachments = list(Attachment.objects.filter(id__in=attachment_ids,
+                                                     emails__isnull=True))
+        Attachment.objects.filter(id__in=[a.id for a in attachments]).delete()
+
+    # Files are only removed once rows are gone for good
+    for attachment in attachments:
+        try:
+            attachment.file.delete(save=False)
+        except Exception as e:
+            logger.warning('Failed to delete %s: %s' % (attachment.file.name, e))
+    return len(attachments)
 
 
 class Command(BaseCommand):
-    help = 'Place deferred messages back in the queue.'
+    help = 'Delete emails older than a number of days, along with their logs and attachments.'
 
     def add_arguments(self, parser):
         parser.add_argument('-d', '--days',
@@ -15,11 +59,64 @@ class Command(BaseCommand):
             default=90,
             help="Cleanup mails older than this many days, defaults to 90."
             )
+        parser.add_argument('-b', '--batch-size',
+            type=int,
+            default=1000,
+            help="Number of mails deleted at once, defaults to 1000."
+            )
+        parser.add_argument('-s', '--sleep',
+            type=float,
+            default=0,
+            help="Seconds to pause between batches, defaults to 0."
+            )
+        parser.add_argument('--dry-run',
+            action='store_true',
+            default=False,
+            help="Report what would be deleted without deleting anything."
+            )
 
-    def handle(self, verbosity, days, **options):
+    def handle(self, verbosity, days, batch_size, sleep, dry_run, **options):
         # Delete mails and their related logs and queued created before X days
-
         cutoff_date = now() - datetime.timedelta(days)
-        count = Email.objects.filter(created__lt=cutoff_date).count()
-        Email.objects.only('id').filter(created__lt=cutoff_date).delete()
-        print("Deleted {0} mails created before {1} ".format(count, cutoff_date))
+        if is_partitioned(Email) and not dry_run:
+            # Drop whole partitions first, only the newest of the old emails
+            # are left to delete
+            dropped = drop_partitions(cutoff_date)
+            if dropped:
+                self.stdout.write("Dropped partitions {0}".format(', '.join(dropped)))
+
+        start = time.time()
+        email_count = attachment_count = 0
+        orphans = set()
+        last_id = 0
+        while True:
+            ids = list(Email.objects.filter(created__lt=cutoff_date, id__gt=last_id)
+                       .order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            attachment_ids = set(Attachment.emails.through.objects.filter(email__in=ids)
+                                 .values_list('attachment_id', flat=True))
+            if dry_run:
+                # Attachments only referenced by old emails would be deleted
+                orphans.update(Attachment.objects.filter(id__in=attachment_ids)
+                               .exclude(emails__created__gte=cutoff_date)
+                               .values_list('id', flat=True))
+                attachment_count = len(orphans)
+            else:
+                attachment_count += delete_emails(ids, attachment_ids)
+            email_count += len(ids)
+
+            if verbosity > 1:
+                self.stdout.write("Deleted {0} mails ({1:.0f} mails/s)".format(
+                    email_count, email_count / (time.time() - start)))
+            if sleep:
+                time.sleep(sleep)
+
+        elapsed = time.time() - start
+        self.stdout.write("{0} {1} mails and {2} attachments created before {3} "
+                          "in {4:.1f}s ({5:.0f} mails/s)".format(
+                              'Would delete' if dry_run else 'Deleted', email_count,
+                              attachment_count, cutoff_date, elapsed,
+                              email_count / elapsed if elapsed else email_count))
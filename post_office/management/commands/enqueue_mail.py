@@ -0,0 +1,224 @@
+import csv
+import json
+import os
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from ...compat import PY2
+from ...mail import send_campaign
+from ...models import EmailTemplate, SharedContext
+from ...utils import get_email_template, parse_emails
+
+
+class LineReader(object):
+    """
+    Iterates over the lines of a binary file, decoded on Python 3, keeping
+    track of the byte offset and of the raw lines read since the last call
+    to ``take()``, so one ``csv.reader`` can read records spanning several
+    lines from it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+        self.lines = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        self.lines.append(line)
+        if PY2:
+            return line
+        return line.decode('utf-8')
+
+    next = __next__
+
+    def take(self):
+        """Returns the raw bytes read since the last call."""
+        lines, self.lines = self.lines, []
+        return b''.join(lines)
+
+
+def decode_csv_row(values):
+    if PY2:
+        return [value.decode('utf-8') for value in values]
+    return values
+
+
+def parse_csv_row(values, fieldnames):
+    values = decode_csv_row(values)
+    if len(values) != len(fieldnames):
+        raise ValueError('Expected %d columns, got %d' % (len(fieldnames), len(values)))
+    return dict(zip(fieldnames, values))
+
+
+def parse_jsonl_line(line):
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError('Expected a JSON object')
+    return row
+
+
+class Command(BaseCommand):
+    help = ('Queue emails using a template for every recipient of a CSV or '
+            'JSONL file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file of recipients')
+        parser.add_argument(
+            '-t', '--template',
+            required=True,
+            help='Name of the EmailTemplate to send',
+        )
+        parser.add_argument(
+            '--language',
+            default='',
+            help='Language of the EmailTemplate',
+        )
+        parser.add_argument(
+            '-f', '--format',
+            choices=['csv', 'jsonl'],
+            help='File format, guessed from the file extension by default',
+        )
+        parser.add_argument(
+            '--email-field',
+            default='email',
+            help='CSV column or JSON key holding recipients, defaults to "email"',
+        )
+        parser.add_argument(
+            '-c', '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of rows validated and inserted at once, defaults to 1000',
+        )
+        parser.add_argument(
+            '-o', '--offset',
+            type=int,
+            default=0,
+            help='Byte offset to resume from, as reported by a previous run',
+        )
+        parser.add_argument(
+            '-r', '--rejects',
+            help='File rejected rows are appended to, defaults to PATH.rejected',
+        )
+        parser.add_argument(
+            '--context',
+            help='JSON object of context variables shared by every email',
+        )
+        parser.add_argument('--sender', help='Sender of the emails')
+        parser.add_argument('--priority', help='Priority of the emails')
+        parser.add_argument(
+            '--render-on-delivery',
+            action='store_true',
+            default=False,
+            help='Render emails when they are sent instead of when queued',
+        )
+
+    def handle(self, path, template, language, chunk_size, offset, **options):
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in ('csv', 'jsonl'):
+            raise CommandError('Unknown file format, use --format to specify it')
+
+        try:
+            self.template = get_email_template(template, language)
+        except EmailTemplate.DoesNotExist:
+            raise CommandError('EmailTemplate "%s" does not exist' % template)
+
+        try:
+            context = json.loads(options['context']) if options['context'] else {}
+        except ValueError as e:
+            raise CommandError('--context is not valid JSON: %s' % e)
+        if not isinstance(context, dict):
+            raise CommandError('--context must be a JSON object')
+        self.send_kwargs = {
+            'sender': options['sender'],
+            'priority': options['priority'],
+            'render_on_delivery': options['render_on_delivery'],
+        }
+        if context and options['render_on_delivery']:
+            self.send_kwargs['shared_context'] = SharedContext.objects.create(context=context)
+            context = {}
+        self.context = context
+        self.email_field = options['email_field']
+
+        rejects_path = options['rejects'] or path + '.rejected'
+        with open(path, 'rb') as f, open(rejects_path, 'ab') as rejects:
+            self.rejects = rejects
+            fieldnames = None
+            if file_format == 'csv':
+                try:
+                    fieldnames = decode_csv_row(next(csv.reader(LineReader(f))))
+                except (StopIteration, ValueError, csv.Error):
+                    raise CommandError('Could not read the CSV header')
+                offset = max(offset, f.tell())
+            f.seek(offset)
+            self.enqueue(LineReader(f), fieldnames, chunk_size)
+
+    def enqueue(self, lines, fieldnames, chunk_size):
+        # Quoted CSV fields may span several lines, so records are read with
+        # a single reader and offsets are those of the lines it consumed
+        records = lines if fieldnames is None else csv.reader(lines)
+        total_queued = total_rejected = 0
+        rows = []
+        while True:
+            record_offset = lines.offset
+            try:
+                record = next(records, None)
+            except (ValueError, csv.Error) as e:
+                self.reject(record_offset, lines.take(), e)
+                total_rejected += 1
+                continue
+            line = lines.take()
+            if record is not None and line.strip():
+                try:
+                    rows.append(self.parse(record, fieldnames))
+                except (ValueError, ValidationError) as e:
+                    self.reject(record_offset, line, e)
+                    total_rejected += 1
+
+            if len(rows) >= chunk_size or (record is None and rows):
+                total_queued += send_campaign(self.template, rows, context=self.context,
+                                              chunk_size=chunk_size, **self.send_kwargs)
+                rows = []
+                self.rejects.flush()
+                self.stdout.write('Queued %d emails, rejected %d rows, next offset: %d'
+                                  % (total_queued, total_rejected, lines.offset))
+            if record is None:
+                break
+
+        self.stdout.write('Done, queued %d emails and rejected %d rows'
+                          % (total_queued, total_rejected))
+
+    def parse(self, record, fieldnames):
+        if fieldnames is None:
+            row = parse_jsonl_line(record)
+            context = row.get('context', {})
+        else:
+            row = parse_csv_row(record, fieldnames)
+            context = row
+
+        recipients = row.get(self.email_field)
+        if not recipients:
+            raise ValueError('Missing "%s"' % self.email_field)
+        if not isinstance(recipients, list):
+            recipients = [email.strip() for email in recipients.split(',')]
+        parse_emails(recipients)
+
+        context = dict((key, value) for key, value in context.items()
+                       if key != self.email_field)
+        return {'recipients': recipients, 'context': context}
+
+    def reject(self, offset, line, error):
+        if isinstance(error, ValidationError):
+            error = '; '.join(error.messages)
+        self.rejects.write(json.dumps({
+            'offset': offset,
+            'line': line.decode('utf-8', 'replace').rstrip('\r\n'),
+            'error': '%s' % error,
+        }).encode('utf-8') + b'\n')
@@ -0,0 +1,65 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from ... import partitioning
+from ...models import Email
+
+
+class Command(BaseCommand):
+    help = ('Manage monthly partitions of the Email and Log tables on PostgreSQL: '
+            '"setup" partitions existing tables, "create" adds partitions for the '
+            'next months and "drop" removes old partitions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['setup', 'create', 'drop'])
+        parser.add_argument(
+            '-m', '--months',
+            type=int,
+            default=3,
+            help='Number of months to create partitions for, defaults to 3',
+        )
+        parser.add_argument(
+            '-d', '--days',
+            type=int,
+            default=90,
+            help='Drop partitions of emails older than this many days, defaults to 90',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Print the SQL run by "setup" without running it',
+        )
+
+    def handle(self, action, months, days, dry_run, **options):
+        if not partitioning.is_supported():
+            raise CommandError('Partitioning requires PostgreSQL 11 or later')
+
+        partitioned = partitioning.is_partitioned(Email)
+        if action == 'setup':
+            if partitioned:
+                raise CommandError('Tables are already partitioned')
+            pending = partitioning.get_pending_migrations()
+            if pending:
+                raise CommandError('Apply pending migrations before partitioning: %s'
+                                   % ', '.join(pending))
+            if dry_run:
+                for model, key in partitioning.PARTITIONED_MODELS:
+                    for statement in partitioning.get_setup_sql(model, key):
+                        self.stdout.write(statement + ';')
+                return
+            partitioning.setup()
+            self.stdout.write('Partitioned tables')
+            return
+
+        if not partitioned:
+            raise CommandError('Tables are not partitioned, run "setup" first')
+        if action == 'create':
+            names = partitioning.create_partitions(months)
+            self.stdout.write('Created %d partitions' % len(names))
+        else:
+            cutoff_date = now() - datetime.timedelta(days)
+            names = partitioning.drop_partitions(cutoff_date)
+            self.stdout.write('Dropped %d partitions: %s' % (len(names), ', '.join(names)))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from ...models import QueuedEmail
+
+
+class Command(BaseCommand):
+    help = ('Recreate the queue table from queued emails, needed after enabling '
+            'QUEUE_TABLE on an existing installation.')
+
+    def handle(self, **options):
+        count = QueuedEmail.objects.rebuild()
+        self.stdout.write('Queued %d emails' % count)
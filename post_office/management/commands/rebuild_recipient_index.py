@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Recipient
+
+
+class Command(BaseCommand):
+    help = ('Recreate the recipient index of all emails, needed after enabling '
+            'RECIPIENT_INDEX on an existing installation.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of emails indexed at once, defaults to 1000',
+        )
+
+    def handle(self, batch_size, **options):
+        count = Recipient.objects.rebuild(batch_size)
+        self.stdout.write('Indexed recipients of %d emails' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Email, StatusCounter
+
+
+class Command(BaseCommand):
+    help = ('Recount emails by status, needed after enabling STATUS_COUNTERS on an '
+            'existing installation.')
+
+    def handle(self, **options):
+        StatusCounter.objects.rebuild()
+        for status, count in sorted(StatusCounter.objects.get_counts().items()):
+            self.stdout.write('%s: %d emails' % (dict(Email.STATUS_CHOICES)[status], count))
@@ -0,0 +1,46 @@
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from ...lockfile import FileLock, FileLocked
+from ...logutils import setup_loghandlers
+from ...models import BulkAction
+from ...settings import JOB_STATUS
+
+logger = setup_loghandlers()
+default_lockfile = tempfile.gettempdir() + "/post_office_bulk_actions"
+
+
+class Command(BaseCommand):
+    help = 'Run admin actions on emails handed to the background, in chunks of ids.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of mails updated at once, defaults to 1000',
+        )
+        parser.add_argument(
+            '-L', '--lockfile',
+            default=default_lockfile,
+            help='Absolute path of lockfile to acquire',
+        )
+
+    def handle(self, batch_size, **options):
+        try:
+            with FileLock(options['lockfile']):
+                # Running jobs were interrupted and resume where they stopped
+                jobs = BulkAction.objects.filter(
+                    status__in=[JOB_STATUS.pending, JOB_STATUS.running]).order_by('id')
+                for job in jobs:
+                    try:
+                        job.run(batch_size)
+                    except Exception as e:
+                        logger.error(e, exc_info=sys.exc_info(),
+                                     extra={'status_code': 500})
+                        continue
+                    self.stdout.write('%s: %d mails' % (job, job.processed))
+        except FileLocked:
+            logger.info('Failed to acquire lock, terminating now.')
@@ -1,14 +1,14 @@
+import os
 import tempfile
 import sys
+from datetime import datetime
 
 from django.core.management.base import BaseCommand
-from django.db import connection
-from django.db.models import Q
-from django.utils.timezone import now
+from django.db import connections
 
+from ... import profiling
 from ...lockfile import FileLock, FileLocked
-from ...mail import send_queued
-from ...models import Email, STATUS
+from ...mail import has_queued, send_queued
 from ...logutils import setup_loghandlers
 
 
@@ -34,27 +34,61 @@ class Command(BaseCommand):
             type=int,
             help='"0" to log nothing, "1" to only log errors',
         )
+        parser.add_argument(
+            '--profile',
+            metavar='PATH',
+            help='Write profiles of every sending process, and their merged '
+                 'summary, to a new subdirectory of this directory',
+        )
+        parser.add_argument(
+            '--profile-mode',
+            choices=[profiling.DETERMINISTIC, profiling.SAMPLING],
+            default=profiling.DETERMINISTIC,
+            help='"deterministic" profiles every call with cProfile, "sampling" '
+                 'records stacks periodically with a low overhead, '
+                 'defaults to "deterministic"',
+        )
+        parser.add_argument(
+            '--profile-interval',
+            type=float,
+            default=0.01,
+            help='Seconds between samples in sampling mode, defaults to 0.01',
+        )
 
     def handle(self, *args, **options):
         logger.info('Acquiring lock for sending queued emails at %s.lock' %
                     options['lockfile'])
         try:
             with FileLock(options['lockfile']):
-
-                while 1:
-                    try:
-                        send_queued(options['processes'],
-                                    options.get('log_level'))
-                    except Exception as e:
-                        logger.error(e, exc_info=sys.exc_info(),
-                                     extra={'status_code': 500})
-                        raise
-
-                    # Close DB connection to avoid multiprocessing errors
-                    connection.close()
-
-                    if not Email.objects.filter(status=STATUS.queued) \
-                            .filter(Q(scheduled_time__lte=now()) | Q(scheduled_time=None)).exists():
-                        break
+                if options.get('profile'):
+                    # Each run gets its own directory, so summaries don't
+                    # merge dumps of previous runs
+                    path = os.path.join(options['profile'],
+                                        datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+                    profiling.enable(path, options['profile_mode'], options['profile_interval'])
+                try:
+                    with profiling.profile_process('main'):
+                        self.send(options)
+                finally:
+                    if options.get('profile'):
+                        profiling.disable()
+                        summary = profiling.write_summary(path)
+                        self.stdout.write('Profile summary written to %s' % summary)
         except FileLocked:
-            logger.info('Failed to acquire lock, terminating now.')
\ No newline at end of file
+            logger.info('Failed to acquire lock, terminating now.')
+
+    def send(self, options):
+        while 1:
+            try:
+                send_queued(options['processes'],
+                            options.get('log_level'))
+            except Exception as e:
+                logger.error(e, exc_info=sys.exc_info(),
+                             extra={'status_code': 500})
+                raise
+
+            # Close DB connections to avoid multiprocessing errors
+            connections.close_all()
+
+            if not has_queued():
+                break
\ No newline at end of file
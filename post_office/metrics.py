@@ -0,0 +1,237 @@
+"""
+Timings and counts of the sending pipeline stages, exported through the
+backend set by ``POST_OFFICE['METRICS_BACKEND']``. Without one, the null
+backend discards everything at the cost of a method call per stage.
+"""
+import os
+import socket
+import time
+from collections import defaultdict
+from threading import Lock, Thread
+
+from .compat import import_attribute, PY3
+from .settings import get_metrics_backend, get_metrics_options
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class Timer(object):
+
+    def __init__(self, metrics, name, tags):
+        self.metrics = metrics
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, time.time() - self.start, **self.tags)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class BaseMetrics(object):
+    """
+    Metrics backends implement ``incr()`` and ``timing()``, tags are
+    passed as keyword arguments. ``collect()`` and ``merge()`` hand metrics
+    recorded by sending processes over to the parent process.
+    """
+    enabled = True
+
+    def __init__(self, prefix='post_office'):
+        self.prefix = prefix
+
+    def incr(self, name, value=1, **tags):
+        raise NotImplementedError
+
+    def timing(self, name, seconds, **tags):
+        raise NotImplementedError
+
+    def timer(self, name, **tags):
+        """Returns a context manager recording the time spent in its block."""
+        return Timer(self, name, tags)
+
+    def collect(self):
+        return None
+
+    def merge(self, collected):
+        pass
+
+    def flush(self):
+        pass
+
+
+class NullMetrics(BaseMetrics):
+    enabled = False
+
+    def incr(self, name, value=1, **tags):
+        pass
+
+    def timing(self, name, seconds, **tags):
+        pass
+
+    def timer(self, name, **tags):
+        return null_timer
+
+
+class StatsdMetrics(BaseMetrics):
+    """
+    Sends counters and timings over UDP in the StatsD line format, tags are
+    appended to metric names.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='post_office'):
+        super(StatsdMetrics, self).__init__(prefix)
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def get_name(self, name, tags):
+        parts = [self.prefix, name] + ['%s' % tags[key] for key in sorted(tags)]
+        return '.'.join(part for part in parts if part)
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            # Metrics must never break sending
+            pass
+
+    def incr(self, name, value=1, **tags):
+        self.send('%s:%d|c' % (self.get_name(name, tags), value))
+
+    def timing(self, name, seconds, **tags):
+        self.send('%s:%d|ms' % (self.get_name(name, tags), seconds * 1000))
+
+
+class PrometheusMetrics(BaseMetrics):
+    """
+    Keeps counters and timings in memory and exposes them in the Prometheus
+    text format, written to ``path`` on ``flush()``, e.g. for the node
+    exporter textfile collector, and/or served over HTTP on ``port``.
+    Timings are exported as ``<name>_seconds`` summaries.
+    """
+
+    def __init__(self, path=None, port=None, addr='', prefix='post_office'):
+        super(PrometheusMetrics, self).__init__(prefix)
+        self.path = path
+        self.lock = Lock()
+        self.counters = defaultdict(float)
+        self.timings = defaultdict(lambda: [0.0, 0])
+        if port is not None:
+            self.serve(addr, port)
+
+    def incr(self, name, value=1, **tags):
+        with self.lock:
+            self.counters[(name, tuple(sorted(tags.items())))] += value
+
+    def timing(self, name, seconds, **tags):
+        with self.lock:
+            timing = self.timings[(name, tuple(sorted(tags.items())))]
+            timing[0] += seconds
+            timing[1] += 1
+
+    def collect(self):
+        with self.lock:
+            collected = (dict(self.counters), dict((key, list(value)) for key, value
+                                                   in self.timings.items()))
+            self.counters.clear()
+            self.timings.clear()
+        return collected
+
+    def merge(self, collected):
+        counters, timings = collected
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+            for key, (total, count) in timings.items():
+                self.timings[key][0] += total
+                self.timings[key][1] += count
+
+    def render(self):
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                                     for key, value in labels)
+
+        # Samples of a metric follow a single TYPE line, whatever their labels
+        lines = []
+        with self.lock:
+            family = None
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = '%s_%s_total' % (self.prefix, name)
+                if metric != family:
+                    lines.append('# TYPE %s counter' % metric)
+                    family = metric
+                lines.append('%s%s %s' % (metric, format_labels(labels), repr(float(value))))
+            for (name, labels), (total, count) in sorted(self.timings.items()):
+                metric = '%s_%s_seconds' % (self.prefix, name)
+                if metric != family:
+                    lines.append('# TYPE %s summary' % metric)
+                    family = metric
+                lines.append('%s_sum%s %s' % (metric, format_labels(labels), repr(total)))
+                lines.append('%s_count%s %d' % (metric, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        if not self.path:
+            return
+        # Replace the file at once so scrapers never read it half written
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_path, self.path)
+
+    def serve(self, addr, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((addr, port), Handler)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+_metrics = None
+_config = None
+
+
+def get_metrics():
+    """
+    Returns the metrics backend, created once per process unless settings
+    change.
+    """
+    global _metrics, _config
+    config = (get_metrics_backend(), get_metrics_options())
+    if _metrics is None or config != _config:
+        backend, options = config
+        backend_class = import_attribute(backend) if backend else NullMetrics
+        _metrics = backend_class(**options)
+        _config = config
+    return _metrics
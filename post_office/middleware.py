@@ -0,0 +1,31 @@
+try:
+    from django.utils.deprecation import MiddlewareMixin  # Django >= 1.10
+except ImportError:
+    MiddlewareMixin = object
+
+from .mail import buffered
+
+
+class EnqueueBufferMiddleware(MiddlewareMixin):
+    """
+    Buffers emails queued with ``mail.send()`` during a request and inserts
+    them with one query once the response is ready. Emails are discarded if
+    the view raises an exception.
+    """
+
+    def process_request(self, request):
+        request._post_office_buffer = buffered()
+        request._post_office_buffer.__enter__()
+
+    def process_exception(self, request, exception):
+        buffer = getattr(request, '_post_office_buffer', None)
+        if buffer is not None:
+            del request._post_office_buffer
+            buffer.__exit__(type(exception), exception, None)
+
+    def process_response(self, request, response):
+        buffer = getattr(request, '_post_office_buffer', None)
+        if buffer is not None:
+            del request._post_office_buffer
+            buffer.__exit__(None, None, None)
+        return response
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 04:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0011_auto_20180718_1816'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='rendered_template',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='post_office.EmailTemplate'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0012_email_rendered_template'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedContext',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('context', jsonfield.fields.JSONField(blank=True, null=True, verbose_name='Context')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Shared context',
+                'verbose_name_plural': 'Shared contexts',
+            },
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='shared_context',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='post_office.SharedContext', verbose_name='Shared context'),
+        ),
+    ]
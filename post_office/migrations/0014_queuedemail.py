@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0013_sharedcontext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedEmail',
+            fields=[
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='queue_entry', serialize=False, to='post_office.Email')),
+                ('priority', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('scheduled_time', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Queued email',
+                'verbose_name_plural': 'Queued emails',
+            },
+        ),
+    ]
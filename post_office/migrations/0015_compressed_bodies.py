@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:14
+from __future__ import unicode_literals
+
+from django.db import migrations
+import post_office.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0014_queuedemail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='html_message',
+            field=post_office.fields.CompressedTextField(blank=True, verbose_name='HTML Message'),
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='message',
+            field=post_office.fields.CompressedTextField(blank=True, verbose_name='Message'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import post_office.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0015_compressed_bodies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailBody',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('message', post_office.fields.CompressedTextField(blank=True, verbose_name='Message')),
+                ('html_message', post_office.fields.CompressedTextField(blank=True, verbose_name='HTML Message')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Email body',
+                'verbose_name_plural': 'Email bodies',
+            },
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='body',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='post_office.EmailBody', verbose_name='Body'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import post_office.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0016_emailbody'),
+    ]
+
+    operations = [
+        post_office.operations.SkipEmailForeignKeys(migrations.CreateModel(
+            name='Recipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('to', 'To'), ('cc', 'Cc'), ('bcc', 'Bcc')], max_length=3)),
+                ('address', models.CharField(db_index=True, max_length=254)),
+                ('domain', models.CharField(db_index=True, max_length=254)),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='post_office.Email')),
+            ],
+            options={
+                'verbose_name': 'Recipient',
+                'verbose_name_plural': 'Recipients',
+            },
+        )),
+    ]
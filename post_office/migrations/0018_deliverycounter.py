@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0017_recipient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(db_index=True, verbose_name='Start')),
+                ('backend_alias', models.CharField(blank=True, default='', max_length=64, verbose_name='Backend alias')),
+                ('sent', models.PositiveIntegerField(default=0, verbose_name='Sent')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='Failed')),
+                ('template', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='post_office.EmailTemplate', verbose_name='Email template')),
+            ],
+            options={
+                'verbose_name': 'Delivery counter',
+                'verbose_name_plural': 'Delivery counters',
+            },
+        ),
+    ]
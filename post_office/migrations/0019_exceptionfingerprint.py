@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0018_deliverycounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExceptionFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('exception_type', models.CharField(blank=True, max_length=255, verbose_name='Exception type')),
+                ('message', models.TextField(blank=True, verbose_name='Message')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('last_seen', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Last seen')),
+            ],
+            options={
+                'verbose_name': 'Exception fingerprint',
+                'verbose_name_plural': 'Exception fingerprints',
+            },
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='fingerprint',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='logs', to='post_office.ExceptionFingerprint', verbose_name='Exception fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='variables',
+            field=jsonfield.fields.JSONField(blank=True, editable=False, null=True, verbose_name='Variables'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0019_exceptionfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkAction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('requeue', 'requeue'), ('set_as_sent', 'set as sent')], max_length=32, verbose_name='Action')),
+                ('filters', jsonfield.fields.JSONField(default=dict, editable=False)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'pending'), (1, 'running'), (2, 'done'), (3, 'failed')], db_index=True, default=0, verbose_name='Status')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='Total')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Processed')),
+                ('last_id', models.BigIntegerField(default=0, editable=False)),
+                ('message', models.TextField(blank=True, verbose_name='Message')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Bulk action',
+                'verbose_name_plural': 'Bulk actions',
+            },
+        ),
+    ]
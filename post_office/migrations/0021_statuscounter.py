@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-19 03:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0020_bulkaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'sent'), (1, 'failed'), (2, 'queued')], verbose_name='Status')),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.BigIntegerField(default=0, verbose_name='Count')),
+            ],
+            options={
+                'verbose_name': 'Status counter',
+                'verbose_name_plural': 'Status counters',
+            },
+        ),
+    ]
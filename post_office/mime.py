@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.message import SafeMIMEMultipart, SafeMIMEText
+
+
+class SharedBodyEmailMessage(EmailMultiAlternatives):
+    """
+    An ``EmailMultiAlternatives`` whose body and alternatives MIME parts are
+    fetched from ``part_cache`` (an ``AttachmentCache``) by ``body_key``, so
+    emails with identical bodies only encode them once.
+
+    Parts are only shared inside the ``multipart/alternative`` container,
+    since headers of each email are set on the outermost part.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.body_key = kwargs.pop('body_key')
+        self.part_cache = kwargs.pop('part_cache')
+        super(SharedBodyEmailMessage, self).__init__(*args, **kwargs)
+
+    def get_part(self, name, factory):
+        def create():
+            part = factory()
+            return part, len(part.get_payload())
+        return self.part_cache.get_or_create(('body', self.body_key, name), create)
+
+    def message(self):
+        if not self.alternatives:
+            return super(SharedBodyEmailMessage, self).message()
+        # The text part built by EmailMessage.message() is replaced by the
+        # shared one, so don't encode it
+        self._body, self.body = self.body, ''
+        try:
+            return super(SharedBodyEmailMessage, self).message()
+        finally:
+            self.body = self._body
+
+    def _create_alternatives(self, msg):
+        if not self.alternatives:
+            return super(SharedBodyEmailMessage, self)._create_alternatives(msg)
+
+        encoding = self.encoding or settings.DEFAULT_CHARSET
+        msg = SafeMIMEMultipart(_subtype=self.alternative_subtype, encoding=encoding)
+        if self._body:
+            msg.attach(self.get_part(self.content_subtype, lambda: SafeMIMEText(
+                self._body, self.content_subtype, encoding)))
+        for content, mimetype in self.alternatives:
+            msg.attach(self.get_part(mimetype, lambda content=content, mimetype=mimetype:
+                                     self._create_mime_attachment(content, mimetype)))
+        return msg
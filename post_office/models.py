@@ -1,31 +1,285 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import hashlib
 import logging
-
-
+import re
+
+import random
+from collections import defaultdict, OrderedDict
+from datetime import timedelta
+from email.utils import parseaddr
+from itertools import islice
+from threading import Lock
 from uuid import uuid4
 
 from django.conf import settings
 from django.core.mail import EmailMessage, EmailMultiAlternatives
-from django.db import models
+from django.db import connections as db_connections, models, router, transaction
+from django.db.models import F
 from django.template import Context, Template
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
 from django.utils.translation import pgettext_lazy
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
 
 from post_office import cache
-from post_office.fields import CommaSeparatedEmailField
+from post_office.attachments import (attach, attach_template_attachment,
+                                     get_template_attachments)
+from post_office.fields import CommaSeparatedEmailField, CompressedTextField
+from post_office.metrics import get_metrics
+from post_office.mime import SharedBodyEmailMessage
 from post_office.utils import transform_html_to_plain, make_raw_template
 
 from .compat import text_type, smart_text
 from .connections import connections
-from .settings import context_field_class, get_log_level, get_base_email_templates, PRIORITY, STATUS
+from .settings import (context_field_class, get_log_level, get_base_email_templates,
+                       get_body_cache_size, get_bulk_action_requeue_interval,
+                       get_delivery_counter_interval, get_delivery_counters,
+                       get_fingerprint_cache_size, get_fingerprint_exceptions,
+                       get_log_deduplicate_failures, get_log_success_sample_rate,
+                       get_queue_table, get_recipient_index,
+                       get_shared_context_cache_size, get_status_counters,
+                       JOB_STATUS, PRIORITY, STATUS)
 from .validators import validate_email_with_name, validate_template_syntax
 
 logger = logging.getLogger(__name__)
 
 
+class CachingManager(models.Manager):
+    """
+    A manager with a per process LRU cache of immutable rows.
+    """
+
+    def __init__(self):
+        super(CachingManager, self).__init__()
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def get_cached(self, key):
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+            except KeyError:
+                return None
+            self._cache[key] = value
+            return value
+
+    def set_cached(self, key, value, max_size):
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > max_size:
+                self._cache.popitem(last=False)
+
+    def delete_cached(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class SharedContextManager(CachingManager):
+
+    def get_context(self, pk):
+        """
+        Returns the context stored in the ``SharedContext`` with ``pk``. Since
+        shared contexts are never modified, they're cached per process.
+        """
+        context = self.get_cached(pk)
+        if context is None:
+            context = self.get(pk=pk).context
+            self.set_cached(pk, context, get_shared_context_cache_size())
+        return context
+
+
+class EmailBodyManager(CachingManager):
+
+    def get_for(self, message, html_message):
+        """
+        Returns the ``EmailBody`` holding ``message`` and ``html_message``,
+        creating it if needed. Cached bodies are checked to still exist, since
+        ``cleanup_mail`` deletes bodies no email uses anymore.
+        """
+        digest = EmailBody.get_hash(message, html_message)
+        body = self.get_cached(digest)
+        if body is not None and not self.filter(pk=body.pk).exists():
+            self.delete_cached(digest)
+            body = None
+        if body is None:
+            body, created = self.get_or_create(
+                hash=digest, defaults={'message': message, 'html_message': html_message})
+            self.set_cached(digest, body, get_body_cache_size())
+        return body
+
+
+@python_2_unicode_compatible
+class EmailBody(models.Model):
+    """
+    Rendered bodies shared by identical emails when ``DEDUPLICATE_BODIES`` is
+    enabled, identified by a hash of their content.
+    """
+    hash = models.CharField(max_length=64, unique=True)
+    message = CompressedTextField(_("Message"), blank=True)
+    html_message = CompressedTextField(_("HTML Message"), blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = EmailBodyManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Email body")
+        verbose_name_plural = _("Email bodies")
+
+    def __str__(self):
+        return self.hash
+
+    @staticmethod
+    def get_hash(message, html_message):
+        content = '%s\x00%s' % (message, html_message)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+@python_2_unicode_compatible
+class SharedContext(models.Model):
+    """
+    A context shared by many emails rendered on delivery, e.g. a campaign's
+    product lists and footer. Emails only store their own context, which is
+    merged into the shared context when rendering.
+    """
+    context = context_field_class(_('Context'), blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = SharedContextManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Shared context")
+        verbose_name_plural = _("Shared contexts")
+
+    def __str__(self):
+        return text_type(self.created)
+
+
+def can_return_bulk_ids(using):
+    features = db_connections[using].features
+    return getattr(features, 'can_return_rows_from_bulk_insert',
+                   getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+class EmailQuerySet(models.QuerySet):
+    """
+    Keeps the ``QueuedEmail`` table in sync when ``QUEUE_TABLE`` is enabled,
+    the ``Recipient`` table when ``RECIPIENT_INDEX`` is, and status counters
+    when ``STATUS_COUNTERS`` is.
+    """
+    # Number of emails whose queue entries are updated at once
+    update_chunk_size = 1000
+
+    def get_status_counts(self):
+        return dict(self.order_by().values_list('status').annotate(count=models.Count('pk')))
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if get_status_counters():
+            objs = list(objs)
+            changes = defaultdict(int)
+            for obj in objs:
+                changes[obj.status] += 1
+        if not get_queue_table() and not get_recipient_index():
+            with transaction.atomic(using=self.db):
+                objs = super(EmailQuerySet, self).bulk_create(objs, *args, **kwargs)
+                if get_status_counters():
+                    StatusCounter.objects.db_manager(self.db).add(changes)
+            return objs
+
+        objs = list(objs)
+        with transaction.atomic(using=self.db):
+            if can_return_bulk_ids(self.db):
+                super(EmailQuerySet, self).bulk_create(objs, *args, **kwargs)
+            else:
+                # Queue entries and recipients need primary keys, which bulk
+                # inserts don't return on this database
+                for obj in objs:
+                    models.Model.save(obj, force_insert=True, using=self.db)
+            if get_queue_table():
+                QueuedEmail.objects.using(self.db).bulk_create(
+                    [QueuedEmail.from_email(obj) for obj in objs
+                     if obj.status == STATUS.queued])
+            if get_recipient_index():
+                Recipient.objects.using(self.db).bulk_create(
+                    [recipient for obj in objs for recipient in Recipient.for_email(obj)])
+            if get_status_counters():
+                StatusCounter.objects.db_manager(self.db).add(changes)
+        return objs
+
+    def with_recipient(self, address, roles=None):
+        """
+        Returns emails sent to ``address``, or to any address of a domain if
+        ``address`` starts with ``@``. ``roles`` restricts matches to some of
+        ``'to'``, ``'cc'`` and ``'bcc'``.
+        """
+        address = address.strip().lower()
+        roles = roles or [role for role, label in Recipient.ROLE_CHOICES]
+        if not get_recipient_index():
+            query = models.Q()
+            for role in roles:
+                query |= models.Q(**{'%s__icontains' % role: address})
+            return self.filter(query)
+
+        if address.startswith('@'):
+            recipients = Recipient.objects.filter(domain=address[1:])
+        else:
+            recipients = Recipient.objects.filter(address=address)
+        if len(roles) < len(Recipient.ROLE_CHOICES):
+            recipients = recipients.filter(role__in=roles)
+        return self.filter(pk__in=recipients.values('email_id'))
+
+    def update(self, **kwargs):
+        if 'status' not in kwargs or not (get_queue_table() or get_status_counters()):
+            return super(EmailQuerySet, self).update(**kwargs)
+
+        # Emails are updated in chunks of increasing primary keys, so their
+        # ids never have to be loaded all at once
+        rows = 0
+        last_pk = None
+        with transaction.atomic(using=self.db):
+            while True:
+                queryset = self.order_by('pk')
+                if last_pk is not None:
+                    queryset = queryset.filter(pk__gt=last_pk)
+                ids = list(queryset.values_list('pk', flat=True)[:self.update_chunk_size])
+                if not ids:
+                    break
+                last_pk = ids[-1]
+
+                emails = Email.objects.using(self.db).filter(pk__in=ids)
+                if get_status_counters():
+                    # Statuses are read from locked rows, so concurrent
+                    # updates can't change them before this one
+                    changes = defaultdict(int)
+                    for status in emails.select_for_update().values_list('status', flat=True):
+                        changes[status] -= 1
+                        changes[kwargs['status']] += 1
+                    StatusCounter.objects.db_manager(self.db).add(changes)
+                rows += super(EmailQuerySet, emails).update(**kwargs)
+                if get_queue_table():
+                    QueuedEmail.objects.using(self.db).filter(email__in=ids).delete()
+                    if kwargs['status'] == STATUS.queued:
+                        QueuedEmail.objects.using(self.db).bulk_create(
+                            [QueuedEmail.from_email(email)
+                             for email in emails.only('pk', 'priority', 'scheduled_time')])
+        return rows
+
+    def delete(self):
+        if not get_status_counters():
+            return super(EmailQuerySet, self).delete()
+
+        with transaction.atomic(using=self.db):
+            changes = dict((status, -count) for status, count in self.get_status_counts().items())
+            result = super(EmailQuerySet, self).delete()
+            StatusCounter.objects.db_manager(self.db).add(changes)
+        return result
 
 
 @python_2_unicode_compatible
@@ -45,8 +299,8 @@ class Email(models.Model):
     cc = CommaSeparatedEmailField(_("Cc"))
     bcc = CommaSeparatedEmailField(("Bcc"))
     subject = models.CharField(_("Subject"), max_length=989, blank=True)
-    message = models.TextField(_("Message"), blank=True)
-    html_message = models.TextField(_("HTML Message"), blank=True)
+    message = CompressedTextField(_("Message"), blank=True)
+    html_message = CompressedTextField(_("HTML Message"), blank=True)
     """
     Emails with 'queued' status will get processed by ``send_queued`` command.
     Status field will then be set to ``failed`` or ``sent`` depending on
@@ -67,9 +321,21 @@ class Email(models.Model):
     template = models.ForeignKey('post_office.EmailTemplate', blank=True, 
                                  null=True, verbose_name=_('Email template'),
                                  on_delete=models.CASCADE)
+    # Template an email was rendered with when queued, only used to attach
+    # the template's attachments on delivery
+    rendered_template = models.ForeignKey(
+        'post_office.EmailTemplate', blank=True, null=True, editable=False,
+        related_name='+', on_delete=models.SET_NULL)
     context = context_field_class(_('Context'), blank=True, null=True)
+    shared_context = models.ForeignKey(SharedContext, blank=True, null=True,
+                                       verbose_name=_('Shared context'),
+                                       on_delete=models.PROTECT)
     backend_alias = models.CharField(_('Backend alias'), blank=True, default='',
                                      max_length=64)
+    body = models.ForeignKey(EmailBody, blank=True, null=True, editable=False,
+                             verbose_name=_('Body'), on_delete=models.PROTECT)
+
+    objects = EmailQuerySet.as_manager()
 
     class Meta:
         app_label = 'post_office'
@@ -83,6 +349,26 @@ class Email(models.Model):
     def __str__(self):
         return u'%s' % self.to
 
+    def get_context(self):
+        """
+        Returns the context used to render the email, this email's context
+        merged into its shared context, if any.
+        """
+        if self.shared_context_id is None:
+            return self.context
+        context = dict(SharedContext.objects.get_context(self.shared_context_id) or {})
+        context.update(self.context or {})
+        return context
+
+    def get_bodies(self):
+        """
+        Returns this email's ``(message, html_message)``, which are stored in
+        ``body`` if it was deduplicated.
+        """
+        if self.body_id is not None:
+            return self.body.message, self.body.html_message
+        return self.message, self.html_message
+
     def email_message(self):
         """
         Returns Django EmailMessage object for sending.
@@ -92,27 +378,38 @@ class Email(models.Model):
 
         return self.prepare_email_message()
 
-    def prepare_email_message(self):
+    def prepare_email_message(self, attachment_cache=None):
         """
         Returns a django ``EmailMessage`` or ``EmailMultiAlternatives`` object,
         depending on whether html_message is empty.
+
+        Attachments of the email template are included too. If
+        ``attachment_cache`` is given, encoded attachments are shared with
+        other emails prepared with the same cache.
         """
         subject = smart_text(self.subject)
 
         if self.template is not None:# and self.context is not None:
-            _context = Context(self.context)
+            _context = Context(self.get_context())
             subject = Template(self.template.subject).render(_context)
             message = Template(self.template.content).render(_context)
             html_message = Template(self.template.html_content).render(_context)
 
         else:
             subject = self.subject
-            message = self.message
-            html_message = self.html_message
+            message, html_message = self.get_bodies()
 
         connection = connections[self.backend_alias or 'default']
 
-        if html_message:
+        if html_message and self.body_id is not None and attachment_cache is not None:
+            # MIME parts of the body are shared by emails of the batch
+            msg = SharedBodyEmailMessage(
+                subject=subject, body=message, from_email=self.from_email,
+                to=self.to, bcc=self.bcc, cc=self.cc,
+                headers=self.headers, connection=connection,
+                body_key=self.body.hash, part_cache=attachment_cache)
+            msg.attach_alternative(html_message, "text/html")
+        elif html_message:
             msg = EmailMultiAlternatives(
                 subject=subject, body=message, from_email=self.from_email,
                 to=self.to, bcc=self.bcc, cc=self.cc,
@@ -125,8 +422,12 @@ class Email(models.Model):
                 headers=self.headers, connection=connection)
 
         for attachment in self.attachments.all():
-            msg.attach(attachment.name, attachment.file.read(), mimetype=attachment.mimetype or None)
-            attachment.file.close()
+            attach(msg, attachment, cache=attachment_cache)
+
+        template = self.template if self.template_id else self.rendered_template
+        if template is not None:
+            for attachment in get_template_attachments(template):
+                attach_template_attachment(msg, attachment, cache=attachment_cache)
 
         self._cached_email_message = msg
         return msg
@@ -139,12 +440,10 @@ class Email(models.Model):
         try:
             self.email_message().send()
             status = STATUS.sent
-            message = ''
-            exception_type = ''
+            failed_emails = []
         except Exception as e:
             status = STATUS.failed
-            message = str(e)
-            exception_type = type(e).__name__
+            failed_emails = [(self, e)]
 
             # If run in a bulk sending mode, reraise and let the outer
             # layer handle the exception
@@ -157,22 +456,250 @@ class Email(models.Model):
 
             if log_level is None:
                 log_level = get_log_level()
-
-            # If log level is 0, log nothing, 1 logs only sending failures
-            # and 2 means log both successes and failures
-            if log_level == 1:
-                if status == STATUS.failed:
-                    self.logs.create(status=status, message=message,
-                                     exception_type=exception_type)
-            elif log_level == 2:
-                self.logs.create(status=status, message=message,
-                                 exception_type=exception_type)
+            sent_emails = [self] if status == STATUS.sent else []
+            log_deliveries(sent_emails, failed_emails, log_level)
+            get_metrics().incr('emails', status='sent' if status == STATUS.sent else 'failed')
 
         return status
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Email, cls).from_db(db, field_names, values)
+        # Status counters need to know which status a saved email leaves
+        if 'status' in field_names:
+            instance._loaded_status = instance.status
+        return instance
+
+    def get_status_changes(self, update_fields=None):
+        """
+        Returns the changes to status counters saving the email makes, empty
+        if its previous status isn't known.
+        """
+        changes = defaultdict(int)
+        if update_fields is not None and 'status' not in update_fields:
+            return changes
+        if not self._state.adding:
+            if not hasattr(self, '_loaded_status'):
+                return changes
+            changes[self._loaded_status] -= 1
+        changes[self.status] += 1
+        return changes
+
     def save(self, *args, **kwargs):
         self.full_clean()
-        return super(Email, self).save(*args, **kwargs)
+        if not get_queue_table() and not get_recipient_index() and not get_status_counters():
+            return super(Email, self).save(*args, **kwargs)
+
+        using = kwargs.get('using') or router.db_for_write(Email, instance=self)
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic(using=using):
+            if get_status_counters():
+                StatusCounter.objects.db_manager(using).add(self.get_status_changes(update_fields))
+                self._loaded_status = self.status
+            super(Email, self).save(*args, **kwargs)
+            if get_queue_table():
+                if self.status == STATUS.queued:
+                    QueuedEmail.from_email(self).save(using=using)
+                else:
+                    QueuedEmail.objects.using(using).filter(email=self).delete()
+            if get_recipient_index() and (
+                    update_fields is None or set(update_fields) & set(['to', 'cc', 'bcc'])):
+                Recipient.objects.using(using).filter(email=self).delete()
+                Recipient.objects.using(using).bulk_create(Recipient.for_email(self))
+
+    def delete(self, *args, **kwargs):
+        if not get_status_counters() or not hasattr(self, '_loaded_status'):
+            return super(Email, self).delete(*args, **kwargs)
+
+        using = kwargs.get('using') or router.db_for_write(Email, instance=self)
+        with transaction.atomic(using=using):
+            result = super(Email, self).delete(*args, **kwargs)
+            StatusCounter.objects.db_manager(using).add({self._loaded_status: -1})
+        return result
+
+
+class QueuedEmailManager(models.Manager):
+
+    def rebuild(self):
+        """
+        Recreates queue entries for every queued email, e.g. after enabling
+        ``QUEUE_TABLE`` on an existing installation.
+        """
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            emails = Email.objects.using(self.db).filter(status=STATUS.queued) \
+                .only('pk', 'priority', 'scheduled_time')
+            entries = (QueuedEmail.from_email(email) for email in emails.iterator())
+            count = 0
+            while True:
+                chunk = list(islice(entries, 1000))
+                if not chunk:
+                    break
+                self.bulk_create(chunk)
+                count += len(chunk)
+        return count
+
+
+class RecipientManager(models.Manager):
+
+    def rebuild(self, batch_size=1000):
+        """
+        Recreates recipients of every email, e.g. after enabling
+        ``RECIPIENT_INDEX`` on an existing installation.
+        """
+        self.all().delete()
+        emails = Email.objects.using(self.db).only('pk', 'to', 'cc', 'bcc').order_by('pk')
+        count = last_id = 0
+        while True:
+            chunk = list(emails.filter(pk__gt=last_id)[:batch_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].pk
+            with transaction.atomic(using=self.db):
+                self.bulk_create([recipient for email in chunk
+                                  for recipient in Recipient.for_email(email)])
+            count += len(chunk)
+        return count
+
+
+@python_2_unicode_compatible
+class Recipient(models.Model):
+    """
+    A normalized recipient of an email, used to search emails by address or
+    domain when ``RECIPIENT_INDEX`` is enabled.
+    """
+    ROLE_CHOICES = [('to', _("To")), ('cc', _("Cc")), ('bcc', _("Bcc"))]
+
+    email = models.ForeignKey(Email, related_name='recipients', on_delete=models.CASCADE)
+    role = models.CharField(max_length=3, choices=ROLE_CHOICES)
+    address = models.CharField(max_length=254, db_index=True)
+    domain = models.CharField(max_length=254, db_index=True)
+
+    objects = RecipientManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Recipient")
+        verbose_name_plural = _("Recipients")
+
+    def __str__(self):
+        return self.address
+
+    @classmethod
+    def for_email(cls, email):
+        recipients = []
+        for role, label in cls.ROLE_CHOICES:
+            for value in getattr(email, role) or []:
+                address = parseaddr(value)[1].lower()
+                if address:
+                    recipients.append(cls(email_id=email.pk, role=role, address=address,
+                                          domain=address.rpartition('@')[2]))
+        return recipients
+
+
+@python_2_unicode_compatible
+class QueuedEmail(models.Model):
+    """
+    An entry for each queued email, used to poll the queue when
+    ``QUEUE_TABLE`` is enabled. This table only grows with the number of
+    queued emails, while sent and failed emails stay in ``Email``.
+    """
+    email = models.OneToOneField(Email, primary_key=True, related_name='queue_entry',
+                                 on_delete=models.CASCADE)
+    priority = models.PositiveSmallIntegerField(blank=True, null=True)
+    scheduled_time = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    objects = QueuedEmailManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Queued email")
+        verbose_name_plural = _("Queued emails")
+
+    def __str__(self):
+        return text_type(self.email_id)
+
+    @classmethod
+    def from_email(cls, email):
+        return cls(email_id=email.pk, priority=email.priority,
+                   scheduled_time=email.scheduled_time)
+
+
+class ExceptionFingerprintManager(CachingManager):
+
+    def get_for(self, exception_type, message):
+        """
+        Returns the ``ExceptionFingerprint`` of an exception, creating it if
+        needed, and the variable parts of ``message``.
+        """
+        normalized, variables = ExceptionFingerprint.normalize(message)
+        digest = ExceptionFingerprint.get_hash(exception_type, normalized)
+        fingerprint = self.get_cached(digest)
+        if fingerprint is None:
+            fingerprint, created = self.get_or_create(
+                hash=digest, defaults={'exception_type': exception_type, 'message': normalized})
+            self.set_cached(digest, fingerprint, get_fingerprint_cache_size())
+        return fingerprint, variables
+
+
+@python_2_unicode_compatible
+class ExceptionFingerprint(models.Model):
+    """
+    A distinct delivery error, with variable parts of its message such as
+    addresses and numbers replaced by placeholders. Logs of failures refer to
+    it when ``FINGERPRINT_EXCEPTIONS`` is enabled and also store the variable
+    parts, e.g. to find failures of an address.
+    """
+    # Addresses, hexadecimal ids such as queue ids, and numbers
+    VARIABLE_RE = re.compile(
+        r'(?P<email>[^\s<>@"\'(),;:\[\]]+@[\w.-]*\w)'
+        r'|(?P<id>\b(?=[0-9a-fA-F-]*\d)(?=[0-9a-fA-F-]*[a-fA-F])[0-9a-fA-F][0-9a-fA-F-]{5,}\b)'
+        r'|(?P<n>\d+(?:\.\d+)*)')
+    PLACEHOLDER_RE = re.compile(r'<(email|id|n)>')
+
+    hash = models.CharField(max_length=64, unique=True)
+    exception_type = models.CharField(_('Exception type'), max_length=255, blank=True)
+    message = models.TextField(_('Message'), blank=True)
+    count = models.PositiveIntegerField(_('Count'), default=0)
+    last_seen = models.DateTimeField(_('Last seen'), blank=True, null=True, db_index=True)
+
+    objects = ExceptionFingerprintManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Exception fingerprint")
+        verbose_name_plural = _("Exception fingerprints")
+
+    def __str__(self):
+        return '%s: %s' % (self.exception_type, self.message)
+
+    @staticmethod
+    def get_hash(exception_type, message):
+        content = '%s\x00%s' % (exception_type, message)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def normalize(cls, message):
+        """
+        Returns ``message`` with variable parts replaced by placeholders, and
+        the list of replaced parts.
+        """
+        if cls.PLACEHOLDER_RE.search(message):
+            # Placeholders couldn't be told apart when restoring the message
+            return message, []
+        variables = []
+
+        def replace(match):
+            variables.append(match.group(0))
+            return '<%s>' % match.lastgroup
+
+        return cls.VARIABLE_RE.sub(replace, message), variables
+
+    def restore(self, variables):
+        """Returns the original message, given its variable parts."""
+        variables = iter(variables)
+        return self.PLACEHOLDER_RE.sub(lambda match: next(variables, match.group(0)),
+                                       self.message)
 
 
 @python_2_unicode_compatible
@@ -189,6 +716,11 @@ class Log(models.Model):
     status = models.PositiveSmallIntegerField(_('Status'),choices=STATUS_CHOICES)
     exception_type = models.CharField(_('Exception type'),max_length=255, blank=True)
     message = models.TextField(_('Message'), blank=True)
+    fingerprint = models.ForeignKey(ExceptionFingerprint, blank=True, null=True,
+                                    editable=False, related_name='logs',
+                                    verbose_name=_('Exception fingerprint'),
+                                    on_delete=models.PROTECT)
+    variables = JSONField(_('Variables'), blank=True, null=True, editable=False)
 
     class Meta:
         app_label = 'post_office'
@@ -199,6 +731,61 @@ class Log(models.Model):
         return text_type(self.date)
 
 
+def log_deliveries(sent_emails, failed_emails, log_level):
+    """
+    Logs deliveries of ``sent_emails`` and ``failed_emails``, a list of
+    ``(email, exception)``, and updates delivery counters if enabled.
+    """
+    if get_delivery_counters():
+        DeliveryCounter.objects.record(sent_emails, [email for email, e in failed_emails])
+
+    # If log level is 0, log nothing, 1 logs only sending failures
+    # and 2 means log both successes and failures
+    logs = []
+    if log_level >= 1:
+        # Failures are (email, exception type, error, logged message)
+        failures = [(email, type(e).__name__, str(e), str(e)) for email, e in failed_emails]
+        if get_log_deduplicate_failures():
+            # Only the first email failing with each error logs its message,
+            # the others refer to it
+            groups = OrderedDict()
+            for email, exception_type, error, message in failures:
+                groups.setdefault((exception_type, error), []).append(email)
+            failures = []
+            for (exception_type, error), emails in groups.items():
+                first = emails[0]
+                message = error
+                if len(emails) > 1:
+                    message = '%s (and %d other emails)' % (error, len(emails) - 1)
+                failures.append((first, exception_type, error, message))
+                for email in emails[1:]:
+                    failures.append((email, exception_type, error,
+                                     'Same failure as email #%s' % first.id))
+        fingerprint_exceptions = get_fingerprint_exceptions()
+        counts = defaultdict(int)
+        for email, exception_type, error, message in failures:
+            log = Log(email=email, status=STATUS.failed, message=message,
+                      exception_type=exception_type)
+            if fingerprint_exceptions:
+                log.fingerprint, variables = ExceptionFingerprint.objects.get_for(
+                    exception_type, error)
+                log.variables = variables or None
+                counts[log.fingerprint.pk] += 1
+            logs.append(log)
+        for pk, count in counts.items():
+            ExceptionFingerprint.objects.filter(pk=pk).update(
+                count=F('count') + count, last_seen=now())
+
+    if log_level == 2:
+        sample_rate = get_log_success_sample_rate()
+        for email in sent_emails:
+            if sample_rate >= 1 or random.random() < sample_rate:
+                logs.append(Log(email=email, status=STATUS.sent))
+
+    if logs:
+        Log.objects.bulk_create(logs)
+
+
 class EmailTemplateManager(models.Manager):
     def get_by_natural_key(self, name, language, default_template):
         return self.get(name=name, language=language, default_template=default_template)
@@ -281,6 +868,219 @@ class EmailTemplate(models.Model):
         return obj
 
 
+class DeliveryCounterManager(models.Manager):
+
+    def get_interval_start(self, date=None):
+        """
+        Returns the start of the interval ``date`` falls in, intervals are
+        ``DELIVERY_COUNTER_INTERVAL`` seconds long, counting from midnight.
+        """
+        if date is None:
+            date = now()
+        midnight = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        interval = get_delivery_counter_interval()
+        elapsed = int((date - midnight).total_seconds())
+        return midnight + timedelta(seconds=elapsed - elapsed % interval)
+
+    def record(self, sent_emails, failed_emails, date=None):
+        """
+        Adds ``sent_emails`` and ``failed_emails`` to the current interval's
+        counters, with one query per backend alias and template.
+        """
+        counts = defaultdict(lambda: [0, 0])
+        for email in sent_emails:
+            counts[(email.backend_alias, email.template_id)][0] += 1
+        for email in failed_emails:
+            counts[(email.backend_alias, email.template_id)][1] += 1
+
+        start = self.get_interval_start(date)
+        for (backend_alias, template_id), (sent, failed) in counts.items():
+            updated = self.filter(
+                start=start, backend_alias=backend_alias, template_id=template_id
+            ).update(sent=F('sent') + sent, failed=F('failed') + failed)
+            if not updated:
+                # Concurrent senders may both create a row, which is fine
+                # since counters are summed
+                self.create(start=start, backend_alias=backend_alias,
+                            template_id=template_id, sent=sent, failed=failed)
+
+
+@python_2_unicode_compatible
+class DeliveryCounter(models.Model):
+    """
+    Numbers of emails sent and failed during an interval through a backend
+    alias and a template, recorded when ``DELIVERY_COUNTERS`` is enabled.
+    Rows with the same interval, backend alias and template must be summed.
+    """
+    start = models.DateTimeField(_('Start'), db_index=True)
+    backend_alias = models.CharField(_('Backend alias'), blank=True, default='',
+                                     max_length=64)
+    template = models.ForeignKey(EmailTemplate, blank=True, null=True,
+                                 verbose_name=_('Email template'),
+                                 on_delete=models.SET_NULL)
+    sent = models.PositiveIntegerField(_('Sent'), default=0)
+    failed = models.PositiveIntegerField(_('Failed'), default=0)
+
+    objects = DeliveryCounterManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Delivery counter")
+        verbose_name_plural = _("Delivery counters")
+
+    def __str__(self):
+        return text_type(self.start)
+
+
+@python_2_unicode_compatible
+class BulkAction(models.Model):
+    """
+    An admin action on emails matched by ``filters``, run in chunks of ids
+    by the ``run_bulk_actions`` command. ``filters`` holds either the
+    selected ``ids``, or the changelist ``lookups`` and ``search`` along
+    with the highest ``max_id`` matched when the action was created.
+    """
+    ACTION_CHOICES = [('requeue', _("requeue")), ('set_as_sent', _("set as sent"))]
+    STATUS_CHOICES = [(JOB_STATUS.pending, _("pending")), (JOB_STATUS.running, _("running")),
+                      (JOB_STATUS.done, _("done")), (JOB_STATUS.failed, _("failed"))]
+
+    action = models.CharField(_('Action'), max_length=32, choices=ACTION_CHOICES)
+    filters = JSONField(default=dict, editable=False)
+    status = models.PositiveSmallIntegerField(_('Status'), choices=STATUS_CHOICES,
+                                              default=JOB_STATUS.pending, db_index=True)
+    total = models.PositiveIntegerField(_('Total'), blank=True, null=True)
+    processed = models.PositiveIntegerField(_('Processed'), default=0)
+    last_id = models.BigIntegerField(default=0, editable=False)
+    message = models.TextField(_('Message'), blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Bulk action")
+        verbose_name_plural = _("Bulk actions")
+
+    def __str__(self):
+        return '%s #%s' % (self.get_action_display(), self.pk)
+
+    def get_queryset(self):
+        queryset = Email.objects.using(self._state.db).all()
+        if 'ids' in self.filters:
+            queryset = queryset.filter(pk__in=self.filters['ids'])
+        else:
+            queryset = queryset.filter(pk__lte=self.filters['max_id'],
+                                       **self.filters.get('lookups', {}))
+            if self.filters.get('search'):
+                # Search like the changelist the action was started from
+                from django.contrib import admin
+                from .admin import EmailAdmin
+                queryset, use_distinct = EmailAdmin(Email, admin.site).get_search_results(
+                    None, queryset, self.filters['search'])
+                if use_distinct:
+                    queryset = queryset.distinct()
+        return queryset.values_list('pk', flat=True).order_by('pk')
+
+    def run(self, batch_size=1000):
+        """
+        Applies the action to matched emails in chunks of ``batch_size``
+        ordered by id, saving progress after each chunk so an interrupted
+        job resumes where it stopped. Requeued chunks are scheduled
+        ``BULK_ACTION_REQUEUE_INTERVAL`` seconds apart.
+        """
+        queryset = self.get_queryset()
+        if self.total is None:
+            self.total = queryset.count()
+        self.status = JOB_STATUS.running
+        self.save()
+
+        interval = get_bulk_action_requeue_interval()
+        chunk = self.processed // batch_size
+        start = now()
+        try:
+            while True:
+                ids = list(queryset.filter(pk__gt=self.last_id)[:batch_size])
+                if not ids:
+                    break
+                if self.action == 'requeue':
+                    update = {'status': STATUS.queued}
+                    if interval:
+                        update['scheduled_time'] = start + timedelta(seconds=interval * chunk)
+                else:
+                    update = {'status': STATUS.sent}
+                with transaction.atomic(using=self._state.db):
+                    Email.objects.using(self._state.db).filter(pk__in=ids).update(**update)
+                    self.processed += len(ids)
+                    self.last_id = ids[-1]
+                    self.save()
+                chunk += 1
+        except Exception as e:
+            self.status = JOB_STATUS.failed
+            self.message = text_type(e)
+            self.save()
+            raise
+        self.status = JOB_STATUS.done
+        self.save()
+
+
+class StatusCounterManager(models.Manager):
+
+    def add(self, changes):
+        """
+        Adds ``changes``, a dict of numbers of emails by status, to the
+        counters, in a randomly picked shard of each status so concurrent
+        senders rarely wait on the same row.
+        """
+        for status, count in changes.items():
+            if status is None or not count:
+                continue
+            shard = random.randrange(self.model.SHARDS)
+            updated = self.filter(status=status, shard=shard).update(count=F('count') + count)
+            if not updated:
+                # Concurrent senders may both create a row, which is fine
+                # since counters are summed
+                self.create(status=status, shard=shard, count=count)
+
+    def get_counts(self):
+        """Returns the number of emails by status, reading a few rows."""
+        counts = dict((status, 0) for status in STATUS)
+        counts.update(self.values_list('status').annotate(total=models.Sum('count')))
+        return counts
+
+    def rebuild(self):
+        """
+        Recounts emails by status, e.g. after enabling ``STATUS_COUNTERS`` on
+        an existing installation.
+        """
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            counts = Email.objects.using(self.db).get_status_counts()
+            self.bulk_create([self.model(status=status, shard=0, count=count)
+                              for status, count in counts.items() if status is not None])
+
+
+@python_2_unicode_compatible
+class StatusCounter(models.Model):
+    """
+    Numbers of emails by status, maintained when ``STATUS_COUNTERS`` is
+    enabled. Each status is split over ``SHARDS`` rows, which are summed.
+    """
+    SHARDS = 8
+
+    status = models.PositiveSmallIntegerField(_('Status'), choices=Email.STATUS_CHOICES)
+    shard = models.PositiveSmallIntegerField(default=0)
+    count = models.BigIntegerField(_('Count'), default=0)
+
+    objects = StatusCounterManager()
+
+    class Meta:
+        app_label = 'post_office'
+        verbose_name = _("Status counter")
+        verbose_name_plural = _("Status counters")
+
+    def __str__(self):
+        return '%s: %s' % (self.get_status_display(), self.count)
+
+
 def get_upload_path(instance, filename):
     """Overriding to store the original filename"""
     if not instance.name:
@@ -0,0 +1,61 @@
+"""
+Migration operations of ``post_office``. Migrations import this module, so it
+must not import models.
+"""
+from django.db.migrations.operations.base import Operation
+
+
+def is_partitioned_table(connection, table):
+    """Returns whether ``table`` is a partitioned table on PostgreSQL 11+."""
+    if connection.vendor != 'postgresql' or connection.pg_version < 110000:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+                       [table])
+        return cursor.fetchone() is not None
+
+
+class SkipEmailForeignKeys(Operation):
+    """
+    Runs a migration ``operation`` without creating its foreign keys to
+    ``Email`` when ``Email`` is partitioned, since foreign keys can't
+    reference a partitioned table by primary key alone. Related rows are
+    still removed by the ORM and ``partitioning.drop_partitions()``.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    @property
+    def reversible(self):
+        return self.operation.reversible
+
+    def state_forwards(self, app_label, state):
+        self.operation.state_forwards(app_label, state)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        deferred_count = len(schema_editor.deferred_sql)
+        self.operation.database_forwards(app_label, schema_editor, from_state, to_state)
+        table = to_state.apps.get_model('post_office', 'Email')._meta.db_table
+        if not is_partitioned_table(schema_editor.connection, table):
+            return
+
+        reference = 'REFERENCES %s ' % schema_editor.quote_name(table)
+
+        def is_email_foreign_key(statement):
+            if hasattr(statement, 'parts'):
+                # Django 2.0+ keeps statements as objects until they run
+                to_table = statement.parts.get('to_table')
+                return ('FOREIGN KEY' in statement.template and to_table is not None and
+                        to_table.references_table(table))
+            return 'FOREIGN KEY' in statement and reference in statement
+
+        schema_editor.deferred_sql[deferred_count:] = [
+            statement for statement in schema_editor.deferred_sql[deferred_count:]
+            if not is_email_foreign_key(statement)]
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self.operation.database_backwards(app_label, schema_editor, from_state, to_state)
+
+    def describe(self):
+        return self.operation.describe()
@@ -0,0 +1,282 @@
+"""
+Native range partitioning of the ``Email`` and ``Log`` tables by creation date
+on PostgreSQL 11+, with one partition per month. Old emails are then removed
+by detaching and dropping whole partitions instead of deleting rows. Rows
+outside monthly partitions land in a ``<table>_default`` partition, which
+``create_partitions()`` moves them out of.
+
+Foreign keys can't reference a partitioned table by primary key alone, so
+migrations adding foreign keys to ``Email`` wrap their operations in
+``operations.SkipEmailForeignKeys``.
+"""
+import re
+from datetime import datetime
+
+from django.db import connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import (Attachment, Email, EmailBody, Log, QueuedEmail, Recipient,
+                     SharedContext, StatusCounter)
+from .operations import is_partitioned_table
+from .settings import get_database, get_status_counters
+
+# Partitioned models and their partition key, ``Email`` goes first since
+# setting it up drops foreign keys referencing it, including ``Log``'s
+PARTITIONED_MODELS = ((Email, 'created'), (Log, 'date'))
+
+upper_bound_re = re.compile(r"TO \('([^']+)'\)")
+
+
+def is_supported(using=None):
+    using = using or get_database()
+    connection = connections[using]
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def is_partitioned(model, using=None):
+    using = using or get_database()
+    return is_partitioned_table(connections[using], model._meta.db_table)
+
+
+def get_pending_migrations(using=None):
+    """
+    Returns names of unapplied ``post_office`` migrations, which must be
+    applied before partitioning since they may add foreign keys to ``Email``.
+    """
+    using = using or get_database()
+    executor = MigrationExecutor(connections[using])
+    plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+    return [migration.name for migration, backwards in plan
+            if migration.app_label == 'post_office']
+
+
+def month_start(date, months=0):
+    """Returns the first day of ``date``'s month, ``months`` months later."""
+    month = date.month - 1 + months
+    start = datetime(date.year + month // 12, month % 12 + 1, 1)
+    if timezone.is_aware(date):
+        start = timezone.make_aware(start, date.tzinfo)
+    return start
+
+
+def get_partitions(model, using=None):
+    """
+    Returns a list of ``(name, upper_bound)`` of ``model``'s monthly and
+    legacy partitions, ordered by upper bound. The default partition isn't
+    included.
+    """
+    using = using or get_database()
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)',
+            [model._meta.db_table])
+        partitions = []
+        for name, bound in cursor.fetchall():
+            match = upper_bound_re.search(bound)
+            if match:
+                partitions.append((name, parse_datetime(match.group(1))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def get_default_partition(model, using=None):
+    """Returns the name of ``model``'s default partition, or ``None``."""
+    using = using or get_database()
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s) AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT'",
+            [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_setup_sql(model, key, using=None):
+    """
+    Returns the statements turning ``model``'s table into a table partitioned
+    by ``key``. The existing table becomes the ``<table>_legacy`` partition,
+    holding rows created until the end of the current month, later rows go
+    to ``<table>_default`` until monthly partitions are created.
+    """
+    using = using or get_database()
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    table = model._meta.db_table
+    legacy = table + '_legacy'
+    pk = model._meta.pk.column
+    column = model._meta.get_field(key).column
+    bound = month_start(timezone.now(), 1).isoformat()
+
+    statements = []
+    with connection.cursor() as cursor:
+        # Foreign keys can't reference a partitioned table unless they include
+        # the partition key, related rows are removed by the ORM or by
+        # drop_partitions() instead
+        cursor.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = to_regclass(%s)", [table])
+        for referencing_table, name in cursor.fetchall():
+            statements.append('ALTER TABLE %s DROP CONSTRAINT %s' % (referencing_table, quote(name)))
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk])
+        sequence = cursor.fetchone()[0]
+
+    statements += [
+        'ALTER TABLE %s RENAME TO %s' % (quote(table), quote(legacy)),
+        'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (%s)'
+        % (quote(table), quote(legacy), quote(column)),
+        'ALTER TABLE %s ADD PRIMARY KEY (%s, %s)' % (quote(table), quote(pk), quote(column)),
+    ]
+    for field in model._meta.concrete_fields:
+        if field.db_index and not field.primary_key:
+            statements.append('CREATE INDEX %s ON %s (%s)' % (
+                quote('%s_%s_part_idx' % (table, field.column)), quote(table), quote(field.column)))
+    if sequence:
+        statements.append('ALTER SEQUENCE %s OWNED BY %s.%s' % (sequence, quote(table), quote(pk)))
+    # Validating a check constraint first lets ATTACH PARTITION skip scanning
+    # the table while holding its lock
+    statements += [
+        "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL AND %s < '%s') NOT VALID"
+        % (quote(legacy), quote(legacy + '_bound'), quote(column), quote(column), bound),
+        'ALTER TABLE %s VALIDATE CONSTRAINT %s' % (quote(legacy), quote(legacy + '_bound')),
+        "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO ('%s')"
+        % (quote(table), quote(legacy), bound),
+        'CREATE TABLE %s PARTITION OF %s DEFAULT' % (quote(table + '_default'), quote(table)),
+    ]
+    return statements
+
+
+def setup(using=None):
+    """
+    Partitions the ``Email`` and ``Log`` tables and creates partitions for the
+    next months.
+    """
+    using = using or get_database()
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            for model, key in PARTITIONED_MODELS:
+                for statement in get_setup_sql(model, key, using):
+                    cursor.execute(statement)
+        create_partitions(using=using)
+
+
+def create_partitions(months=3, using=None):
+    """
+    Creates monthly partitions of ``Email`` and ``Log`` covering at least the
+    next ``months`` months, moving rows they cover out of the default
+    partition. Returns the names of created partitions.
+    """
+    using = using or get_database()
+    quote = connections[using].ops.quote_name
+    end = month_start(timezone.now(), months + 1)
+    created = []
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        for model, key in PARTITIONED_MODELS:
+            table = model._meta.db_table
+            column = model._meta.get_field(key).column
+            default = get_default_partition(model, using)
+            if default is None:
+                # Tables partitioned before default partitions were added
+                default = table + '_default'
+                cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT'
+                               % (quote(default), quote(table)))
+            partitions = get_partitions(model, using)
+            start = partitions[-1][1] if partitions else month_start(timezone.now())
+            while start < end:
+                next_start = month_start(start, 1)
+                name = '%s_p%s' % (table, start.strftime('%Y%m'))
+                # Rows of the month that landed in the default partition are
+                # moved before attaching, which fails if any are left
+                cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)'
+                               % (quote(name), quote(table)))
+                cursor.execute(
+                    'WITH moved AS (DELETE FROM %s WHERE %s >= %%s AND %s < %%s RETURNING *) '
+                    'INSERT INTO %s SELECT * FROM moved'
+                    % (quote(default), quote(column), quote(column), quote(name)),
+                    [start, next_start])
+                cursor.execute(
+                    'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)'
+                    % (quote(table), quote(name)), [start, next_start])
+                created.append(name)
+                start = next_start
+    return created
+
+
+def get_email_relations():
+    """
+    Returns ``(table, column)`` of tables referencing ``Email`` whose rows are
+    deleted along with dropped partitions.
+    """
+    return [(QueuedEmail._meta.db_table, QueuedEmail._meta.get_field('email').column),
+            (Log._meta.db_table, Log._meta.get_field('email').column),
+            (Recipient._meta.db_table, Recipient._meta.get_field('email').column)]
+
+
+def delete_email_relations(cursor, partition, using=None):
+    """
+    Deletes rows referencing emails of the detached ``partition``, returns
+    the ids of attachments these emails used.
+    """
+    quote = connections[using or get_database()].ops.quote_name
+    emails = 'SELECT %s FROM %s' % (quote(Email._meta.pk.column), quote(partition))
+    through = Attachment.emails.through
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s) RETURNING %s' % (
+        quote(through._meta.db_table), quote(through._meta.get_field('email').column),
+        emails, quote(through._meta.get_field('attachment').column)))
+    attachment_ids = set(row[0] for row in cursor.fetchall())
+    for table, column in get_email_relations():
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (quote(table), quote(column), emails))
+    return attachment_ids
+
+
+def drop_partitions(before, using=None):
+    """
+    Detaches and drops partitions of ``Email`` and ``Log`` only holding rows
+    created before ``before``, along with the rows referencing dropped
+    emails, attachments no other email uses and deduplicated bodies and
+    shared contexts no email uses anymore. Returns the names of dropped
+    partitions.
+    """
+    using = using or get_database()
+    quote = connections[using].ops.quote_name
+    dropped = []
+    attachment_ids = set()
+    body_ids = set()
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        for model, key in PARTITIONED_MODELS:
+            for name, upper_bound in get_partitions(model, using):
+                if upper_bound > before:
+                    break
+                cursor.execute('ALTER TABLE %s DETACH PARTITION %s'
+                               % (quote(model._meta.db_table), quote(name)))
+                if model is Email and get_status_counters():
+                    # The detached partition no longer changes, so counters
+                    # are decreased by exactly what is dropped
+                    cursor.execute('SELECT %s, COUNT(*) FROM %s GROUP BY 1' % (
+                        quote(Email._meta.get_field('status').column), quote(name)))
+                    StatusCounter.objects.db_manager(using).add(
+                        dict((status, -count) for status, count in cursor.fetchall()))
+                if model is Email:
+                    attachment_ids |= delete_email_relations(cursor, name, using)
+                    body = quote(Email._meta.get_field('body').column)
+                    cursor.execute('SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL'
+                                   % (body, quote(name), body))
+                    body_ids.update(row[0] for row in cursor.fetchall())
+                cursor.execute('DROP TABLE %s' % quote(name))
+                dropped.append(name)
+
+        attachments = list(Attachment.objects.using(using)
+                           .filter(id__in=attachment_ids, emails__isnull=True))
+        Attachment.objects.using(using).filter(id__in=[a.id for a in attachments]).delete()
+        EmailBody.objects.using(using).filter(id__in=body_ids, email__isnull=True).delete()
+        if dropped:
+            # Shared contexts are created before their emails, so recent ones
+            # may not be referenced yet
+            SharedContext.objects.using(using) \
+                .filter(created__lt=before, email__isnull=True).delete()
+
+    # Files can't be restored by a rollback, so they're deleted last
+    for attachment in attachments:
+        attachment.file.delete(save=False)
+    return dropped
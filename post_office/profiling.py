@@ -0,0 +1,227 @@
+"""
+Profiling of ``send_queued_mail``. Every process sending emails writes its
+own dump to a directory, ``write_summary()`` then merges them.
+
+Deterministic profiling uses ``cProfile`` and writes ``.prof`` files, which
+``pstats`` and tools like snakeviz read. Sampling records the stacks of all
+threads every ``interval`` seconds and writes ``.samples`` files holding
+collapsed stacks, as used by flame graph tools.
+"""
+import cProfile
+import glob
+import os
+import pstats
+import sys
+from collections import defaultdict
+from threading import Event, Lock, Thread, current_thread, local
+
+from .compat import PY3
+
+if PY3:
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+DETERMINISTIC = 'deterministic'
+SAMPLING = 'sampling'
+
+# Set by enable(), inherited by forked sending processes
+config = None
+current_session = None
+_sequence = [0]
+
+
+def enable(path, mode=DETERMINISTIC, interval=0.01):
+    global config
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    config = {'path': path, 'mode': mode, 'interval': interval}
+
+
+def disable():
+    global config
+    config = None
+
+
+class Sampler(Thread):
+    """Counts the stacks of the process' other threads every ``interval``."""
+
+    def __init__(self, interval):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.stopped = Event()
+
+    def run(self):
+        ident = current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Session(object):
+    """
+    Profiles the current process while active, along with threads running
+    functions passed to ``wrap()`` when profiling deterministically.
+    """
+
+    def __init__(self, role, path, mode, interval):
+        self.role = role
+        self.path = path
+        self.mode = mode
+        self.interval = interval
+        self.pid = os.getpid()
+        self.lock = Lock()
+        self.local = local()
+        self.thread_profilers = []
+
+    def __enter__(self):
+        if self.mode == SAMPLING:
+            self.sampler = Sampler(self.interval)
+            self.sampler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        global current_session
+        if self.mode == SAMPLING:
+            self.sampler.stop()
+        else:
+            self.profiler.disable()
+        current_session = None
+        self.dump()
+
+    def abandon(self):
+        """Stops a session inherited from the parent process, without dumping it."""
+        if self.mode == DETERMINISTIC:
+            self.profiler.disable()
+
+    def wrap(self, func):
+        if self.mode == SAMPLING:
+            return func
+
+        def wrapper(*args, **kwargs):
+            profiler = getattr(self.local, 'profiler', None)
+            if profiler is None:
+                profiler = self.local.profiler = cProfile.Profile()
+                with self.lock:
+                    self.thread_profilers.append(profiler)
+            try:
+                profiler.enable()
+            except ValueError:
+                # Python >= 3.12 only allows one profiler per process, which
+                # then covers every thread
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+        return wrapper
+
+    def get_filename(self, extension):
+        _sequence[0] += 1
+        return os.path.join(self.path, '%s-%d-%d%s' % (self.role, self.pid, _sequence[0],
+                                                       extension))
+
+    def dump(self):
+        if self.mode == SAMPLING:
+            with open(self.get_filename('.samples'), 'w') as f:
+                for stack, count in sorted(self.sampler.stacks.items()):
+                    f.write('%s %d\n' % (stack, count))
+        else:
+            stats = pstats.Stats(self.profiler)
+            for profiler in self.thread_profilers:
+                stats.add(profiler)
+            stats.dump_stats(self.get_filename('.prof'))
+
+
+class NullSession(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def profile_process(role):
+    """
+    Returns a context manager profiling the current process if profiling is
+    enabled.
+    """
+    global current_session
+    if config is None:
+        return NullSession()
+    if current_session is not None and current_session.pid != os.getpid():
+        current_session.abandon()
+    current_session = Session(role, **config)
+    return current_session
+
+
+def wrap_thread(func):
+    """
+    Returns ``func`` profiled in the thread it runs in, when the current
+    process is profiled.
+    """
+    if current_session is None or current_session.pid != os.getpid():
+        return func
+    return current_session.wrap(func)
+
+
+def write_summary(path, limit=50):
+    """
+    Merges dumps found in ``path`` into ``summary.txt``, functions sorted by
+    cumulative time, or by number of samples they appear in. Returns the
+    summary's path.
+    """
+    summary_path = os.path.join(path, 'summary.txt')
+    output = StringIO()
+    profiles = sorted(glob.glob(os.path.join(path, '*.prof')))
+    if profiles:
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        output.write('Merged %d profiles\n' % len(profiles))
+        stats.sort_stats('cumulative').print_stats(limit)
+
+    samples = sorted(glob.glob(os.path.join(path, '*.samples')))
+    if samples:
+        cumulative = defaultdict(int)
+        own = defaultdict(int)
+        total = 0
+        for filename in samples:
+            with open(filename) as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    count = int(count)
+                    frames = stack.split(';')
+                    total += count
+                    own[frames[-1]] += count
+                    # Recursive functions are only counted once per stack
+                    for frame in set(frames):
+                        cumulative[frame] += count
+        output.write('Merged %d sample files, %d samples\n\n' % (len(samples), total))
+        output.write('%10s %10s  %s\n' % ('cumulative', 'own', 'function'))
+        ranked = sorted(cumulative.items(), key=lambda item: (-item[1], item[0]))
+        for frame, count in ranked[:limit]:
+            output.write('%9.1f%% %9.1f%%  %s\n' % (100.0 * count / total,
+                                                     100.0 * own[frame] / total, frame))
+
+    with open(summary_path, 'w') as f:
+        f.write(output.getvalue())
+    return summary_path
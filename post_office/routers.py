@@ -0,0 +1,29 @@
+from .settings import get_database
+
+
+class PostOfficeRouter(object):
+    """
+    Routes queries of post_office models to the database alias set by
+    ``POST_OFFICE['DATABASE']``.
+    """
+    app_label = 'post_office'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return get_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return get_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == self.app_label and obj2._meta.app_label == self.app_label:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == self.app_label:
+            return db == get_database()
+        return None
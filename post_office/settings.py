@@ -2,6 +2,7 @@ import warnings
 
 from django.conf import settings
 from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import connections
 
 from collections import namedtuple
 from .compat import import_attribute, get_cache
@@ -71,6 +72,34 @@ def get_config():
     return getattr(settings, 'POST_OFFICE', {})
 
 
+def get_database():
+    return get_config().get('DATABASE', 'default')
+
+
+def get_read_database():
+    return get_config().get('READ_DATABASE', get_database())
+
+
+def get_fast_admin_changelist():
+    return get_config().get('FAST_ADMIN_CHANGELIST', False)
+
+
+def get_bulk_action_threshold():
+    return get_config().get('BULK_ACTION_THRESHOLD', 1000)
+
+
+def get_bulk_action_requeue_interval():
+    return get_config().get('BULK_ACTION_REQUEUE_INTERVAL', 0)
+
+
+def get_metrics_backend():
+    return get_config().get('METRICS_BACKEND')
+
+
+def get_metrics_options():
+    return get_config().get('METRICS_OPTIONS', {})
+
+
 def get_batch_size():
     return get_config().get('BATCH_SIZE', 100)
 
@@ -87,16 +116,85 @@ def get_log_level():
     return get_config().get('LOG_LEVEL', 2)
 
 
+def get_log_success_sample_rate():
+    return get_config().get('LOG_SUCCESS_SAMPLE_RATE', 1)
+
+
+def get_log_deduplicate_failures():
+    return get_config().get('LOG_DEDUPLICATE_FAILURES', False)
+
+
+def get_fingerprint_exceptions():
+    return get_config().get('FINGERPRINT_EXCEPTIONS', False)
+
+
+def get_fingerprint_cache_size():
+    return get_config().get('FINGERPRINT_CACHE_SIZE', 100)
+
+
+def get_delivery_counters():
+    return get_config().get('DELIVERY_COUNTERS', False)
+
+
+def get_status_counters():
+    return get_config().get('STATUS_COUNTERS', False)
+
+
+def get_delivery_counter_interval():
+    return get_config().get('DELIVERY_COUNTER_INTERVAL', 3600)
+
+
 def get_sending_order():
     return get_config().get('SENDING_ORDER', ['-priority'])
 
 
+def get_queue_table():
+    return get_config().get('QUEUE_TABLE', False)
+
+
+def get_recipient_index():
+    return get_config().get('RECIPIENT_INDEX', False)
+
+
+def get_compress_bodies():
+    return get_config().get('COMPRESS_BODIES', False)
+
+
+def get_deduplicate_bodies():
+    return get_config().get('DEDUPLICATE_BODIES', False)
+
+
+def get_body_cache_size():
+    return get_config().get('BODY_CACHE_SIZE', 100)
+
+
+def get_attachment_cache_size():
+    return get_config().get('ATTACHMENT_CACHE_SIZE', 50 * 1024 * 1024)
+
+
+def get_template_attachment_cache_size():
+    return get_config().get('TEMPLATE_ATTACHMENT_CACHE_SIZE', 50 * 1024 * 1024)
+
+
+def get_shared_context_cache_size():
+    return get_config().get('SHARED_CONTEXT_CACHE_SIZE', 100)
+
+
+def get_attachment_streaming_threshold():
+    return get_config().get('ATTACHMENT_STREAMING_THRESHOLD', None)
+
+
+def get_attachment_spool_size():
+    return get_config().get('ATTACHMENT_SPOOL_SIZE', 1024 * 1024)
+
+
 CONTEXT_FIELD_CLASS = get_config().get('CONTEXT_FIELD_CLASS',
                                        'jsonfield.JSONField')
 context_field_class = import_attribute(CONTEXT_FIELD_CLASS)
 
 PRIORITY = namedtuple('PRIORITY', 'low medium high now')._make(range(4))
 STATUS = namedtuple('STATUS', 'sent failed queued')._make(range(3))
+JOB_STATUS = namedtuple('JOB_STATUS', 'pending running done failed')._make(range(4))
 
 def get_base_email_templates():
     POSTOFFICE_TEMPLATES_DEFAULT = (
@@ -111,3 +209,13 @@ def get_wysiwyg_editors():
 
     ]
     return get_config().get('WYSIWYG_EDITORS', POSTOFFICE_WYSIWYG_EDITORS_DEFAULT)
+
+
+def get_async_threads():
+    # SQLite doesn't handle concurrent writes, so its default is one thread
+    vendor = connections[get_database()].vendor
+    return get_config().get('ASYNC_THREADS', 1 if vendor == 'sqlite' else 4)
+
+
+def get_async_batch_size():
+    return get_config().get('ASYNC_BATCH_SIZE', 100)
@@ -0,0 +1,83 @@
+"""
+Queue depth, age of the oldest queued email and delivery throughput, read
+from counters maintained by ``STATUS_COUNTERS`` and ``DELIVERY_COUNTERS``
+so monitoring doesn't count emails.
+"""
+from datetime import timedelta
+
+from django.db.models import Sum
+from django.utils.timezone import now
+
+from .models import DeliveryCounter, Email, QueuedEmail, StatusCounter
+from .settings import (get_delivery_counter_interval, get_delivery_counters,
+                       get_queue_table, get_read_database, get_status_counters, STATUS)
+
+
+def get_status_counts(using=None):
+    """
+    Returns the number of emails by status, from status counters when
+    enabled, by counting emails otherwise.
+    """
+    using = using or get_read_database()
+    if get_status_counters():
+        return StatusCounter.objects.db_manager(using).get_counts()
+    counts = dict((status, 0) for status in STATUS)
+    counts.update((status, count) for status, count
+                  in Email.objects.using(using).get_status_counts().items()
+                  if status is not None)
+    return counts
+
+
+def get_oldest_queued(using=None):
+    """Returns the creation date of the oldest queued email, if any."""
+    using = using or get_read_database()
+    if get_queue_table():
+        dates = QueuedEmail.objects.using(using).order_by('email') \
+            .values_list('email__created', flat=True)
+    else:
+        dates = Email.objects.using(using).filter(status=STATUS.queued) \
+            .order_by('id').values_list('created', flat=True)
+    return dates.first()
+
+
+def get_throughput(using=None):
+    """
+    Returns the numbers of emails sent and failed per minute during the last
+    complete ``DELIVERY_COUNTER_INTERVAL``, and so far during the current one.
+    """
+    using = using or get_read_database()
+    interval = get_delivery_counter_interval()
+    current = DeliveryCounter.objects.get_interval_start()
+    previous = current - timedelta(seconds=interval)
+    totals = {previous: (0, 0), current: (0, 0)}
+    totals.update((start, (sent, failed)) for start, sent, failed
+                  in DeliveryCounter.objects.using(using).filter(start__gte=previous)
+                  .order_by().values_list('start').annotate(Sum('sent'), Sum('failed')))
+
+    elapsed = max((now() - current).total_seconds(), 60)
+    return {
+        'sent_per_minute': totals[previous][0] * 60.0 / interval,
+        'failed_per_minute': totals[previous][1] * 60.0 / interval,
+        'current_sent_per_minute': totals[current][0] * 60.0 / elapsed,
+        'current_failed_per_minute': totals[current][1] * 60.0 / elapsed,
+    }
+
+
+def get_queue_stats(using=None):
+    """
+    Returns a dict of queue statistics, throughput is only included when
+    ``DELIVERY_COUNTERS`` is enabled.
+    """
+    using = using or get_read_database()
+    counts = get_status_counts(using)
+    oldest_queued = get_oldest_queued(using)
+    stats = {
+        'queued': counts[STATUS.queued],
+        'sent': counts[STATUS.sent],
+        'failed': counts[STATUS.failed],
+        'oldest_queued': oldest_queued,
+        'oldest_queued_age': (now() - oldest_queued).total_seconds() if oldest_queued else None,
+    }
+    if get_delivery_counters():
+        stats.update(get_throughput(using))
+    return stats
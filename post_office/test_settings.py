@@ -8,6 +8,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
     },
+    'mail': {
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
 }
 
 # Default values: True
@@ -44,6 +47,7 @@ INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
+    'django.contrib.messages',
     'post_office',
 )
 
@@ -57,11 +61,13 @@ if StrictVersion(str(django.get_version())) < '1.10':
     MIDDLEWARE_CLASSES = (
         'django.contrib.sessions.middleware.SessionMiddleware',
         'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
     )
 else:
     MIDDLEWARE = [
         'django.contrib.sessions.middleware.SessionMiddleware',
         'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
     ]
 
 TEMPLATES = [
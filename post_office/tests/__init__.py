@@ -1,8 +1,16 @@
+from .test_attachments import (AttachmentCacheTest, StreamingAttachmentTest,
+                               TemplateAttachmentTest)
 from .test_backends import BackendTest
 from .test_commands import CommandTest
 from .test_lockfile import LockTest
-from .test_mail import MailTest
+from .test_metrics import MetricsTest
+from .test_mail import MailTest, EnqueueBufferTest
 from .test_models import ModelTest
+from .test_partitioning import PartitioningTest
 from .test_utils import UtilsTest
 from .test_cache import CacheTest
 from .test_views import AdminViewTest
+from ..compat import PY3
+
+if PY3:
+    from .test_aio import AsyncMailTest
@@ -0,0 +1,80 @@
+import asyncio
+
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+
+from .. import aio
+from ..models import Email, EmailTemplate, PRIORITY, STATUS
+from ..settings import get_async_threads
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class AsyncMailTest(TransactionTestCase):
+
+    def setUp(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.executor, aio._executor = aio._executor, None
+
+    def tearDown(self):
+        asyncio.get_event_loop().close()
+        if aio._executor is not None:
+            aio._executor.shutdown()
+        aio._executor = self.executor
+
+    def test_executor(self):
+        # The test database is SQLite, which doesn't support concurrent writes
+        self.assertEqual(aio.get_executor()._max_workers, 1)
+        with override_settings(POST_OFFICE={'ASYNC_THREADS': 3}):
+            self.assertEqual(get_async_threads(), 3)
+
+    def test_send(self):
+        recipients = ['to%d@example.com' % i for i in range(5)]
+        emails = run(asyncio.gather(*[
+            aio.send(recipients=[recipient], sender='from@example.com', subject='Test')
+            for recipient in recipients
+        ]))
+        self.assertEqual([email.to for email in emails], [[r] for r in recipients])
+        self.assertEqual(Email.objects.filter(status=STATUS.queued).count(), 5)
+
+        email = run(aio.send(recipients=['to@example.com'], sender='from@example.com',
+                             commit=True))
+        self.assertEqual(email.to, ['to@example.com'])
+        email = run(aio.send(recipients=['to@example.com'], sender='from@example.com',
+                             commit=False))
+        self.assertIsNone(email.pk)
+        self.assertEqual(Email.objects.count(), 6)
+
+    def test_send_with_errors(self):
+        results = run(asyncio.gather(
+            aio.send(recipients=['to@example.com'], sender='from@example.com'),
+            aio.send(recipients=['invalid'], sender='from@example.com'),
+            return_exceptions=True,
+        ))
+        self.assertIsInstance(results[0], Email)
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(Email.objects.count(), 1)
+
+    @override_settings(POST_OFFICE={'ASYNC_BATCH_SIZE': 2})
+    def test_send_batch_size(self):
+        run(asyncio.gather(*[
+            aio.send(recipients=['to@example.com'], sender='from@example.com')
+            for i in range(5)
+        ]))
+        self.assertEqual(Email.objects.count(), 5)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_send_now(self):
+        email = run(aio.send(recipients=['to@example.com'], sender='from@example.com',
+                             priority=PRIORITY.now))
+        self.assertEqual(email.status, STATUS.sent)
+
+    def test_send_many(self):
+        run(aio.send_many([{'recipients': ['to@example.com'], 'sender': 'from@example.com'}] * 3))
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_get_email_template(self):
+        template = EmailTemplate.objects.create(name='async', subject='Subject')
+        self.assertEqual(run(aio.get_email_template('async')), template)
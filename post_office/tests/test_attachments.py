@@ -0,0 +1,302 @@
+import email as email_module
+import os
+
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.mail import EmailMessage
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .. import attachments
+from ..attachments import (AttachmentCache, SpooledAttachment, attach,
+                           create_attachment_part, get_template_attachment_cache,
+                           map_file, write_message)
+from ..backends import SMTPDataWriter, StreamingSMTPEmailBackend
+from ..compat import PY3
+from ..mail import _send_bulk, get_queued, send, send_campaign, send_many
+from ..models import (Attachment, AttachmentTemplate, Email, EmailTemplate,
+                      STATUS)
+
+
+class FakeSMTPConnection(object):
+    """Records what an SMTP backend sends to the server."""
+
+    def __init__(self):
+        self.commands = []
+        self.data = b''
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, sender):
+        self.commands.append(('mail', sender))
+        return 250, b'OK'
+
+    def rcpt(self, recipient):
+        self.commands.append(('rcpt', recipient))
+        return 250, b'OK'
+
+    def docmd(self, command):
+        self.commands.append((command,))
+        return 354, b'Go ahead'
+
+    def send(self, data):
+        self.data += data
+
+    def getreply(self):
+        return 250, b'Queued'
+
+    def rset(self):
+        pass
+
+
+class AttachmentCacheTest(TestCase):
+
+    def create_attachment(self, name='test.txt', content='test file content'):
+        attachment = Attachment()
+        attachment.file.save(name, content=ContentFile(content), save=True)
+        return attachment
+
+    def test_cache_is_bounded_by_size(self):
+        """
+        Least recently used parts are evicted once max_size is exceeded and
+        parts larger than the cache are never stored.
+        """
+        cache = AttachmentCache(max_size=10)
+        cache.set('a', 'part a', 4)
+        cache.set('b', 'part b', 4)
+        self.assertEqual(cache.get('a'), 'part a')
+
+        cache.set('c', 'part c', 4)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.size, 8)
+
+        cache.set('d', 'part d', 11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 0,
+                                         'count': 2, 'size': 8})
+
+    def test_shared_attachment_is_encoded_once(self):
+        attachment = self.create_attachment()
+        emails = []
+        for i in range(3):
+            email = Email.objects.create(to=['to@example.com'],
+                                         from_email='from@example.com',
+                                         subject='Subject')
+            email.attachments.add(attachment)
+            emails.append(email)
+
+        cache = AttachmentCache()
+        messages = [email.prepare_email_message(attachment_cache=cache)
+                    for email in emails]
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.size, len('test file content'))
+        self.assertIs(messages[0].attachments[0], messages[2].attachments[0])
+
+        part = messages[0].attachments[0]
+        self.assertEqual(part.get_filename(), 'test.txt')
+        self.assertEqual(part.get_content_type(), 'text/plain')
+
+    def test_attachment_part_matches_django(self):
+        for name, content in [('test.txt', u'caf\xe9'.encode('utf-8')),
+                              ('latin.txt', u'caf\xe9'.encode('latin-1')),
+                              ('test.bin', b'\x00\x01binary')]:
+            attachment = self.create_attachment(name=name, content=content)
+            part = create_attachment_part(attachment)[0]
+
+            message = EmailMessage()
+            message.attach(name, content)
+            expected = message.message().get_payload()[-1]
+            self.assertEqual(part.get_content_type(), expected.get_content_type())
+            self.assertEqual(part.get_filename(), expected.get_filename())
+            self.assertEqual(part.get_payload(decode=True),
+                             expected.get_payload(decode=True))
+
+    def test_local_files_are_memory_mapped(self):
+        content = os.urandom(1000)
+        attachment = self.create_attachment(name='data.bin', content=content)
+        mapping = map_file(attachment)
+        self.assertEqual(mapping[:], content)
+        mapping.close()
+
+        part, size = create_attachment_part(attachment)
+        self.assertEqual(size, 1000)
+        self.assertEqual(part.get_content_type(), 'application/octet-stream')
+        self.assertEqual(part.get_payload(decode=True), content)
+        self.assertEqual(part.get_filename(), 'data.bin')
+
+        # Empty files can't be mapped
+        self.assertIsNone(map_file(self.create_attachment(name='empty.bin', content='')))
+
+    @override_settings(POST_OFFICE={'ATTACHMENT_CACHE_SIZE': 0})
+    def test_disabled_cache(self):
+        cache = AttachmentCache()
+        cache.set('a', 'part a', 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_send_bulk_with_shared_attachment(self):
+        attachment = self.create_attachment(name='test.bin', content='binary')
+        emails = []
+        for i in range(2):
+            email = Email.objects.create(to=['to@example.com'],
+                                         from_email='from@example.com',
+                                         subject='Subject', status=STATUS.queued,
+                                         backend_alias='locmem')
+            email.attachments.add(attachment)
+            emails.append(email)
+
+        _send_bulk(emails, uses_multiprocessing=False)
+        self.assertEqual(len(mail.outbox), 2)
+        for message in mail.outbox:
+            self.assertIn('filename="test.bin"', message.message().as_string())
+
+
+@override_settings(POST_OFFICE={'ATTACHMENT_STREAMING_THRESHOLD': 1024,
+                                'ATTACHMENT_SPOOL_SIZE': 4096})
+class StreamingAttachmentTest(TestCase):
+
+    def create_attachment(self, content, name='data.bin'):
+        attachment = Attachment()
+        attachment.file.save(name, content=ContentFile(content), save=True)
+        return attachment
+
+    def create_message(self, attachment):
+        message = EmailMessage(subject='Subject', body='Body',
+                               from_email='from@example.com',
+                               to=['to@example.com'])
+        attach(message, attachment)
+        return message
+
+    def test_large_attachments_are_spooled(self):
+        content = os.urandom(100 * 1024)
+        message = self.create_message(self.create_attachment(content))
+        part = message.attachments[0]
+        self.assertIsInstance(part, SpooledAttachment)
+        self.assertEqual(part.decoded_payload(), content)
+        self.assertEqual(part.memory_size, 4096)
+        self.assertEqual(part.get_filename(), 'data.bin')
+
+        # Small and text attachments are encoded in memory
+        message = self.create_message(self.create_attachment(b'small'))
+        self.assertEqual(message.attachments[0].get_payload(decode=True), b'small')
+        message = self.create_message(self.create_attachment(b'a' * 2048, name='a.txt'))
+        self.assertEqual(message.attachments[0][2], 'text/plain')
+
+    def test_write_message(self):
+        content = os.urandom(100 * 1024)
+        message = self.create_message(self.create_attachment(content)).message()
+
+        class Output(object):
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+
+        output = Output()
+        write_message(message, output)
+        self.assertTrue(max(len(chunk) for chunk in output.chunks) < len(content))
+
+        data = b''.join(output.chunks)
+        if PY3:
+            parsed = email_module.message_from_bytes(data)
+        else:
+            parsed = email_module.message_from_string(data)
+        self.assertEqual(parsed['Subject'], 'Subject')
+        body, attachment = parsed.get_payload()
+        self.assertEqual(body.get_payload(), 'Body')
+        self.assertEqual(attachment.get_payload(decode=True), content)
+
+        # Other generators fall back to reading the whole spool
+        self.assertIn(data.split(b'\n\n', 1)[1][-200:], message.as_bytes()
+                      if PY3 else message.as_string())
+
+    def test_smtp_data_writer(self):
+        connection = FakeSMTPConnection()
+        writer = SMTPDataWriter(connection, buffer_size=10)
+        writer.write(b'first line\n.dot')
+        writer.write(b' line\r\nlast')
+        writer.close()
+        self.assertEqual(connection.data,
+                         b'first line\r\n..dot line\r\nlast\r\n.\r\n')
+
+    def test_streaming_backend(self):
+        content = os.urandom(10 * 1024)
+        message = self.create_message(self.create_attachment(content))
+        backend = StreamingSMTPEmailBackend()
+        backend.connection = FakeSMTPConnection()
+        self.assertTrue(backend._send(message))
+        self.assertEqual(backend.connection.commands,
+                         [('mail', 'from@example.com'),
+                          ('rcpt', 'to@example.com'), ('data',)])
+
+        data = backend.connection.data
+        self.assertTrue(data.endswith(b'\r\n.\r\n'))
+        data = data[:-3].replace(b'\r\n', b'\n')
+        if PY3:
+            parsed = email_module.message_from_bytes(data)
+        else:
+            parsed = email_module.message_from_string(data)
+        self.assertEqual(parsed.get_payload()[1].get_payload(decode=True), content)
+
+
+class TemplateAttachmentTest(TestCase):
+
+    def setUp(self):
+        attachments._template_attachment_cache = None
+        self.template = EmailTemplate.objects.create(name='brochure')
+        self.attachment = AttachmentTemplate()
+        self.attachment.file.save('brochure.pdf', content=ContentFile(b'%PDF'),
+                                  save=True)
+        self.attachment.email_templates.add(self.template)
+
+    def create_email(self, template):
+        return Email.objects.create(to=['to@example.com'], template=template,
+                                    from_email='from@example.com', context={})
+
+    def test_template_attachments_are_included(self):
+        message = self.create_email(self.template).prepare_email_message()
+        part = message.attachments[0]
+        self.assertEqual(part.get_filename(), 'brochure.pdf')
+        self.assertEqual(part.get_payload(decode=True), b'%PDF')
+
+        # Translated templates use the default template's attachments
+        translated = EmailTemplate.objects.create(default_template=self.template,
+                                                  language='it')
+        message = self.create_email(translated).prepare_email_message()
+        self.assertIs(message.attachments[0], part)
+
+    def test_emails_rendered_when_queued(self):
+        send('to@example.com', 'from@example.com', template=self.template,
+             context={'name': 'Alice'}, backend='locmem')
+        send_many([{'recipients': ['to@example.com'], 'sender': 'from@example.com',
+                    'template': self.template, 'context': {'name': name},
+                    'backend': 'locmem'} for name in ['Bob', 'Carol']])
+        send_campaign(self.template, ['dave@example.com', 'erin@example.com'],
+                      sender='from@example.com', backend='locmem')
+        self.assertFalse(Email.objects.filter(rendered_template=None).exists())
+
+        _send_bulk(get_queued(), uses_multiprocessing=False)
+        self.assertEqual(len(mail.outbox), 5)
+        for message in mail.outbox:
+            self.assertEqual(message.attachments[0].get_filename(), 'brochure.pdf')
+
+    def test_parts_are_cached_per_process(self):
+        cache = AttachmentCache()
+        for i in range(3):
+            self.create_email(self.template).prepare_email_message(attachment_cache=cache)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(get_template_attachment_cache().stats()['misses'], 1)
+
+        # A new batch reuses the part encoded by the previous one
+        first = self.create_email(self.template).prepare_email_message(
+            attachment_cache=AttachmentCache())
+        self.assertEqual(get_template_attachment_cache().stats()['hits'], 1)
+
+        # Modifying the file invalidates the cached part
+        path = self.attachment.file.path
+        os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 10))
+        second = self.create_email(self.template).prepare_email_message()
+        self.assertIsNot(first.attachments[0], second.attachments[0])
@@ -1,11 +1,22 @@
 import datetime
+import gzip
+import json
+import os
+import pstats
+import shutil
+import tempfile
 
 from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
+from django.db.models import ProtectedError
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils.six import StringIO
 from django.utils.timezone import now
 
-from ..models import Email, STATUS
+from ..models import Attachment, Email, EmailTemplate, Log, SharedContext, STATUS
+from ..partitioning import month_start
 
 
 class CommandTest(TestCase):
@@ -29,6 +40,48 @@ class CommandTest(TestCase):
         call_command('cleanup_mail', days=30)
         self.assertEqual(Email.objects.count(), 0)
 
+    def test_cleanup_mail_shared_contexts(self):
+        old_context = SharedContext.objects.create(context={'issue': 1})
+        current_context = SharedContext.objects.create(context={'issue': 2})
+        SharedContext.objects.update(created=now() - datetime.timedelta(31))
+        email = Email.objects.create(from_email='from@example.com',
+                                     to=['to@example.com'], shared_context=old_context)
+        Email.objects.create(from_email='from@example.com', to=['to@example.com'],
+                             shared_context=current_context)
+        Email.objects.filter(id=email.id).update(created=now() - datetime.timedelta(31))
+        new_context = SharedContext.objects.create(context={'issue': 3})
+
+        call_command('cleanup_mail', days=30)
+        self.assertEqual(set(SharedContext.objects.all()), {current_context, new_context})
+        with self.assertRaises(ProtectedError):
+            current_context.delete()
+
+    def test_cleanup_mail_batches(self):
+        old = now() - datetime.timedelta(31)
+        emails = [Email.objects.create(from_email='from@example.com', to=['to@example.com'])
+                  for i in range(4)]
+        Email.objects.filter(id__in=[email.id for email in emails[:3]]).update(created=old)
+
+        orphan = Attachment.objects.create(name='orphan.txt')
+        orphan.file.save('orphan.txt', ContentFile(b'orphan'), save=True)
+        orphan.emails.add(emails[0], emails[1])
+        shared = Attachment.objects.create(name='shared.txt')
+        shared.file.save('shared.txt', ContentFile(b'shared'), save=True)
+        shared.emails.add(emails[2], emails[3])
+
+        out = StringIO()
+        call_command('cleanup_mail', days=30, batch_size=2, dry_run=True, stdout=out)
+        self.assertIn('Would delete 3 mails and 1 attachments', out.getvalue())
+        self.assertEqual(Email.objects.count(), 4)
+
+        out = StringIO()
+        call_command('cleanup_mail', days=30, batch_size=2, stdout=out)
+        self.assertIn('Deleted 3 mails and 1 attachments', out.getvalue())
+        self.assertEqual(list(Email.objects.all()), [emails[3]])
+        self.assertEqual(list(Attachment.objects.all()), [shared])
+        self.assertFalse(orphan.file.storage.exists(orphan.file.name))
+        self.assertTrue(shared.file.storage.exists(shared.file.name))
+
     TEST_SETTINGS = {
         'BACKENDS': {
             'default': 'django.core.mail.backends.dummy.EmailBackend',
@@ -53,6 +106,40 @@ class CommandTest(TestCase):
         self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 2)
         self.assertEqual(Email.objects.filter(status=STATUS.queued).count(), 0)
 
+    def test_send_queued_mail_profile(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for i in range(2):
+            Email.objects.create(from_email='from@example.com',
+                                 to=['to@example.com'], status=STATUS.queued)
+        out = StringIO()
+        call_command('send_queued_mail', processes=1, profile=path, stdout=out)
+        self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 2)
+        run_path = os.path.join(path, os.listdir(path)[0])
+        profiles = [name for name in os.listdir(run_path) if name.endswith('.prof')]
+        self.assertEqual(len(profiles), 1)
+        # Threads sending emails are profiled too
+        stats = pstats.Stats(os.path.join(run_path, profiles[0]))
+        self.assertIn('dispatch', [function for filename, line, function in stats.stats])
+        with open(os.path.join(run_path, 'summary.txt')) as f:
+            self.assertIn('Merged 1 profiles', f.read())
+        self.assertIn('summary.txt', out.getvalue())
+
+        # Runs are written to their own directory and summarized separately
+        Email.objects.create(from_email='from@example.com',
+                             to=['to@example.com'], status=STATUS.queued)
+        call_command('send_queued_mail', processes=1, profile=path,
+                     profile_mode='sampling', profile_interval=0.001, stdout=out)
+        runs = sorted(os.listdir(path))
+        self.assertEqual(len(runs), 2)
+        run_path = os.path.join(path, runs[1])
+        self.assertEqual(len([name for name in os.listdir(run_path)
+                              if name.endswith('.samples')]), 1)
+        with open(os.path.join(run_path, 'summary.txt')) as f:
+            summary = f.read()
+        self.assertIn('Merged 1 sample files', summary)
+        self.assertNotIn('profiles', summary)
+
     def test_successful_deliveries_logging(self):
         """
         Successful deliveries are only logged when log_level is 2.
@@ -93,3 +180,127 @@ class CommandTest(TestCase):
                                      backend_alias='error')
         call_command('send_queued_mail', log_level=2)
         self.assertEqual(email.logs.count(), 1)
+
+    def test_enqueue_mail(self):
+        """
+        ``enqueue_mail`` queues an email for every valid row, writes invalid
+        rows to the rejects file and can resume from a reported offset.
+        """
+        template = EmailTemplate.objects.create(name='newsletter')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = os.path.join(directory, 'recipients.csv')
+        with open(path, 'wb') as f:
+            f.write(b'email,name\n'
+                    b'alice@example.com,Alice\n'
+                    b'invalid,Bob\n'
+                    b'carol@example.com,Carol\n')
+        out = StringIO()
+        call_command('enqueue_mail', path, template='newsletter', chunk_size=1,
+                     render_on_delivery=True, stdout=out)
+        emails = Email.objects.order_by('id')
+        self.assertEqual([email.to for email in emails],
+                         [['alice@example.com'], ['carol@example.com']])
+        self.assertEqual(emails[0].context, {'name': 'Alice'})
+        self.assertEqual(emails[0].template, template)
+        self.assertEqual(emails[0].status, STATUS.queued)
+
+        with open(path + '.rejected') as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual(rejected[0]['line'], 'invalid,Bob')
+        self.assertEqual(rejected[0]['offset'], len('email,name\nalice@example.com,Alice\n'))
+
+        # Resume after the first row
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Queued 1 emails, rejected 0 rows, next offset: 35')
+        call_command('enqueue_mail', path, template='newsletter', offset=35,
+                     rejects=os.path.join(directory, 'rejects'), stdout=StringIO())
+        self.assertEqual(Email.objects.filter(to='carol@example.com').count(), 2)
+        self.assertEqual(Email.objects.filter(to='alice@example.com').count(), 1)
+
+    def test_enqueue_mail_multiline_fields(self):
+        EmailTemplate.objects.create(name='newsletter')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = os.path.join(directory, 'recipients.csv')
+        with open(path, 'wb') as f:
+            f.write(b'email,address\n'
+                    b'alice@example.com,"1 Main St\nSpringfield"\n'
+                    b'invalid,"2 Main St\nSpringfield"\n'
+                    b'carol@example.com,3 Main St\n')
+        out = StringIO()
+        call_command('enqueue_mail', path, template='newsletter', chunk_size=1,
+                     render_on_delivery=True, stdout=out)
+        emails = Email.objects.order_by('id')
+        self.assertEqual([email.to for email in emails],
+                         [['alice@example.com'], ['carol@example.com']])
+        self.assertEqual(emails[0].context, {'address': '1 Main St\nSpringfield'})
+
+        with open(path + '.rejected') as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual(rejected[0]['line'], 'invalid,"2 Main St\nSpringfield"')
+        self.assertEqual(rejected[0]['offset'], 56)
+        self.assertIn('next offset: 56', out.getvalue().splitlines()[0])
+
+    def test_enqueue_mail_invalid_context(self):
+        EmailTemplate.objects.create(name='newsletter')
+        with self.assertRaises(CommandError):
+            call_command('enqueue_mail', 'recipients.csv', template='newsletter',
+                         context='{"issue": ')
+        with self.assertRaises(CommandError):
+            call_command('enqueue_mail', 'recipients.csv', template='newsletter',
+                         context='[1]')
+
+    def test_enqueue_mail_jsonl(self):
+        SharedContext.objects.clear_cache()
+        EmailTemplate.objects.create(name='newsletter')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = os.path.join(directory, 'recipients.jsonl')
+        with open(path, 'wb') as f:
+            f.write(b'{"email": ["a@example.com", "b@example.com"], "context": {"n": 1}}\n'
+                    b'not json\n')
+        call_command('enqueue_mail', path, template='newsletter', render_on_delivery=True,
+                     context='{"issue": 2}', stdout=StringIO())
+        email = Email.objects.get()
+        self.assertEqual(email.to, ['a@example.com', 'b@example.com'])
+        self.assertEqual(email.get_context(), {'n': 1, 'issue': 2})
+        self.assertTrue(os.path.exists(path + '.rejected'))
+
+    def test_archive_mail(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        emails = [Email.objects.create(from_email='from@example.com', to=['to@example.com'],
+                                       subject='Email %d' % i) for i in range(4)]
+        Email.objects.filter(id__in=[email.id for email in emails[:3]]) \
+            .update(created=now() - datetime.timedelta(31))
+        Log.objects.create(email=emails[0], status=STATUS.sent)
+
+        call_command('archive_mail', directory, days=30, batch_size=2, rows_per_file=2,
+                     stdout=StringIO())
+        self.assertEqual(list(Email.objects.all()), [emails[3]])
+        self.assertEqual(Log.objects.count(), 0)
+
+        rows = []
+        files = sorted(os.listdir(directory))
+        self.assertEqual(len(files), 2)
+        for name in files:
+            with gzip.open(os.path.join(directory, name), 'rb') as f:
+                rows.extend(json.loads(line.decode('utf-8')) for line in f)
+        self.assertEqual([row['subject'] for row in rows], ['Email 0', 'Email 1', 'Email 2'])
+        self.assertEqual(rows[0]['to'], ['to@example.com'])
+        self.assertEqual([log['status'] for log in rows[0]['logs']], [STATUS.sent])
+
+    def test_mail_partitions(self):
+        # Partitioning is only supported on PostgreSQL
+        with self.assertRaises(CommandError):
+            call_command('mail_partitions', 'create', stdout=StringIO())
+
+        self.assertEqual(month_start(datetime.datetime(2020, 11, 15, 10), 0),
+                         datetime.datetime(2020, 11, 1))
+        self.assertEqual(month_start(datetime.datetime(2020, 11, 15, 10), 2),
+                         datetime.datetime(2021, 1, 1))
@@ -6,13 +6,18 @@ from django.core import mail
 from django.core.files.base import ContentFile
 from django.conf import settings
 
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase
 from django.test.utils import override_settings
 
 from ..settings import get_batch_size, get_log_level, get_threads_per_process
-from ..models import Email, EmailTemplate, Attachment, PRIORITY, STATUS
-from ..mail import (create, get_queued,
-                    send, send_many, send_queued, _send_bulk)
+from ..attachments import AttachmentCache
+from ..models import (Email, EmailBody, EmailQuerySet, EmailTemplate, Attachment,
+                      DeliveryCounter, ExceptionFingerprint, Log, QueuedEmail, SharedContext,
+                      StatusCounter, PRIORITY, STATUS)
+from ..mail import (buffered, create, get_queued, has_queued, send,
+                    send_campaign, send_many, send_queued, _send_bulk)
+from ..middleware import EnqueueBufferMiddleware
 
 
 connection_counter = 0
@@ -33,6 +38,9 @@ class ConnectionTestingBackend(mail.backends.base.BaseEmailBackend):
 
 class MailTest(TestCase):
 
+    def setUp(self):
+        SharedContext.objects.clear_cache()
+
     @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
     def test_send_queued_mail(self):
         """
@@ -228,6 +236,180 @@ class MailTest(TestCase):
         send_many(kwargs_list)
         self.assertEqual(Email.objects.filter(to=['a@example.com']).count(), 1)
 
+    def test_send_campaign(self):
+        template = EmailTemplate.objects.create(name='newsletter')
+
+        def recipients():
+            for i in range(5):
+                yield {'recipients': 'user%d@example.com' % i,
+                       'context': {'name': 'User %d' % i}}
+            yield 'last@example.com'
+
+        progress = []
+        count = send_campaign(template, recipients(), context={'name': 'Anonymous',
+                                                               'issue': 1},
+                              chunk_size=2, progress=progress.append,
+                              sender='from@example.com', render_on_delivery=True)
+        self.assertEqual(count, 6)
+        self.assertEqual(progress, [2, 4, 6])
+
+        emails = Email.objects.order_by('id')
+        self.assertEqual(emails.count(), 6)
+        self.assertEqual(emails[0].to, ['user0@example.com'])
+        self.assertEqual(emails[0].get_context(), {'name': 'User 0', 'issue': 1})
+        self.assertEqual(emails[5].get_context(), {'name': 'Anonymous', 'issue': 1})
+        self.assertEqual(emails[5].template, template)
+        self.assertEqual(emails[5].status, STATUS.queued)
+
+        # The shared context is only stored once
+        self.assertEqual(SharedContext.objects.count(), 1)
+        self.assertEqual(emails[0].context, {'name': 'User 0'})
+        self.assertEqual(emails[5].context, {})
+
+        # Templates can be specified by name too
+        self.assertEqual(send_campaign('newsletter', ['a@example.com']), 1)
+
+    def test_deduplicate_bodies(self):
+        EmailBody.objects.clear_cache()
+        template = EmailTemplate.objects.create(name='announcement', subject='Hi {{ name }}')
+        # EmailTemplate.save() overwrites content
+        EmailTemplate.objects.filter(pk=template.pk).update(
+            content='Announcement', html_content='<p>Announcement</p>')
+        template.refresh_from_db()
+        with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, DEDUPLICATE_BODIES=True)):
+            send_many([{'recipients': ['to%d@example.com' % i], 'sender': 'from@example.com',
+                        'template': template, 'context': {'name': i}} for i in range(3)])
+        self.assertEqual(EmailBody.objects.count(), 1)
+        body = EmailBody.objects.get()
+        self.assertEqual(Email.objects.filter(body=body, message='', html_message='').count(), 3)
+
+        emails = list(get_queued())
+        cache = AttachmentCache()
+        messages = [email.prepare_email_message(attachment_cache=cache).message()
+                    for email in emails]
+        self.assertEqual([message['Subject'] for message in messages], ['Hi 0', 'Hi 1', 'Hi 2'])
+        # MIME parts of the body are shared
+        self.assertIs(messages[0].get_payload()[1], messages[1].get_payload()[1])
+        self.assertEqual(messages[0].get_payload()[0].get_payload(), 'Announcement')
+        self.assertEqual(messages[2].get_payload()[1].get_payload(), '<p>Announcement</p>')
+
+        # Cached bodies deleted meanwhile are created again
+        Email.objects.all().delete()
+        EmailBody.objects.all().delete()
+        new_body = EmailBody.objects.get_for('Announcement', '<p>Announcement</p>')
+        self.assertNotEqual(new_body.pk, body.pk)
+        self.assertTrue(EmailBody.objects.filter(pk=new_body.pk).exists())
+
+    def test_log_modes(self):
+        def create(count, **kwargs):
+            return [Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                         status=STATUS.queued, **kwargs)
+                    for i in range(count)]
+
+        log_settings = dict(settings.POST_OFFICE, LOG_SUCCESS_SAMPLE_RATE=0,
+                            LOG_DEDUPLICATE_FAILURES=True, DELIVERY_COUNTERS=True)
+        with self.settings(POST_OFFICE=log_settings):
+            _send_bulk(create(2) + create(3, backend_alias='error'),
+                       uses_multiprocessing=False, log_level=2)
+
+        # Successes aren't sampled and the three identical failures only log
+        # their message once
+        logs = list(Log.objects.order_by('email_id'))
+        self.assertEqual([log.status for log in logs], [STATUS.failed] * 3)
+        self.assertTrue(logs[0].message.endswith('(and 2 other emails)'))
+        self.assertEqual([log.message for log in logs[1:]],
+                         ['Same failure as email #%s' % logs[0].email_id] * 2)
+        self.assertEqual(set(log.exception_type for log in logs), set([logs[0].exception_type]))
+
+        counters = dict((counter.backend_alias, (counter.sent, counter.failed))
+                        for counter in DeliveryCounter.objects.all())
+        self.assertEqual(counters, {'': (2, 0), 'error': (0, 3)})
+        self.assertEqual(DeliveryCounter.objects.get(backend_alias='').start,
+                         DeliveryCounter.objects.get_interval_start())
+
+    def test_exception_fingerprints(self):
+        ExceptionFingerprint.objects.clear_cache()
+        emails = [Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                       status=STATUS.queued, backend_alias='error')
+                  for i in range(3)]
+        with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, FINGERPRINT_EXCEPTIONS=True)):
+            _send_bulk(emails, uses_multiprocessing=False, log_level=1)
+
+        fingerprint = ExceptionFingerprint.objects.get()
+        self.assertEqual(fingerprint.count, 3)
+        self.assertEqual(fingerprint.exception_type, 'Exception')
+        for log in Log.objects.all():
+            self.assertEqual(log.fingerprint, fingerprint)
+            self.assertEqual(log.message, 'Fake Error')
+            self.assertIsNone(log.variables)
+
+        message = "(550, b'5.1.1 <bob@example.com>: Recipient address rejected')"
+        normalized, variables = ExceptionFingerprint.normalize(message)
+        self.assertEqual(normalized, "(<n>, b'<n> <<email>>: Recipient address rejected')")
+        self.assertEqual(ExceptionFingerprint(message=normalized).restore(variables), message)
+
+    def test_status_counters(self):
+        def assertCounts(queued, sent, failed):
+            counts = StatusCounter.objects.get_counts()
+            self.assertEqual((counts[STATUS.queued], counts[STATUS.sent], counts[STATUS.failed]),
+                             (queued, sent, failed))
+
+        with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, STATUS_COUNTERS=True)):
+            send(recipients=['to@example.com'], sender='from@example.com')
+            send_many([{'recipients': ['to@example.com'], 'sender': 'from@example.com'},
+                       {'recipients': ['to@example.com'], 'sender': 'from@example.com',
+                        'backend': 'error'}])
+            assertCounts(3, 0, 0)
+
+            _send_bulk(list(get_queued()), uses_multiprocessing=False)
+            assertCounts(0, 2, 1)
+
+            send(recipients=['to@example.com'], sender='from@example.com',
+                 priority=PRIORITY.now)
+            assertCounts(0, 3, 1)
+
+            Email.objects.filter(status=STATUS.failed).update(status=STATUS.queued)
+            assertCounts(1, 3, 0)
+            Email.objects.filter(status=STATUS.sent).first().delete()
+            Email.objects.filter(status=STATUS.queued).delete()
+            assertCounts(0, 2, 0)
+            self.assertLessEqual(StatusCounter.objects.count(), 3 * StatusCounter.SHARDS)
+
+            # Changes are counted from the statuses of updated rows
+            Email.objects.filter(pk=Email.objects.earliest('pk').pk).update(status=STATUS.queued)
+            assertCounts(1, 1, 0)
+            self.assertEqual(Email.objects.update(status=STATUS.failed), 2)
+            assertCounts(0, 0, 2)
+
+            StatusCounter.objects.rebuild()
+            assertCounts(0, 0, 2)
+
+    def test_send_with_shared_context(self):
+        template = EmailTemplate.objects.create(name='shared')
+        # Bypass EmailTemplate.save(), which builds content from content_data
+        EmailTemplate.objects.filter(id=template.id).update(
+            subject='{{ title }} for {{ name }}')
+        template = EmailTemplate.objects.get(id=template.id)
+        shared_context = SharedContext.objects.create(context={'title': 'News',
+                                                               'name': 'nobody'})
+
+        email = send(recipients=['to@example.com'], sender='from@example.com',
+                     template=template, context={'name': 'Alice'},
+                     shared_context=shared_context, render_on_delivery=True)
+        email = Email.objects.get(id=email.id)
+        self.assertEqual(email.context, {'name': 'Alice'})
+        self.assertEqual(email.email_message().subject, 'News for Alice')
+
+        # Shared contexts are cached per process
+        with self.assertNumQueries(0):
+            self.assertEqual(email.get_context(), {'title': 'News', 'name': 'Alice'})
+
+        # The shared context is merged right away when rendering on creation
+        email = send(recipients=['to@example.com'], sender='from@example.com',
+                     template=template, shared_context=shared_context)
+        self.assertEqual(email.subject, 'News for nobody')
+        self.assertEqual(email.shared_context, None)
+
     def test_send_with_attachments(self):
         attachments = {
             'attachment_file1.txt': ContentFile('content'),
@@ -397,4 +579,141 @@ class MailTest(TestCase):
                                      template=template, status=STATUS.queued)
         _send_bulk([email], uses_multiprocessing=False)
         email = Email.objects.get(id=email.id)
-        self.assertEqual(email.status, STATUS.failed)
\ No newline at end of file
+        self.assertEqual(email.status, STATUS.failed)
+
+    def test_queue_table(self):
+        queue_settings = dict(settings.POST_OFFICE, QUEUE_TABLE=True,
+                              BACKENDS={'default': 'django.core.mail.backends.locmem.EmailBackend'})
+        with self.settings(POST_OFFICE=queue_settings):
+            kwargs = {'to': ['to@example.com'], 'from_email': 'from@example.com'}
+            queued = Email.objects.create(status=STATUS.queued, priority=PRIORITY.low, **kwargs)
+            scheduled = Email.objects.create(status=STATUS.queued, scheduled_time=datetime(2100, 1, 1),
+                                             **kwargs)
+            Email.objects.create(status=STATUS.sent, **kwargs)
+            send_many([{'recipients': ['to@example.com'], 'sender': 'from@example.com',
+                        'priority': PRIORITY.high}] * 2)
+            self.assertEqual(QueuedEmail.objects.count(), 4)
+            self.assertTrue(QueuedEmail.objects.filter(email=scheduled).exists())
+
+            emails = list(get_queued())
+            self.assertEqual(len(emails), 3)
+            self.assertEqual(emails[-1], queued)
+            self.assertTrue(has_queued())
+
+            send_queued()
+            self.assertFalse(has_queued())
+            self.assertEqual(list(QueuedEmail.objects.values_list('email', flat=True)),
+                             [scheduled.id])
+            self.assertEqual(Email.objects.filter(status=STATUS.sent).count(), 4)
+
+            # Requeued emails get a queue entry again
+            Email.objects.filter(pk=queued.pk).update(status=STATUS.queued)
+            self.assertEqual(list(get_queued()), [queued])
+
+            # Large updates are done in chunks
+            EmailQuerySet.update_chunk_size = 2
+            self.addCleanup(setattr, EmailQuerySet, 'update_chunk_size', 1000)
+            self.assertEqual(Email.objects.exclude(pk=queued.pk).update(status=STATUS.queued), 4)
+            self.assertEqual(QueuedEmail.objects.count(), 5)
+            sent = Email.objects.exclude(pk__in=[queued.pk, scheduled.pk])
+            self.assertEqual(sent.update(status=STATUS.sent), 3)
+            self.assertEqual(QueuedEmail.objects.count(), 2)
+            QueuedEmail.objects.all().delete()
+            self.assertEqual(QueuedEmail.objects.rebuild(), 2)
+
+            # Entries of emails sent without the ORM are removed when polled
+            QueuedEmail.objects.filter(email=scheduled).update(scheduled_time=None)
+            with connection.cursor() as cursor:
+                cursor.execute('UPDATE post_office_email SET status = %s WHERE id IN (%s, %s)',
+                               [STATUS.sent, queued.pk, scheduled.pk])
+            self.assertTrue(has_queued())
+            self.assertEqual(list(get_queued()), [])
+            self.assertFalse(QueuedEmail.objects.exists())
+
+
+class EnqueueBufferTest(TransactionTestCase):
+    multi_db = True  # Django < 2.2
+    databases = '__all__'
+
+    def test_buffered(self):
+        kwargs = {'recipients': ['to@example.com'], 'sender': 'from@example.com'}
+        with buffered() as buffer:
+            email = send(**kwargs)
+            self.assertIsNone(email.pk)
+            self.assertEqual(buffer.emails, [email])
+            with buffered() as nested:
+                self.assertIs(nested, buffer)
+                send(**kwargs)
+            self.assertEqual(Email.objects.count(), 0)
+            # Emails sent right away aren't buffered
+            send(priority=PRIORITY.now, **kwargs)
+            self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_buffered_with_transaction(self):
+        kwargs = {'recipients': ['to@example.com'], 'sender': 'from@example.com'}
+        with buffered():
+            with transaction.atomic():
+                send(**kwargs)
+            try:
+                with transaction.atomic():
+                    send(**kwargs)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(Email.objects.count(), 1)
+
+        # Buffers used inside a transaction are flushed when it's committed
+        with transaction.atomic():
+            with buffered():
+                send(**kwargs)
+            self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(Email.objects.count(), 2)
+
+        with self.assertRaises(ValueError):
+            with buffered():
+                send(**kwargs)
+                raise ValueError
+        self.assertEqual(Email.objects.count(), 2)
+
+    @override_settings(DATABASE_ROUTERS=['post_office.routers.PostOfficeRouter'])
+    def test_buffered_with_mail_database(self):
+        # Emails are only flushed once transactions on both the default and
+        # the mail database are committed
+        kwargs = {'recipients': ['to@example.com'], 'sender': 'from@example.com'}
+        with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, DATABASE='mail')):
+            with transaction.atomic():
+                with buffered():
+                    send(**kwargs)
+                self.assertEqual(Email.objects.count(), 0)
+            self.assertEqual(Email.objects.using('mail').count(), 1)
+
+            with transaction.atomic(), transaction.atomic(using='mail'):
+                with buffered():
+                    send(**kwargs)
+            self.assertEqual(Email.objects.using('mail').count(), 2)
+
+            try:
+                with transaction.atomic():
+                    with buffered():
+                        send(**kwargs)
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(Email.objects.using('mail').count(), 2)
+        self.assertEqual(Email.objects.using('default').count(), 0)
+
+    def test_middleware(self):
+        request = RequestFactory().get('/')
+        middleware = EnqueueBufferMiddleware()
+        middleware.process_request(request)
+        send(recipients=['to@example.com'], sender='from@example.com')
+        self.assertEqual(Email.objects.count(), 0)
+        middleware.process_response(request, None)
+        self.assertEqual(Email.objects.count(), 1)
+
+        middleware.process_request(request)
+        send(recipients=['to@example.com'], sender='from@example.com')
+        middleware.process_exception(request, ValueError())
+        middleware.process_response(request, None)
+        self.assertEqual(Email.objects.count(), 1)
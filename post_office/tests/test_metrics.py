@@ -0,0 +1,87 @@
+import os
+import socket
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+
+from ..mail import send, send_queued
+from ..metrics import NullMetrics, PrometheusMetrics, StatsdMetrics, get_metrics
+
+
+class MetricsTest(TestCase):
+
+    def test_get_metrics(self):
+        self.assertIsInstance(get_metrics(), NullMetrics)
+        self.assertFalse(get_metrics().enabled)
+
+        config = dict(settings.POST_OFFICE, METRICS_BACKEND='post_office.metrics.PrometheusMetrics')
+        with self.settings(POST_OFFICE=config):
+            metrics = get_metrics()
+            self.assertIsInstance(metrics, PrometheusMetrics)
+            self.assertIs(get_metrics(), metrics)
+
+    def test_prometheus(self):
+        path = os.path.join(tempfile.mkdtemp(), 'post_office.prom')
+        metrics = PrometheusMetrics(path=path)
+        metrics.incr('emails', 2, status='sent')
+        metrics.timing('stage', 0.5, stage='send')
+        with metrics.timer('stage', stage='send'):
+            pass
+
+        # Metrics of another process are added up
+        other = PrometheusMetrics()
+        other.incr('emails', 3, status='sent')
+        metrics.merge(other.collect())
+        self.assertEqual(other.collect(), ({}, {}))
+
+        metrics.flush()
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('post_office_emails_total{status="sent"} 5.0', lines)
+        self.assertIn('post_office_stage_seconds_count{stage="send"} 2', lines)
+        self.assertTrue([line for line in lines
+                         if line.startswith('post_office_stage_seconds_sum{stage="send"} 0.5')])
+
+    def test_prometheus_families(self):
+        metrics = PrometheusMetrics()
+        metrics.incr('emails', status='sent')
+        metrics.incr('emails', status='failed')
+        metrics.timing('stage', 0.5, stage='send')
+        metrics.timing('stage', 0.25, stage='render')
+        self.assertEqual(metrics.render().splitlines(), [
+            '# TYPE post_office_emails_total counter',
+            'post_office_emails_total{status="failed"} 1.0',
+            'post_office_emails_total{status="sent"} 1.0',
+            '# TYPE post_office_stage_seconds summary',
+            'post_office_stage_seconds_sum{stage="render"} 0.25',
+            'post_office_stage_seconds_count{stage="render"} 1',
+            'post_office_stage_seconds_sum{stage="send"} 0.5',
+            'post_office_stage_seconds_count{stage="send"} 1',
+        ])
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        metrics = StatsdMetrics(host='127.0.0.1', port=server.getsockname()[1])
+        metrics.incr('emails', 2, status='sent')
+        metrics.timing('stage', 0.25, stage='send')
+        self.assertEqual(server.recv(1024), b'post_office.emails.sent:2|c')
+        self.assertEqual(server.recv(1024), b'post_office.stage.send:250|ms')
+        server.close()
+
+    def test_send_queued_stages(self):
+        config = dict(settings.POST_OFFICE, METRICS_BACKEND='post_office.metrics.PrometheusMetrics')
+        with self.settings(POST_OFFICE=config):
+            metrics = get_metrics()
+            send(recipients=['to@example.com'], sender='from@example.com')
+            send(recipients=['to@example.com'], sender='from@example.com', backend='error')
+            send_queued()
+            counters, timings = metrics.collect()
+
+        self.assertEqual(counters[('emails', (('status', 'sent'),))], 1)
+        self.assertEqual(counters[('emails', (('status', 'failed'),))], 1)
+        stages = set(dict(tags)['stage'] for name, tags in timings)
+        self.assertEqual(stages, set(['fetch', 'load_bodies', 'prepare', 'attachments',
+                                      'send', 'update_status', 'log']))
@@ -10,9 +10,11 @@ from django.core.files.base import ContentFile
 from django.core.mail import EmailMessage, EmailMultiAlternatives
 from django.forms.models import modelform_factory
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from ..models import Email, Log, PRIORITY, STATUS, EmailTemplate, Attachment
-from ..mail import send
+from ..fields import is_compressed
+from ..mail import get_queued, send, _load_bodies
 
 
 class ModelTest(TestCase):
@@ -322,3 +324,47 @@ class ModelTest(TestCase):
         deserialized_objects = serializers.deserialize('json', data, use_natural_primary_keys=True)
         list(deserialized_objects)[0].save()
         self.assertEqual(EmailTemplate.objects.count(), 1)
+
+    @override_settings(POST_OFFICE=dict(django_settings.POST_OFFICE, COMPRESS_BODIES='zlib'))
+    def test_compressed_bodies(self):
+        html_message = '<p>%s</p>' % ('Newsletter ' * 200)
+        email = Email.objects.create(to=['to@example.com'], from_email='from@example.com',
+                                     message='Short', html_message=html_message,
+                                     status=STATUS.queued)
+        message, stored_html = Email.objects.values_list('message', 'html_message').get()
+        self.assertEqual(message, 'Short')
+        self.assertTrue(is_compressed(stored_html))
+        self.assertLess(len(stored_html), len(html_message))
+
+        email = Email.objects.get(id=email.id)
+        self.assertEqual(email.html_message, html_message)
+
+        self.assertEqual(get_queued()[0].get_deferred_fields(), set())
+
+        # Bodies are deferred until emails are sent
+        email = get_queued(defer_bodies=True)[0]
+        self.assertEqual(email.get_deferred_fields(), {'message', 'html_message'})
+        _load_bodies([email])
+        self.assertEqual(email.get_deferred_fields(), set())
+        self.assertEqual(email.email_message().alternatives, [(html_message, 'text/html')])
+
+        # Compressed bodies are still read when compression is disabled
+        with self.settings(POST_OFFICE={}):
+            self.assertEqual(Email.objects.get(id=email.id).html_message, html_message)
+
+    def test_router(self):
+        from django.contrib.auth.models import User
+        from ..routers import PostOfficeRouter
+        router = PostOfficeRouter()
+        self.assertEqual(router.db_for_read(Email), 'default')
+        self.assertIsNone(router.db_for_write(User))
+
+        with self.settings(POST_OFFICE=dict(django_settings.POST_OFFICE, DATABASE='mail')):
+            self.assertEqual(router.db_for_read(Email), 'mail')
+            self.assertEqual(router.db_for_write(Log), 'mail')
+            self.assertIsNone(router.db_for_read(User))
+            self.assertTrue(router.allow_relation(Email(), Log()))
+            self.assertIsNone(router.allow_relation(Email(), User()))
+            self.assertTrue(router.allow_migrate('mail', 'post_office'))
+            self.assertFalse(router.allow_migrate('default', 'post_office'))
+            self.assertIsNone(router.allow_migrate('default', 'auth'))
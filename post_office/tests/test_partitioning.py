@@ -0,0 +1,92 @@
+from django.core.files.base import ContentFile
+from django.db import connection, migrations, models
+from django.db.migrations.loader import MigrationLoader
+from django.test import TestCase
+from django.utils.timezone import now
+
+from .. import mail, partitioning
+from ..models import (Attachment, Email, EmailBody, Log, QueuedEmail, Recipient,
+                      SharedContext)
+from ..operations import SkipEmailForeignKeys
+
+
+class PartitioningTest(TestCase):
+
+    def setUp(self):
+        if not partitioning.is_supported():
+            self.skipTest('Partitioning requires PostgreSQL 11 or later')
+        self.assertEqual(partitioning.get_pending_migrations(), [])
+        partitioning.setup()
+
+    def count_rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(table))
+            return cursor.fetchone()[0]
+
+    def test_default_partition(self):
+        self.assertTrue(partitioning.is_partitioned(Email))
+        self.assertEqual(partitioning.get_default_partition(Email), 'post_office_email_default')
+        self.assertEqual(len(partitioning.get_partitions(Log)), 4)
+
+        # Emails created beyond monthly partitions are kept in the default one
+        email = mail.send('to@example.com', 'from@example.com', subject='Later')
+        later = partitioning.month_start(now(), 6)
+        Email.objects.filter(id=email.id).update(created=later)
+        self.assertEqual(self.count_rows('post_office_email_default'), 1)
+
+        created = partitioning.create_partitions(months=6)
+        self.assertIn('post_office_email_p%s' % later.strftime('%Y%m'), created)
+        self.assertEqual(self.count_rows('post_office_email_default'), 0)
+        self.assertEqual(self.count_rows('post_office_email_p%s' % later.strftime('%Y%m')), 1)
+        self.assertEqual(Email.objects.get(id=email.id).subject, 'Later')
+
+    def test_drop_partitions(self):
+        context = SharedContext.objects.create(context={'issue': 1})
+        old = mail.send('to@example.com', 'from@example.com', shared_context=context)
+        Email.objects.filter(id=old.id).update(body=EmailBody.objects.get_for('Old', ''))
+        Log.objects.create(email=old, status=0)
+        QueuedEmail.objects.get_or_create(email=old, defaults={'priority': old.priority})
+        Recipient.objects.create(email=old, role='to', address='to@example.com',
+                                 domain='example.com')
+        orphan = Attachment()
+        orphan.file.save('orphan.txt', ContentFile(b'orphan'), save=True)
+        orphan.emails.add(old)
+        shared = Attachment()
+        shared.file.save('shared.txt', ContentFile(b'shared'), save=True)
+        shared.emails.add(old)
+
+        # An email of a later partition keeps its attachment
+        later = mail.send('to@example.com', 'from@example.com')
+        Email.objects.filter(id=later.id).update(created=partitioning.month_start(now(), 1))
+        shared.emails.add(later)
+
+        dropped = partitioning.drop_partitions(partitioning.month_start(now(), 1))
+        self.assertEqual(dropped, ['post_office_email_legacy', 'post_office_log_legacy'])
+        self.assertEqual(list(Email.objects.all()), [later])
+        self.assertFalse(Log.objects.exists())
+        self.assertFalse(QueuedEmail.objects.filter(email_id=old.id).exists())
+        self.assertFalse(Recipient.objects.filter(email_id=old.id).exists())
+        self.assertEqual(list(Attachment.objects.all()), [shared])
+        self.assertFalse(orphan.file.storage.exists(orphan.file.name))
+        self.assertTrue(shared.file.storage.exists(shared.file.name))
+        self.assertFalse(SharedContext.objects.exists())
+        self.assertFalse(EmailBody.objects.exists())
+
+    def test_foreign_keys(self):
+        # Migrations adding foreign keys to Email skip their constraints
+        state = MigrationLoader(connection).project_state()
+        new_state = state.clone()
+        operation = SkipEmailForeignKeys(migrations.CreateModel(
+            name='EmailReference',
+            fields=[
+                ('id', models.AutoField(primary_key=True)),
+                ('email', models.ForeignKey(on_delete=models.CASCADE, to='post_office.Email')),
+            ],
+        ))
+        operation.state_forwards('post_office', new_state)
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('post_office', schema_editor, state, new_state)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM pg_constraint WHERE contype = 'f' AND "
+                           "confrelid = to_regclass('post_office_email')")
+            self.assertEqual(cursor.fetchone()[0], 0)
@@ -1,14 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.management import call_command
 from django.contrib.auth.models import User
 from django.test.client import Client
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.html import escape
 
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
 
-from post_office import mail
-from post_office.models import Email
+from post_office import cache, mail
+from post_office.models import (BulkAction, Email, EmailBody, EmailTemplate,
+                                ExceptionFingerprint, Log, STATUS)
+from post_office.settings import JOB_STATUS
 
 
 admin_username = 'real_test_admin'
@@ -33,3 +43,195 @@ class AdminViewTest(TestCase):
         email = Email.objects.latest('id')
         response = self.client.get(reverse('admin:post_office_email_change', args=[email.id]))
         self.assertEqual(response.status_code, 200)
+
+        # Logs of fingerprinted failures show their message
+        message = "(550, b'5.1.1 <bob@example.com>: Recipient address rejected')"
+        fingerprint, variables = ExceptionFingerprint.objects.get_for(
+            'SMTPRecipientsRefused', message)
+        Log.objects.create(email=email, status=STATUS.failed, message=message,
+                           fingerprint=fingerprint, variables=variables)
+        response = self.client.get(reverse('admin:post_office_email_change', args=[email.id]))
+        self.assertContains(response, escape(message))
+        self.assertEqual(Log.objects.get(fingerprint=fingerprint).variables,
+                         ['550', '5.1.1', 'bob@example.com'])
+
+    def test_admin_change_page_deduplicated_body(self):
+        body = EmailBody.objects.get_for('Hello', '<p>Shared body</p>')
+        email = Email.objects.create(to=['test@example.com'], from_email='from@example.com',
+                                     body=body)
+        response = self.client.get(reverse('admin:post_office_email_change', args=[email.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '&lt;p&gt;Shared body&lt;/p&gt;</textarea>')
+
+    def test_admin_search_by_recipient(self):
+        with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, RECIPIENT_INDEX=True)):
+            mail.send(recipients=['Alice <Alice@Example.com>'], sender='from@example.com')
+            mail.send_many([{'recipients': ['bob@example.org'], 'cc': ['alice@example.com'],
+                             'sender': 'from@example.com'}])
+            alice, bob = Email.objects.order_by('id')
+
+            self.assertEqual(list(Email.objects.with_recipient('alice@example.com')), [alice, bob])
+            self.assertEqual(list(Email.objects.with_recipient('alice@example.com', ['to'])),
+                             [alice])
+            self.assertEqual(list(Email.objects.with_recipient('@example.org')), [bob])
+
+            response = self.client.get(reverse('admin:post_office_email_changelist'),
+                                       {'q': '@example.org'})
+            self.assertEqual(list(response.context['cl'].result_list), [bob])
+            response = self.client.get(reverse('admin:post_office_email_changelist'),
+                                       {'q': 'alice@example.com'})
+            self.assertEqual(list(response.context['cl'].result_list), [bob, alice])
+
+            # Other terms are searched in search_fields
+            response = self.client.get(reverse('admin:post_office_email_changelist'),
+                                       {'q': 'alice@example.com bob'})
+            self.assertEqual(list(response.context['cl'].result_list), [])
+            response = self.client.get(reverse('admin:post_office_email_changelist'),
+                                       {'q': 'alice@'})
+            self.assertEqual(list(response.context['cl'].result_list), [alice])
+
+    def test_fast_changelist(self):
+        from post_office.admin import EmailAdmin, estimate_count
+        template = EmailTemplate.objects.create(name='welcome')
+        for i in range(3):
+            mail.send(recipients=['to@example.com'], sender='from@example.com')
+        first, second, third = Email.objects.order_by('id')
+        Email.objects.filter(id__in=[second.id, third.id]).update(template=template)
+        self.assertEqual(estimate_count(Email.objects.all()), 3)
+
+        url = reverse('admin:post_office_email_changelist')
+        list_per_page = EmailAdmin.list_per_page
+        EmailAdmin.list_per_page = 2
+        try:
+            with self.settings(POST_OFFICE=dict(settings.POST_OFFICE, FAST_ADMIN_CHANGELIST=True)):
+                response = self.client.get(url)
+                cl = response.context['cl']
+                self.assertTrue(cl.keyset)
+                self.assertEqual(list(cl.result_list), [third, second])
+                self.assertEqual(cl.next_cursor, second.id)
+                self.assertIsNone(cl.full_result_count)
+                self.assertContains(response, '?before=%s' % second.id)
+
+                response = self.client.get(url, {'before': second.id})
+                cl = response.context['cl']
+                self.assertEqual(list(cl.result_list), [first])
+                self.assertIsNone(cl.next_cursor)
+
+                response = self.client.get(url, {'template_name': 'welcome'})
+                self.assertEqual(list(response.context['cl'].result_list), [third, second])
+                self.assertContains(response, '<option value="welcome">')
+
+                # Other orderings use numbered pages
+                response = self.client.get(url, {'o': '1'})
+                self.assertFalse(response.context['cl'].keyset)
+                self.assertEqual(response.context['cl'].result_count, 3)
+        finally:
+            EmailAdmin.list_per_page = list_per_page
+
+    def test_bulk_actions(self):
+        for i in range(4):
+            mail.send(recipients=['to@example.com'], sender='from@example.com')
+        Email.objects.update(status=STATUS.failed)
+        ids = list(Email.objects.order_by('id').values_list('id', flat=True))
+        url = reverse('admin:post_office_email_changelist')
+
+        # Small selections are updated right away
+        self.client.post(url, {'action': 'set_as_sent', '_selected_action': ids[:1]})
+        self.assertEqual(Email.objects.get(id=ids[0]).status, STATUS.sent)
+
+        config = dict(settings.POST_OFFICE, BULK_ACTION_THRESHOLD=1,
+                      BULK_ACTION_REQUEUE_INTERVAL=60)
+        with self.settings(POST_OFFICE=config):
+            response = self.client.post('%s?status__exact=%d&q=example' % (url, STATUS.failed),
+                                        {'action': 'requeue', 'select_across': '1',
+                                         '_selected_action': ids[1:2]}, follow=True)
+            job = BulkAction.objects.get()
+            self.assertContains(response, reverse('admin:post_office_bulkaction_change',
+                                                  args=[job.id]))
+            self.assertEqual(job.filters, {
+                'lookups': {'status__exact': str(STATUS.failed)}, 'search': 'example',
+                'max_id': ids[3]})
+            self.assertEqual(Email.objects.filter(status=STATUS.queued).count(), 0)
+
+            # Emails created afterwards are left alone
+            mail.send(recipients=['to@example.com'], sender='from@example.com')
+            Email.objects.filter(status=STATUS.queued).update(status=STATUS.failed)
+            call_command('run_bulk_actions', batch_size=2)
+
+        job = BulkAction.objects.get()
+        self.assertEqual(job.status, JOB_STATUS.done)
+        self.assertEqual((job.processed, job.total), (3, 3))
+        emails = Email.objects.order_by('id')
+        self.assertEqual([email.status for email in emails],
+                         [STATUS.sent] + [STATUS.queued] * 3 + [STATUS.failed])
+        self.assertEqual(emails[3].scheduled_time - emails[1].scheduled_time,
+                         timedelta(seconds=60))
+
+        response = self.client.get(reverse('admin:post_office_bulkaction_changelist'))
+        self.assertContains(response, '3 / 3')
+
+    def test_template_admin(self):
+        from post_office.admin import EmailTemplateAdmin
+        url = reverse('admin:post_office_emailtemplate_changelist')
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        for name in ('first', 'second', 'third'):
+            template = EmailTemplate.objects.create(name=name)
+            EmailTemplate.objects.create(name=name, language='it', default_template=template)
+            if name == 'first':
+                num_queries = count_queries()
+        self.assertEqual(count_queries(), num_queries)
+        self.assertContains(self.client.get(url), '<td class="field-languages_compact">it</td>')
+
+        # Previews are cached until the template is updated
+        template_admin = EmailTemplateAdmin(EmailTemplate, admin.site)
+        EmailTemplate.objects.filter(id=template.id).update(html_content='<p>Hello</p>')
+        template = EmailTemplate.objects.get(id=template.id)
+        self.assertIn('Hello', template_admin.get_mail_preview(template))
+        EmailTemplate.objects.filter(id=template.id).update(html_content='<p>Bye</p>')
+        template = EmailTemplate.objects.get(id=template.id)
+        self.assertIn('Hello', template_admin.get_mail_preview(template))
+        template.last_updated += timedelta(seconds=1)
+        self.assertIn('Bye', template_admin.get_mail_preview(template))
+        self.assertIn('Bye', template_admin.get_mail_preview(template, is_plain_text=True))
+
+        # Unless template caching is disabled
+        EmailTemplate.objects.filter(id=template.id).update(html_content='<p>Hi</p>')
+        template = EmailTemplate.objects.get(id=template.id)
+        with self.settings(POST_OFFICE_TEMPLATE_CACHE=False):
+            self.assertIn('Hi', template_admin.get_mail_preview(template))
+            EmailTemplate.objects.filter(id=template.id).update(html_content='<p>Ciao</p>')
+            template = EmailTemplate.objects.get(id=template.id)
+            self.assertIn('Ciao', template_admin.get_mail_preview(template))
+        cache_backend, cache.cache_backend = cache.cache_backend, None
+        try:
+            self.assertIn('Ciao', template_admin.get_mail_preview(template))
+        finally:
+            cache.cache_backend = cache_backend
+
+    def test_dashboard(self):
+        config = dict(settings.POST_OFFICE, STATUS_COUNTERS=True, DELIVERY_COUNTERS=True)
+        with self.settings(POST_OFFICE=config):
+            mail.send(recipients=['to@example.com'], sender='from@example.com')
+            mail.send(recipients=['to@example.com'], sender='from@example.com',
+                      priority='now')
+            queued = Email.objects.get(status=STATUS.queued)
+
+            response = self.client.get(reverse('admin:post_office_email_dashboard_json'))
+            stats = response.json()
+            self.assertEqual((stats['queued'], stats['sent'], stats['failed']), (1, 1, 0))
+            self.assertIsNotNone(stats['oldest_queued_age'])
+            self.assertEqual(stats['sent_per_minute'], 0)
+            self.assertGreater(stats['current_sent_per_minute'], 0)
+
+            response = self.client.get(reverse('admin:post_office_email_dashboard'))
+            self.assertEqual(response.context['stats']['oldest_queued'], queued.created)
+            self.assertContains(response, 'Sent per minute')
+
+        response = self.client.get(reverse('admin:post_office_email_changelist'))
+        self.assertContains(response, reverse('admin:post_office_email_dashboard'))